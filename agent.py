@@ -1,29 +1,419 @@
-from flask import Flask, jsonify
+from flask import Flask, Response, g, jsonify, request, stream_with_context
+from werkzeug.serving import make_server
+import argparse
 import json
+import logging
+import os
+import threading
+import time
+from collections import deque
 
-# Setup flash server and define pipe
+from shmring import RingReader, RING_PATH
+from history import MetricHistory
+from tsstore import TimeSeriesStore, DEFAULT_STORE_DIR
+from wireformat import JSON_MIME, SERVED_HEADER, compact_json, encode_response, encode_sample, is_number, negotiate
+from selfstats import Stats, COLLECTOR_STATS_PATH, prometheus_text, read_published
+from alerts import AlertEngine, DEFAULT_RULES, DEFAULT_RULES_PATH, load_rules, make_rules
+from proctable import RANKINGS
+from anomaly import AnomalyEngine, THRESHOLD as ANOMALY_THRESHOLD
+
+# waitress is the production WSGI server served through (it's in requirements.txt), with werkzeug's
+# threaded server as the fallback where it can't be installed
+try:
+    import waitress
+except ImportError:
+    waitress = None
+
+# Setup flask server and attach to the collector's ring buffer
 app = Flask(__name__)
-PIPE_PATH = '/tmp/metrics_pipe'
+ring = RingReader(RING_PATH)
+ring_lock = threading.RLock()
+
+# The agent's own counters, served with the collector's on /internal/stats
+stats = Stats('agent')
+
+# Alert rules, checked against every sample as it comes off the ring whether or not anyone is watching
+try:
+    alert_engine = AlertEngine(load_rules(DEFAULT_RULES_PATH))
+except ValueError as e:
+    print(f"Couldn't load the alert rules from {DEFAULT_RULES_PATH}, using the defaults: {e}")
+    alert_engine = AlertEngine(make_rules(DEFAULT_RULES))
+
+# Recent history kept by the agent itself, so clients can backfill after a disconnect
+history = MetricHistory()
+# Long term history the collector keeps on disk
+archive = TimeSeriesStore(DEFAULT_STORE_DIR, readonly=True)
+# How unusual each metric is for this server, scored on every sample against a baseline from the history on disk
+anomaly_engine = AnomalyEngine(archive)
+# How often the background thread checks the ring for new samples. Checking is a single read of the ring's
+# head, so it's cheap to do often: every RING_POLL_INTERVAL from shortly before the next sample is due until
+# it lands, and every RING_IDLE_INTERVAL otherwise (in case the collector speeds up or starts again).
+RING_POLL_INTERVAL = 0.002
+RING_IDLE_INTERVAL = 0.1
+RING_WAKE_MARGIN = 0.01 # Seconds before the next sample is due to start checking often
+MAX_HISTORY_SAMPLES = 3600 # Cap on samples returned by one history request
+
+# The most recently parsed sample, so repeated polls between collector ticks don't parse it again, and its
+# /metrics body in each format, so it is only encoded once however many clients poll. The ETag is made from
+# the sequence number and timestamp, so it changes with every sample even if the collector starts counting again.
+latest_cache = {"seq": None, "data": None, "bodies": {}, "etag": None}
+
+# Serving limits, so a burst of pollers can't take CPU away from whatever the server is there to run
+DEFAULT_PORT = 5050
+SPARE_THREADS = 2 # waitress workers left over once the caps are reached, to answer everything else with a 503
+MAX_CONCURRENT_REQUESTS = 8 # Requests handled at once, the rest wait briefly and then get a 503
+MAX_STREAMS = 32 # Open /metrics/stream connections (they don't count towards the request limit)
+SLOT_WAIT = 0.5 # Seconds a request waits for a free slot
+request_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+open_streams = 0
+streams_lock = threading.Lock()
+
+# Recent samples already formatted as server-sent events, so every stream shares one encoding per sample
+STREAM_BACKLOG = 600 # How far back a reconnecting stream can resume from
+STREAM_KEEPALIVE = 15 # Seconds between keepalive comments on an idle stream
+recent_events = deque(maxlen=STREAM_BACKLOG)
+new_sample = threading.Condition()
+
+# Move every sample the history doesn't have yet from the ring into it. Each sample is parsed exactly once.
+def sync_history():
+    with ring_lock:
+        started = time.perf_counter()
+        head = ring.head()
+        # The collector rebuilt the ring and started counting again, so our history is from another run
+        if head < history.last_seq:
+            history.clear()
+            recent_events.clear()
+        last_seq = history.last_seq
+        samples = ring.since(last_seq, head)
+        # The ring lapped us and overwrote samples before we got to them
+        if samples and last_seq and samples[0][0] > last_seq + 1:
+            stats.count('samples_dropped_total', samples[0][0] - last_seq - 1)
+        for seq, timestamp, payload in samples:
+            data = json.loads(payload)
+            data["seq"] = seq
+            # Every sample carries the alerts that are pending or firing as of that sample
+            data["alerts"] = alert_engine.evaluate(data)
+            # And how unusual each metric is, with the ones far enough out to count as anomalies
+            data["anomaly_scores"], data["anomalies"] = anomaly_engine.evaluate(data)
+            history.append(seq, data)
+            body = compact_json(data)
+            recent_events.append((seq, timestamp, f"id: {seq}\nevent: sample\ndata: {body.decode()}\n\n"))
+            latest_cache["seq"] = seq
+            latest_cache["data"] = data
+            latest_cache["bodies"] = {JSON_MIME: body}
+            latest_cache["etag"] = f"{seq}-{int(timestamp * 1000)}"
+        if samples:
+            stats.count('samples_total', len(samples))
+            stats.observe('ring_sync_seconds', time.perf_counter() - started)
+    # Wake up any streams waiting on a new sample
+    if samples:
+        with new_sample:
+            new_sample.notify_all()
+    return head
+
+# Keep the history filled even while nobody is polling, and get each sample to the streams as soon as it lands
+def follow_ring():
+    while True:
+        try:
+            with ring_lock:
+                changed = ring.head() != history.last_seq
+            if changed:
+                sync_history()
+        except FileNotFoundError:
+            pass # Collector hasn't started yet
+        except Exception as e:
+            stats.count('ring_errors_total')
+            print(f"An error occurred while reading the ring buffer: {e}")
+        time.sleep(ring_check_delay())
+
+# Seconds until the ring should next be checked: often when a sample is about due, less so until then
+def ring_check_delay():
+    data = latest_cache["data"]
+    if not data or not is_number(data.get("timestamp")) or not is_number(data.get("interval")):
+        return RING_IDLE_INTERVAL
+    until_due = data["timestamp"] + data["interval"] - time.time()
+    return max(RING_POLL_INTERVAL, min(RING_IDLE_INTERVAL, until_due - RING_WAKE_MARGIN))
+
+threading.Thread(target=follow_ring, daemon=True).start()
+
+# Get the newest sample, parsing it only if it's one we haven't seen yet
+def latest_sample():
+    with ring_lock:
+        if latest_cache["seq"] != ring.head():
+            sync_history()
+        return latest_cache["data"]
 
-# Define where the metrics are
+# Time every request and hold it to the concurrency limit
+@app.before_request
+def start_request():
+    g.started = time.perf_counter()
+    g.has_slot = False
+    if request.endpoint == 'stream_metrics':
+        return None # Streams are limited on their own
+    if not request_slots.acquire(timeout=SLOT_WAIT):
+        stats.count('requests_rejected_total')
+        return jsonify({"error": "Agent is busy, try again shortly"}), 503, {"Retry-After": "1"}
+    g.has_slot = True
+    return None
+
+@app.teardown_request
+def release_slot(exception=None):
+    if g.get('has_slot'):
+        g.has_slot = False
+        request_slots.release()
+
+# Count what every request sent, per endpoint
+
+@app.after_request
+def record_request(response):
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    stats.observe('request_seconds', time.perf_counter() - g.started, endpoint=endpoint)
+    stats.count('requests_total', endpoint=endpoint, status=response.status_code)
+    if response.content_length:
+        stats.count('bytes_served_total', response.content_length, endpoint=endpoint)
+    # When the response went out by our clock, for clients to trace how old the data is and correct for clock skew
+    response.headers[SERVED_HEADER] = f"{time.time():.6f}"
+    return response
+
+# The newest sample's /metrics body in the given format and its ETag, encoding it the first time it's asked for
+def latest_body(mimetype):
+    with ring_lock:
+        if latest_sample() is None:
+            return None, None
+        bodies = latest_cache["bodies"]
+        if mimetype not in bodies:
+            bodies[mimetype] = encode_sample(latest_cache["data"])
+        return bodies[mimetype], f"{latest_cache['etag']}-{'json' if mimetype == JSON_MIME else 'bin'}"
+
+# Encode a bulk response of columns in the format the client asked for
+def columns_response(columns, rows):
+    body, mimetype, headers = encode_response(columns, rows, request)
+    return Response(body, mimetype=mimetype, headers=headers)
+
+# Define where the metrics are. Send "Accept: application/x-spm-columns" to get the compact binary encoding,
+# and the ETag from the last response in If-None-Match to get an empty 304 until there's a newer sample.
 @app.route('/metrics', methods=['GET'])
 def get_metrics():
     try:
-        # Open the pipe.
-        with open(PIPE_PATH, 'r') as pipe:
-            # Read all available lines and take the last one. This ensures we get the most recent data if the client polls slowly.
-            lines = pipe.readlines()
-            if not lines:
-                return jsonify({"error": "No data available from collector"}), 503
-            latest_line = lines[-1].strip()
-            data = json.loads(latest_line)
-            return jsonify(data)
-    # Account for a missing pipe or an exception being thrown.
+        mimetype = negotiate(request)
+        body, etag = latest_body(mimetype)
+        if body is None:
+            return jsonify({"error": "No data available from collector"}), 503
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers={"ETag": f'"{etag}"', "Vary": "Accept"})
+        return Response(body, mimetype=mimetype, headers={"ETag": f'"{etag}"', "Vary": "Accept", "Cache-Control": "no-cache"})
+    # Account for a missing ring or an exception being thrown.
+    except FileNotFoundError:
+        return jsonify({"error": f"Metrics ring buffer not found at {RING_PATH}"}), 500
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Range of recent samples as columns. Use ?since_seq=N (sequence number) or ?since=T (unix timestamp) to only get newer samples.
+@app.route('/metrics/history', methods=['GET'])
+def get_history():
+    try:
+        limit = min(request.args.get('limit', MAX_HISTORY_SAMPLES, type=int), MAX_HISTORY_SAMPLES)
+        since_seq = request.args.get('since_seq', type=int)
+        since = request.args.get('since', type=float)
+
+        sync_history()
+        if since_seq is not None:
+            columns = history.since_seq(since_seq, limit)
+        else:
+            columns = history.since_time(since if since is not None else 0.0, limit)
+
+        columns["count"] = len(columns["seq"])
+        columns["head"] = history.last_seq
+        columns["oldest"] = history.first_timestamp
+        return columns_response(columns, columns["count"])
+    except FileNotFoundError:
+        return jsonify({"error": f"Metrics ring buffer not found at {RING_PATH}"}), 500
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Long range history from the collector's on-disk store, as columns. ?start=T&end=T are unix timestamps
+# (default: the last 24 hours) and ?resolution= is raw, 1m or 1h (default: the finest that fits the range).
+@app.route('/metrics/archive', methods=['GET'])
+def get_archive():
+    try:
+        end = request.args.get('end', time.time(), type=float)
+        start = request.args.get('start', end - 86400, type=float)
+        resolution = request.args.get('resolution')
+        columns = archive.query(start, end, resolution)
+        columns["rows"] = len(columns["timestamp"])
+        return columns_response(columns, columns["rows"])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# The top processes from the newest sample (if the collector was started with --top), ordered by
+# ?sort=cpu (default), memory or io, with ?limit=N to keep only the first N
+@app.route('/processes', methods=['GET'])
+def get_processes():
+    try:
+        sort = request.args.get('sort', 'cpu')
+        if sort not in RANKINGS:
+            return jsonify({"error": f"Can't sort by {sort}, use one of {', '.join(RANKINGS)}"}), 400
+        data = latest_sample()
+        if data is None:
+            return jsonify({"error": "No data available from collector"}), 503
+        if 'processes' not in data:
+            return jsonify({"error": "The collector isn't listing processes, start it with --top N"}), 404
+        processes = sorted(data['processes'], key=lambda process: process.get(RANKINGS[sort], 0), reverse=True)
+        limit = request.args.get('limit', type=int)
+        return jsonify({"timestamp": data.get("timestamp"), "seq": data.get("seq"), "sort": sort, "processes": processes[:limit]})
     except FileNotFoundError:
-        return jsonify({"error": f"Metrics pipe not found at {PIPE_PATH}"}), 500
+        return jsonify({"error": f"Metrics ring buffer not found at {RING_PATH}"}), 500
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Formatted events for every buffered sample newer than seq, oldest first
+def events_since(seq):
+    events = []
+    with ring_lock:
+        for event in reversed(recent_events):
+            if event[0] <= seq:
+                break
+            events.append(event)
+    events.reverse()
+    return events
+
+# Long-lived server-sent event stream that pushes each sample as soon as the collector publishes it.
+# ?since_seq=N (or the Last-Event-ID header) resumes after sample N, ?interval=S sends at most one sample every S seconds.
+@app.route('/metrics/stream', methods=['GET'])
+def stream_metrics():
+    since_seq = request.args.get('since_seq', type=int)
+    if since_seq is None:
+        since_seq = request.headers.get('Last-Event-ID', type=int)
+    interval = request.args.get('interval', 0.0, type=float)
+    global open_streams
+    with streams_lock:
+        if open_streams >= MAX_STREAMS:
+            stats.count('requests_rejected_total')
+            return jsonify({"error": "Too many open streams, try again later"}), 503, {"Retry-After": "5"}
+        open_streams += 1
+
+    # The server closes the response however it ends, even if the client went before the body was started
+    def release():
+        global open_streams
+        with streams_lock:
+            open_streams -= 1
+
+    try:
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        response = Response(stream_with_context(stream_events(since_seq, interval)), mimetype="text/event-stream", headers=headers)
+    except Exception:
+        release()
+        raise
+    response.call_on_close(release)
+    return response
+
+# The events of one stream, as they come
+def stream_events(since_seq, interval):
+    # Without a resume point, start from the newest sample
+    seq = since_seq
+    if seq is None:
+        seq = (latest_cache["seq"] or 1) - 1
+    last_sent = 0.0
+    while True:
+        with new_sample:
+            new_sample.wait_for(lambda: latest_cache["seq"] is not None and latest_cache["seq"] != seq, timeout=STREAM_KEEPALIVE)
+        # The collector started counting again after rebuilding the ring
+        if latest_cache["seq"] is not None and latest_cache["seq"] < seq:
+            seq = latest_cache["seq"] - 1
+        events = events_since(seq)
+        if not events:
+            yield ": keepalive\n\n"
+            continue
+        for event_seq, timestamp, event in events:
+            seq = event_seq
+            # Skip samples that arrive sooner than the client asked for (with a little slack for jitter)
+            if timestamp - last_sent < interval * 0.9:
+                continue
+            last_sent = timestamp
+            # Each sample goes with when it was sent, in a comment other clients skip, so ours can trace its latency
+            event = f": served {time.time():.6f}\n{event}"
+            stats.count('bytes_served_total', len(event), endpoint='/metrics/stream')
+            yield event
+
+# Every alert rule with its current state, value and threshold, plus the recent firing/resolved transitions
+@app.route('/alerts', methods=['GET'])
+def get_alerts():
+    try:
+        sync_history()
+    except FileNotFoundError:
+        pass # No collector yet, the rules just haven't seen anything
+    with ring_lock:
+        rules = alert_engine.status()
+        events = list(alert_engine.events)
+    return jsonify({"rules": rules, "events": events, "firing": sum(rule["state"] == "firing" for rule in rules)})
+
+# Each metric's anomaly score, with the value it was expected to be near and how far it usually strays
+@app.route('/anomalies', methods=['GET'])
+def get_anomalies():
+    try:
+        sync_history()
+    except FileNotFoundError:
+        pass # No collector yet, nothing has been scored
+    with ring_lock:
+        metrics = anomaly_engine.status()
+    return jsonify({"metrics": metrics, "threshold": ANOMALY_THRESHOLD, "anomalous": [m["metric"] for m in metrics if m["anomalous"]]})
+
+# The agent's and the collector's own footprint and timings. ?format=prometheus gives the Prometheus text format.
+@app.route('/internal/stats', methods=['GET'])
+def get_internal_stats():
+    stats.gauge('history_samples', history.count)
+    stats.gauge('stream_backlog_events', len(recent_events))
+    stats.gauge('open_streams', open_streams)
+    snapshots = {"agent": stats.snapshot(), "collector": read_published(COLLECTOR_STATS_PATH)}
+    if request.args.get('format') == 'prometheus':
+        text = prometheus_text(snapshot for snapshot in snapshots.values() if snapshot)
+        return Response(text, content_type="text/plain; version=0.0.4; charset=utf-8")
+    return jsonify(snapshots)
+
+# waitress runs every request on one of a fixed pool of worker threads, and an open stream holds on to its
+# worker for as long as it's open. So the pool needs a worker for every stream and concurrent request the
+# caps allow, plus a spare few to turn away the rest with a 503 instead of leaving them queued.
+def worker_threads():
+    return MAX_CONCURRENT_REQUESTS + MAX_STREAMS + SPARE_THREADS
+
+# Make the server the agent runs on: waitress if it's installed, otherwise werkzeug's threaded server.
+# Returns the port it's listening on and the function that serves requests until the process ends.
+# threads is the number of waitress workers, at least worker_threads() (the default).
+def create_server(host, port, threads=None):
+    if waitress is not None:
+        threads = max(threads or 0, worker_threads())
+        server = waitress.create_server(app, host=host, port=port, threads=threads)
+        return server.effective_port, server.run
+    server = make_server(host, port, app, threaded=True)
+    return server.server_port, server.serve_forever
+
 if __name__ == '__main__':
-    # This isn't exactly safe for production, for this project, it'll do.
-    app.run(host='0.0.0.0', port=5050)
+    parser = argparse.ArgumentParser(description="Serve the collector's samples to dashboards")
+    parser.add_argument('--host', default='0.0.0.0', help="Address to listen on")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="Port to listen on")
+    parser.add_argument('--threads', type=int, help="Worker threads with waitress (at least --max-concurrent + --max-streams + 2, the default)")
+    parser.add_argument('--max-concurrent', type=int, default=MAX_CONCURRENT_REQUESTS, help="Requests handled at once before answering 503")
+    parser.add_argument('--max-streams', type=int, default=MAX_STREAMS, help="Open /metrics/stream connections allowed")
+    parser.add_argument('--nice', type=int, default=10, help="How much to lower the agent's CPU priority (0 to leave it)")
+    args = parser.parse_args()
+
+    MAX_CONCURRENT_REQUESTS = args.max_concurrent
+    request_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+    MAX_STREAMS = args.max_streams
+    if waitress is not None and args.threads is not None and args.threads < worker_threads():
+        parser.error(f"--threads {args.threads} can't hold --max-concurrent {MAX_CONCURRENT_REQUESTS} requests and --max-streams "
+                     f"{MAX_STREAMS} streams with room to turn the rest away, it needs at least {worker_threads()}")
+    if args.nice:
+        try:
+            os.nice(args.nice) # Let the server's real work win whenever there's contention
+        except OSError as e:
+            print(f"Couldn't lower the agent's priority: {e}")
+    # A log line per request costs more than answering it
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    port, serve = create_server(args.host, args.port, args.threads)
+    print(f"Agent serving on {args.host}:{port} with "
+          f"{f'waitress ({max(args.threads or 0, worker_threads())} threads)' if waitress else 'the threaded werkzeug server'}")
+    serve()
@@ -0,0 +1,196 @@
+import json
+import math
+import os
+import time
+from collections import deque
+
+# Alert rules evaluated by the agent on every sample the collector publishes.
+#
+# A rule compares an aggregate of one metric over a sliding time window against a threshold, e.g.
+# "average cpu_percent over 120 s > 90" or "memory_percent rising faster than 5 per minute over
+# 10 min". Each window keeps just the samples it covers, with a running sum for averages and
+# monotonic queues for min/max, so every sample costs O(1) per rule however long the window is.
+# Averages are weighted by the time each sample covers, so a burst of fast samples from an adaptive
+# collector doesn't outweigh the slow ones around it.
+# Rules go pending as soon as their condition holds and fire once it has held for their "for"
+# time. Rules are read from a JSON file holding a list of objects like:
+#
+#   {"name": "high_cpu", "metric": "cpu_percent", "aggregate": "avg", "window": 120, "op": ">", "threshold": 90}
+#
+# aggregate is one of value (the latest sample), avg, min, max or rate (change per minute), window
+# and for are in seconds, and "per_core": true multiplies the threshold by the number of CPU cores.
+
+DEFAULT_RULES_PATH = '/opt/monitor/alerts.json'
+DEFAULT_RULES = (
+    {"name": "high_cpu", "metric": "cpu_percent", "aggregate": "avg", "window": 120, "op": ">", "threshold": 90,
+     "description": "Average CPU over 90% for 2 minutes"},
+    {"name": "high_memory", "metric": "memory_percent", "aggregate": "avg", "window": 60, "op": ">", "threshold": 90,
+     "description": "Average memory use over 90% for a minute"},
+    {"name": "memory_growth", "metric": "memory_percent", "aggregate": "rate", "window": 600, "op": ">", "threshold": 2,
+     "description": "Memory use growing by more than 2% a minute over 10 minutes"},
+    {"name": "high_load", "metric": "load_avg", "aggregate": "value", "op": ">", "threshold": 1.5, "per_core": True, "for": 60,
+     "description": "Load above 1.5 per core for a minute"},
+)
+OPERATORS = {
+    '>': lambda value, threshold: value > threshold,
+    '>=': lambda value, threshold: value >= threshold,
+    '<': lambda value, threshold: value < threshold,
+    '<=': lambda value, threshold: value <= threshold,
+}
+AGGREGATES = ('value', 'avg', 'min', 'max', 'rate')
+MAX_EVENTS = 200 # Firing/resolved transitions kept for /alerts
+FULL_WINDOW = 0.9 # A window has to span this much of its length before its rule is checked
+
+
+# One metric over a sliding window of time, aggregated incrementally
+class Window:
+
+    def __init__(self, seconds, aggregate):
+        self.seconds = seconds
+        self.aggregate = aggregate
+        self.samples = deque() # (timestamp, value, weight), oldest first
+        self.total = 0.0 # Sum of value x weight
+        self.weight = 0.0
+        self.extremes = deque() # Candidates for the min or max, kept monotonic
+
+    # weight is how many seconds the sample covers
+    def add(self, timestamp, value, weight=1.0):
+        self.samples.append((timestamp, value, weight))
+        self.total += value * weight
+        self.weight += weight
+        if self.aggregate == 'min':
+            while self.extremes and self.extremes[-1][1] >= value:
+                self.extremes.pop()
+            self.extremes.append((timestamp, value))
+        elif self.aggregate == 'max':
+            while self.extremes and self.extremes[-1][1] <= value:
+                self.extremes.pop()
+            self.extremes.append((timestamp, value))
+        # Drop everything that has slid out of the window
+        cutoff = timestamp - self.seconds
+        while self.samples[0][0] < cutoff:
+            _, old, old_weight = self.samples.popleft()
+            self.total -= old * old_weight
+            self.weight -= old_weight
+        while self.extremes and self.extremes[0][0] < cutoff:
+            self.extremes.popleft()
+
+    # The aggregate over the window, or None until the window is (nearly) full
+    def value(self):
+        if not self.samples:
+            return None
+        first_time, first, _ = self.samples[0]
+        last_time, last, _ = self.samples[-1]
+        if self.seconds and last_time - first_time < self.seconds * FULL_WINDOW:
+            return None
+        if self.aggregate == 'value':
+            return last
+        if self.aggregate == 'avg':
+            return self.total / self.weight if self.weight > 0 else last
+        if self.aggregate == 'rate':
+            return (last - first) / (last_time - first_time) * 60 if last_time > first_time else 0.0
+        return self.extremes[0][1]
+
+
+class AlertRule:
+
+    def __init__(self, name, metric, threshold, op='>', aggregate='value', window=0, sustain=0, per_core=False, description=''):
+        if op not in OPERATORS:
+            raise ValueError(f"Rule {name}: unknown operator {op!r}")
+        if aggregate not in AGGREGATES:
+            raise ValueError(f"Rule {name}: unknown aggregate {aggregate!r}")
+        if aggregate != 'value' and window <= 0:
+            raise ValueError(f"Rule {name}: a window is needed for {aggregate}")
+        self.name = name
+        self.metric = metric
+        self.op = op
+        self.threshold = float(threshold) * ((os.cpu_count() or 1) if per_core else 1)
+        self.aggregate = aggregate
+        self.window = Window(window if aggregate != 'value' else 0, aggregate)
+        self.sustain = sustain
+        self.description = description or f"{aggregate} of {metric} {op} {self.threshold:g}"
+        self.state = 'inactive'
+        self.since = None # When the current state started
+        self.value = None
+
+    # Take in one sample. Returns the new state if the rule just fired or resolved.
+    def update(self, timestamp, sample):
+        value = sample.get(self.metric)
+        if not isinstance(value, (int, float)) or math.isnan(value):
+            return None
+        interval = sample.get('interval')
+        self.window.add(timestamp, value, interval if isinstance(interval, (int, float)) and interval > 0 else 1.0)
+        self.value = self.window.value()
+        breached = self.value is not None and OPERATORS[self.op](self.value, self.threshold)
+
+        if not breached:
+            was_firing = self.state == 'firing'
+            if self.state != 'inactive':
+                self.state, self.since = 'inactive', timestamp
+            return 'resolved' if was_firing else None
+        if self.state == 'inactive':
+            self.state, self.since = 'pending', timestamp
+        if self.state == 'pending' and timestamp - self.since >= self.sustain:
+            self.state, self.since = 'firing', timestamp
+            return 'firing'
+        return None
+
+    def status(self):
+        return {
+            "rule": self.name,
+            "metric": self.metric,
+            "state": self.state,
+            "since": self.since,
+            "value": self.value,
+            "threshold": self.threshold,
+            "description": self.description,
+        }
+
+
+class AlertEngine:
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.events = deque(maxlen=MAX_EVENTS)
+
+    # Evaluate every rule against a sample. Returns the pending and firing alerts, for the sample to carry.
+    def evaluate(self, sample):
+        timestamp = sample.get('timestamp') or time.time()
+        active = []
+        for rule in self.rules:
+            change = rule.update(timestamp, sample)
+            if change:
+                self.events.append({"rule": rule.name, "state": change, "time": timestamp, "value": rule.value})
+            if rule.state != 'inactive':
+                active.append({"rule": rule.name, "metric": rule.metric, "state": rule.state})
+        return active
+
+    def status(self):
+        return [rule.status() for rule in self.rules]
+
+
+# Build the rules from a list of dicts as found in the rules file
+def make_rules(definitions):
+    rules = []
+    for definition in definitions:
+        definition = dict(definition)
+        try:
+            name = definition.pop('name')
+            metric = definition.pop('metric')
+            threshold = definition.pop('threshold')
+        except KeyError as e:
+            raise ValueError(f"Alert rule {definition} is missing {e}")
+        definition['sustain'] = definition.pop('for', 0)
+        try:
+            rules.append(AlertRule(name, metric, threshold, **definition))
+        except TypeError as e:
+            raise ValueError(f"Alert rule {name}: {e}")
+    return rules
+
+# Load the rules file, or the default rules if there isn't one
+def load_rules(path=DEFAULT_RULES_PATH):
+    try:
+        with open(path) as f:
+            return make_rules(json.load(f))
+    except FileNotFoundError:
+        return make_rules(DEFAULT_RULES)
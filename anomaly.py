@@ -0,0 +1,126 @@
+import math
+import time
+
+# Anomaly scores worked out by the agent on every sample the collector publishes.
+#
+# Fixed thresholds are wrong for most servers: a database box sitting at 85% CPU all day is fine,
+# a web box jumping from 5% to 40% isn't. So each metric also gets a score for how unusual it is
+# for this server. Each metric keeps an exponentially weighted moving average and variance
+# (EWMA/EWMV) of how far it is from its usual level for this hour of the day, and the score is how
+# many standard deviations the newest sample is from that average (a z-score). The usual level for
+# each hour of the day (the seasonal baseline) comes from the hourly rollups the collector keeps on
+# disk, so a nightly backup isn't flagged every night but the same spike in the afternoon is.
+# Everything is a handful of numbers per metric, so memory is constant and each sample costs O(1).
+
+ANOMALY_METRICS = ('cpu_percent', 'memory_percent', 'load_avg', 'disk_io_bytes', 'net_io_bytes')
+HALF_LIFE = 600.0 # Seconds for a sample's weight in the average and variance to halve
+WARMUP = 300.0 # Seconds of samples before a metric is scored
+THRESHOLD = 4.0 # Scores this far from zero (either way) count as anomalies
+# Smallest standard deviation used for each metric, so a flat-lined metric doesn't score a tiny wiggle as huge
+NOISE_FLOORS = {'cpu_percent': 2.0, 'memory_percent': 1.0, 'load_avg': 0.1, 'disk_io_bytes': 65536, 'net_io_bytes': 65536}
+DEFAULT_NOISE_FLOOR = 1.0
+BASELINE_DAYS = 14 # Days of hourly rollups the seasonal baseline is made from
+MIN_BASELINE_DAYS = 3 # Hours of the day seen fewer times than this are left out of the baseline
+BASELINE_REFRESH = 3600 # Seconds between reloads of the baseline
+DAY = 86400
+
+
+# One metric's running average and variance of its distance from the seasonal baseline
+class Detector:
+
+    def __init__(self, metric):
+        self.metric = metric
+        self.floor = NOISE_FLOORS.get(metric, DEFAULT_NOISE_FLOOR)
+        self.mean = 0.0
+        self.variance = 0.0
+        self.seen = 0.0 # Seconds of samples taken in
+        self.score = None
+        self.expected = None
+
+    # Score a value, then take it into the average. offset is the baseline for this hour of the day
+    # minus the overall baseline, interval how many seconds the sample covers.
+    def update(self, value, offset, interval):
+        residual = value - offset
+        if not self.seen:
+            self.mean = residual
+        deviation = max(math.sqrt(self.variance), self.floor)
+        score = (residual - self.mean) / deviation
+        self.expected = self.mean + offset
+        self.score = score if self.seen >= WARMUP else None
+
+        # Weigh the sample by the time it covers, so faster or slower sampling doesn't change the half-life
+        alpha = 1.0 - math.exp(-interval * math.log(2) / HALF_LIFE)
+        # A spike only moves the average as far as a THRESHOLD deviation would, so one wild sample doesn't
+        # hide the ones after it. A lasting change still becomes the new normal within a few half-lives.
+        difference = max(-THRESHOLD * deviation, min(THRESHOLD * deviation, residual - self.mean))
+        increment = alpha * difference
+        self.mean += increment
+        self.variance = (1.0 - alpha) * (self.variance + difference * increment)
+        self.seen += interval
+        return self.score
+
+    def status(self):
+        return {
+            "metric": self.metric,
+            "score": self.score,
+            "expected": self.expected,
+            "deviation": max(math.sqrt(self.variance), self.floor),
+            "anomalous": self.score is not None and abs(self.score) >= THRESHOLD,
+            "warming_up": self.seen < WARMUP,
+        }
+
+
+class AnomalyEngine:
+
+    # store is the collector's on-disk history (a readonly TimeSeriesStore), for the seasonal baseline. None for no baseline.
+    def __init__(self, store=None, metrics=ANOMALY_METRICS):
+        self.store = store
+        self.detectors = {metric: Detector(metric) for metric in metrics}
+        # Per metric, how far each hour of the day usually is from the metric's overall level (None where unknown)
+        self.offsets = {metric: [None] * 24 for metric in metrics}
+        self.next_baseline = 0.0
+
+    # Work out the seasonal baseline from the hourly rollups on disk
+    def load_baseline(self, now):
+        try:
+            rollups = self.store.query(now - BASELINE_DAYS * DAY, now, resolution='1h')
+        except (OSError, ValueError) as e:
+            print(f"Couldn't read the history for the anomaly baseline: {e}")
+            return
+        hours = [time.localtime(timestamp).tm_hour for timestamp in rollups['timestamp']]
+        for metric, offsets in self.offsets.items():
+            totals = [0.0] * 24
+            counts = [0] * 24
+            for hour, value in zip(hours, rollups.get(f'{metric}_avg', ())):
+                totals[hour] += value
+                counts[hour] += 1
+            known = [totals[hour] / counts[hour] for hour in range(24) if counts[hour] >= MIN_BASELINE_DAYS]
+            overall = sum(known) / len(known) if known else 0.0
+            for hour in range(24):
+                offsets[hour] = totals[hour] / counts[hour] - overall if counts[hour] >= MIN_BASELINE_DAYS else None
+
+    # Score every metric of a sample. Returns the scores (for the metrics past their warmup) and the anomalous metrics.
+    def evaluate(self, sample):
+        timestamp = sample.get('timestamp') or time.time()
+        if self.store is not None and timestamp >= self.next_baseline:
+            self.next_baseline = timestamp + BASELINE_REFRESH
+            self.load_baseline(timestamp)
+        hour = time.localtime(timestamp).tm_hour
+        interval = sample.get('interval')
+        if not isinstance(interval, (int, float)) or interval <= 0:
+            interval = 1.0
+        scores = {}
+        anomalous = []
+        for metric, detector in self.detectors.items():
+            value = sample.get(metric)
+            if not isinstance(value, (int, float)) or math.isnan(value):
+                continue
+            score = detector.update(value, self.offsets[metric][hour] or 0.0, interval)
+            if score is not None:
+                scores[metric] = round(score, 2)
+                if abs(score) >= THRESHOLD:
+                    anomalous.append(metric)
+        return scores, anomalous
+
+    def status(self):
+        return [detector.status() for detector in self.detectors.values()]
@@ -0,0 +1,520 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+from history import COLUMNS
+from wireformat import BINARY_MIME, JSON_MIME, SERVED_HEADER, compact_json, encode_columns, encode_sample
+
+# Benchmark harness for the monitor.
+#
+# Everything runs on this machine against synthetic data, so runs are repeatable and don't need any
+# real servers. The fake agent fleet is a single separate process serving every host from its own
+# port, and the agent under test also runs in its own process, so the clients measuring them don't
+# share a GIL with them. Results are written as JSON; pass an older results file with --compare to
+# see what changed between versions.
+
+BENCHMARKS = ('agent', 'collector', 'ingest', 'graphs', 'startup')
+DEFAULT_OUTPUT = 'bench_results.json'
+WARMUP = 0.5 # Seconds of each load run that aren't counted
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+# p50/p99/max of a list of seconds, in milliseconds
+def latency_summary(seconds):
+    return {
+        "p50_ms": round(percentile(seconds, 0.5) * 1000, 3) if seconds else None,
+        "p99_ms": round(percentile(seconds, 0.99) * 1000, 3) if seconds else None,
+        "max_ms": round(max(seconds) * 1000, 3) if seconds else None,
+    }
+
+
+# One synthetic host. Its samples only depend on its index and the sequence number, so every run sees the same data.
+class FakeHost:
+
+    def __init__(self, index, period):
+        self.index = index
+        self.period = period
+        self.start = time.time()
+        self.cached = (None, None)
+
+    def sample_for(self, seq):
+        rng = random.Random(self.index * 1000003 + seq)
+        wave = math.sin(seq / 30 + self.index)
+        disk_read, disk_write = rng.randint(0, 5 << 20), rng.randint(0, 20 << 20)
+        net_recv, net_sent = rng.randint(0, 10 << 20), rng.randint(0, 10 << 20)
+        return {
+            "timestamp": self.start + seq * self.period,
+            "interval": self.period,
+            "cpu_percent": round(min(100, max(0, 50 + 40 * wave + rng.gauss(0, 5))), 1),
+            "memory_percent": round(60 + 10 * math.sin(seq / 300 + self.index) + rng.random(), 1),
+            "disk_io_bytes": disk_read + disk_write,
+            "net_io_bytes": net_recv + net_sent,
+            "load_avg": round(max(0.0, 2 + 1.5 * wave + rng.random()), 2),
+            "disk_read_bytes": disk_read,
+            "disk_write_bytes": disk_write,
+            "net_recv_bytes": net_recv,
+            "net_sent_bytes": net_sent,
+            "per_cpu": [round(rng.uniform(0, 100), 1) for _ in range(8)],
+            "disks": {"sda": {"read_bytes": disk_read, "write_bytes": disk_write}},
+            "nics": {"eth0": {"recv_bytes": net_recv, "sent_bytes": net_sent}},
+            "seq": seq,
+        }
+
+    def current_seq(self):
+        return int((time.time() - self.start) / self.period) + 1
+
+    # The sample for the current moment, built once per sequence number like the real agent does
+    def latest(self):
+        seq = self.current_seq()
+        if self.cached[0] != seq:
+            self.cached = (seq, self.sample_for(seq))
+        return self.cached[1]
+
+
+class FakeAgentHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, like the real agent
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        path = url.path
+        binary = BINARY_MIME in self.headers.get("Accept", "")
+        if path == "/metrics/stream":
+            self.stream(parse_qs(url.query))
+            return
+        if path == "/metrics":
+            sample = self.server.host.latest()
+            body = encode_sample(sample) if binary else compact_json(sample)
+        elif path in ("/metrics/history", "/metrics/archive"):
+            # Nothing to backfill from a host that was only just made up
+            columns = {name: [] for name in ('seq',) + COLUMNS}
+            columns.update(count=0, head=0, rows=0)
+            body = encode_columns(columns, 0) if binary else compact_json(columns)
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", BINARY_MIME if binary else JSON_MIME)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Push each sample as it's due, in the same server-sent event format as the real agent's stream
+    def stream(self, query):
+        host = self.server.host
+        interval = float(query.get("interval", ["0"])[0])
+        seq = int(query.get("since_seq", [host.current_seq() - 1])[0])
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header(SERVED_HEADER, f"{time.time():.6f}")
+        self.end_headers()
+        last_sent = 0.0
+        try:
+            while True:
+                newest = host.current_seq()
+                for seq in range(max(seq + 1, newest - 600), newest + 1):
+                    sample = host.sample_for(seq)
+                    if sample["timestamp"] - last_sent < interval * 0.9:
+                        continue
+                    last_sent = sample["timestamp"]
+                    self.wfile.write(f": served {time.time():.6f}\nid: {seq}\nevent: sample\n"
+                                     f"data: {compact_json(sample).decode()}\n\n".encode())
+                self.wfile.flush()
+                seq = newest
+                # Sleep until the next sample is due
+                time.sleep(max(0.0, host.start + newest * host.period - time.time()))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+# Child process: serve count fake agents, each on its own port, until told to stop
+def run_fleet(count, period, conn):
+    servers = []
+    for index in range(count):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FakeAgentHandler)
+        server.daemon_threads = True
+        server.host = FakeHost(index, period)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    conn.send([server.server_address[1] for server in servers])
+    conn.recv()
+
+# Child process: the real agent app, fed from a private ring by a synthetic collector
+def run_agent(ring_path, period, conn):
+    import logging
+    from shmring import RingReader, RingWriter
+    import agent
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR) # A log line per request would swamp the output
+
+    agent.ring = RingReader(ring_path) # Read our ring, not a live collector's
+    writer = RingWriter(ring_path)
+    host = FakeHost(0, period)
+
+    def collect():
+        while True:
+            sample = dict(host.latest())
+            del sample["seq"]
+            writer.write(compact_json(sample), sample["timestamp"])
+            time.sleep(period)
+
+    threading.Thread(target=collect, daemon=True).start()
+    # The same server the agent runs in production
+    port, serve = agent.create_server('127.0.0.1', 0)
+    threading.Thread(target=serve, daemon=True).start()
+    conn.send(port)
+    conn.recv()
+    writer.close()
+
+# Client process: request url back to back for duration seconds, returning every latency after the warmup
+def run_client(url, accept, duration):
+    session = requests.Session()
+    session.headers["Accept"] = accept
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    while True:
+        began = time.perf_counter()
+        if began - start > duration:
+            break
+        try:
+            session.get(url, timeout=5).raise_for_status()
+        except requests.exceptions.RequestException:
+            errors += 1
+            continue
+        if began - start > WARMUP:
+            latencies.append(time.perf_counter() - began)
+    return latencies, errors
+
+def start_child(target, *args):
+    context = multiprocessing.get_context('spawn')
+    parent_conn, child_conn = context.Pipe()
+    process = context.Process(target=target, args=args + (child_conn,), daemon=True)
+    process.start()
+    return process, parent_conn, parent_conn.recv()
+
+def stop_child(process, conn):
+    conn.send("stop")
+    process.join(5)
+    if process.is_alive():
+        process.terminate()
+
+
+# Requests/sec and latency of the agent's /metrics with a number of clients hammering it
+def bench_agent(options):
+    ring_dir = tempfile.mkdtemp(prefix='spm-bench-')
+    process, conn, port = start_child(run_agent, os.path.join(ring_dir, 'ring'), 0.1)
+    results = {"clients": options.clients, "duration_s": options.duration}
+    try:
+        time.sleep(0.5) # Let the first samples arrive
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(options.clients) as pool:
+            for name, accept in (("json", JSON_MIME), ("binary", BINARY_MIME)):
+                url = f"http://127.0.0.1:{port}/metrics"
+                runs = pool.starmap(run_client, [(url, accept, options.duration)] * options.clients)
+                latencies = [latency for run, _ in runs for latency in run]
+                results[name] = {
+                    "requests_per_s": round(len(latencies) / max(options.duration - WARMUP, 1e-9), 1),
+                    "errors": sum(errors for _, errors in runs),
+                    **latency_summary(latencies),
+                }
+    finally:
+        stop_child(process, conn)
+        shutil.rmtree(ring_dir, ignore_errors=True)
+    return results
+
+# CPU time the collector spends on each stage of one sample
+def bench_collector(options):
+    from sampler import Sampler
+    from shmring import RingWriter
+    from tsstore import TimeSeriesStore
+    from proctable import ProcessTable, MAX_TOP
+
+    directory = tempfile.mkdtemp(prefix='spm-bench-')
+    ring = RingWriter(os.path.join(directory, 'ring'))
+    store = TimeSeriesStore(os.path.join(directory, 'tsdb'))
+    sampler = Sampler()
+    processes = ProcessTable(MAX_TOP)
+    stages = {"sample": 0.0, "encode": 0.0, "ring_write": 0.0, "store_append": 0.0}
+    scan_time = 0.0
+    count = options.samples
+    try:
+        for _ in range(count):
+            time.sleep(0.001) # Give the counters something to move by
+            began = time.process_time()
+            metrics = sampler.sample()
+            sampled = time.process_time()
+            payload = compact_json(metrics)
+            encoded = time.process_time()
+            ring.write(payload, metrics['timestamp'])
+            written = time.process_time()
+            store.append(metrics)
+            stored = time.process_time()
+            stages["sample"] += sampled - began
+            stages["encode"] += encoded - sampled
+            stages["ring_write"] += written - encoded
+            stages["store_append"] += stored - written
+            # A full process scan on every sample, as with --top before the scans get spaced out
+            processes.scan()
+            scan_time += time.process_time() - stored
+    finally:
+        store.close()
+        ring.close()
+        shutil.rmtree(directory, ignore_errors=True)
+    results = {f"{stage}_us": round(total / count * 1e6, 1) for stage, total in stages.items()}
+    results["total_us"] = round(sum(stages.values()) / count * 1e6, 1)
+    results["samples"] = count
+    # How much of one core the collector takes at its default one sample a second
+    results["cpu_percent_at_1s"] = round(sum(stages.values()) / count * 100, 4)
+    # What --top adds on this machine, with however many processes it's running
+    results["process_scan_us"] = round(scan_time / count * 1e6, 1)
+    results["processes_scanned"] = len(processes.entries)
+    return results
+
+# Samples/sec the dashboard's polling engine takes in from a fleet of fake agents, both with the samples
+# streamed to it (as the dashboard does) and polled for (as with agents from before the stream)
+def bench_ingest(options):
+    from poller import PollingEngine
+
+    results = {}
+    for mode in ("stream", "poll"):
+        results[mode] = {}
+        for count in options.hosts:
+            process, conn, ports = start_child(run_fleet, count, options.poll_interval)
+            engine = PollingEngine(stream=mode == "stream")
+            try:
+                for port in ports:
+                    engine.register(port, f"127.0.0.1:{port}", options.poll_interval)
+                time.sleep(WARMUP)
+                engine.drain()
+                samples = errors = 0
+                drain_times = []
+                start = time.perf_counter()
+                while time.perf_counter() - start < options.duration:
+                    time.sleep(0.1) # The dashboard's pump interval
+                    began = time.perf_counter()
+                    for _, kind, payload in engine.drain():
+                        if kind == "samples":
+                            samples += len(payload)
+                        else:
+                            errors += 1
+                    drain_times.append(time.perf_counter() - began)
+                elapsed = time.perf_counter() - start
+                results[mode][str(count)] = {
+                    "samples_per_s": round(samples / elapsed, 1),
+                    "expected_per_s": round(count / options.poll_interval, 1),
+                    "errors": errors,
+                    "drain": latency_summary(drain_times),
+                }
+            finally:
+                engine.close()
+                stop_child(process, conn)
+    return results
+
+# Time the dashboard takes per refresh as the number of server tabs grows: every tab taking in a sample
+# while one of them is on screen, and the fleet overview redrawing
+def bench_graphs(options):
+    import tkinter as tk
+    try:
+        import multidashboard
+        dashboard = multidashboard.PerformanceDashboard()
+    except tk.TclError as e:
+        return {"skipped": f"No display to draw on: {e}"}
+
+    fake_hosts = []
+    results = {}
+    try:
+        dashboard.geometry("1200x1000")
+        for count in options.hosts:
+            while len(dashboard.tabs) < count:
+                dashboard.add_server_tab()
+                tab = dashboard.tabs[-1]
+                fake = FakeHost(len(fake_hosts), 1.0)
+                fake_hosts.append(fake)
+                tab.server_ip.set(f"bench-host-{fake.index}")
+                tab.monitoring = True # Fed by hand below, not polled
+                for seq in range(1, 301):
+                    tab.append_sample(fake.sample_for(seq))
+
+            def refresh(frame):
+                began = time.perf_counter()
+                for tab, fake in zip(dashboard.tabs, fake_hosts):
+                    tab.handle_results([("samples", [fake.sample_for(300 + frame)])])
+                dashboard.update()
+                return time.perf_counter() - began
+
+            dashboard.notebook.select(dashboard.tabs[0])
+            dashboard.update()
+            tab_frames = [refresh(frame) for frame in range(1, options.frames + 1)]
+
+            dashboard.show_fleet_view()
+            dashboard.update()
+            fleet_frames = []
+            for frame in range(options.frames):
+                refresh(options.frames + frame)
+                began = time.perf_counter()
+                dashboard.fleet.tick()
+                dashboard.update()
+                fleet_frames.append(time.perf_counter() - began)
+            results[str(count)] = {"tab_frame": latency_summary(tab_frames), "fleet_frame": latency_summary(fleet_frames),
+                                   "series_reserved_bytes_per_tab": dashboard.tabs[0].series.nbytes}
+    finally:
+        dashboard.on_closing()
+    return results
+
+# Runs in a fresh interpreter that has just imported multidashboard (taking import_seconds): how long the
+# window takes to come up, and what each tab costs in memory before and after its graphs are built.
+# Prints the results as one line of JSON.
+def startup_child(import_seconds, tabs):
+    import gc
+    import tkinter as tk
+    import psutil
+    import multidashboard
+
+    process = psutil.Process()
+    results = {"import_s": round(import_seconds, 3), "matplotlib_imported_at_start": 'matplotlib' in sys.modules}
+    try:
+        began = time.perf_counter()
+        dashboard = multidashboard.PerformanceDashboard()
+        dashboard.update()
+        results["window_s"] = round(time.perf_counter() - began, 3)
+    except tk.TclError as e:
+        results["skipped"] = f"No display to draw on: {e}"
+        print(json.dumps(results))
+        return
+
+    try:
+        # Tabs are added without being looked at, so only the last one gets its graphs built here
+        before = process.memory_info().rss
+        for _ in range(tabs):
+            dashboard.add_server_tab()
+        dashboard.update()
+        added = process.memory_info().rss
+        results["tabs"] = tabs
+        results["unshown_tab_kb"] = round((added - before) / tabs / 1024, 1)
+
+        # Show each tab once to build its graphs, the first one also imports matplotlib
+        shown = []
+        for tab in dashboard.tabs:
+            began = time.perf_counter()
+            dashboard.notebook.select(tab)
+            dashboard.update()
+            shown.append(time.perf_counter() - began)
+        results["first_graphs_s"] = round(shown[0], 3)
+        results["show_tab"] = latency_summary(shown[1:])
+        built = process.memory_info().rss
+        results["graphs_kb_per_tab"] = round((built - added) / tabs / 1024, 1)
+
+        for tab in dashboard.tabs:
+            tab.release_graphs()
+        gc.collect()
+        results["kb_returned_per_released_tab"] = round((built - process.memory_info().rss) / tabs / 1024, 1)
+    finally:
+        dashboard.on_closing()
+    print(json.dumps(results))
+
+# Cold start and per-tab memory of the dashboard, each measured in a fresh interpreter
+def bench_startup(options):
+    tabs = max(options.hosts)
+    code = ("import time; began = time.perf_counter(); import multidashboard; imported = time.perf_counter() - began; "
+            f"import bench; bench.startup_child(imported, {tabs})")
+    try:
+        run = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, timeout=600,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    except subprocess.TimeoutExpired:
+        return {"error": "Timed out"}
+    try:
+        return json.loads(run.stdout.strip().splitlines()[-1])
+    except (ValueError, IndexError):
+        return {"error": (run.stderr.strip().splitlines() or ["No output"])[-1]}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+# Every number in a results file, keyed by its dotted path
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+def compare(old, new):
+    old_flat = flatten({name: old.get(name, {}) for name in BENCHMARKS})
+    new_flat = flatten({name: new.get(name, {}) for name in BENCHMARKS})
+    print(f"Compared with {old.get('meta', {}).get('commit') or 'previous run'}:")
+    for key, value in new_flat.items():
+        if key not in old_flat:
+            continue
+        before = old_flat[key]
+        change = f"{(value - before) / before * 100:+.1f}%" if before else "n/a"
+        print(f"  {key}: {before} -> {value} ({change})")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the monitor against a simulated fleet")
+    parser.add_argument('--only', default=','.join(BENCHMARKS), help=f"Comma separated benchmarks to run ({', '.join(BENCHMARKS)})")
+    parser.add_argument('--hosts', default='1,10,100', help="Comma separated fleet sizes for the ingest and graphs benchmarks")
+    parser.add_argument('--duration', type=float, default=5.0, help="Seconds each load run lasts")
+    parser.add_argument('--clients', type=int, default=4, help="Client processes hammering the agent")
+    parser.add_argument('--samples', type=int, default=500, help="Samples taken for the collector benchmark")
+    parser.add_argument('--frames', type=int, default=50, help="Refreshes timed for the graphs benchmark")
+    parser.add_argument('--poll-interval', type=float, default=0.5, help="Seconds between polls of each fake host")
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help="File to write the results to")
+    parser.add_argument('--compare', help="Earlier results file to compare against")
+    options = parser.parse_args()
+    options.hosts = [int(count) for count in options.hosts.split(',') if count]
+
+    results = {"meta": {
+        "commit": git_commit(),
+        "time": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "options": {key: value for key, value in vars(options).items() if key not in ('output', 'compare')},
+    }}
+    runners = {"agent": bench_agent, "collector": bench_collector, "ingest": bench_ingest, "graphs": bench_graphs,
+               "startup": bench_startup}
+    for name in options.only.split(','):
+        if name not in runners:
+            parser.error(f"Unknown benchmark {name!r}")
+        print(f"Running the {name} benchmark...")
+        results[name] = runners[name](options)
+        print(json.dumps(results[name], indent=2))
+
+    with open(options.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {options.output}")
+
+    if options.compare:
+        with open(options.compare) as f:
+            compare(json.load(f), results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+import json
+import math
+import os
+import struct
+import time
+from array import array
+
+import numpy as np
+
+from history import COLUMNS as METRIC_COLUMNS
+
+# Session capture files: every sample received for every host, kept for replay after the fact.
+#
+# A capture is one append-only file. A fixed-size header holds the column names and the list of
+# hosts seen so far, then every sample follows as one fixed-width record of little-endian doubles:
+# when it was received, which host it came from, its sequence number, then the scalar metrics the
+# agent's history keeps. Opening a capture maps the file and views the records as a 2-D NumPy
+# array, so an hours-long, many-host capture opens instantly and each column is read straight out
+# of the mapping with nothing parsed. Records are in the order they were received, so the received
+# column only ever goes up and seeking to any point in time is a binary search.
+
+MAGIC = b'SPMR'
+VERSION = 1
+HEADER = struct.Struct('<4sBII') # magic, version, header size, length of the JSON that follows
+HEADER_SIZE = 65536 # Room for the column names and thousands of host names
+COLUMNS = ('received', 'host', 'seq') + METRIC_COLUMNS
+FLUSH_INTERVAL = 1.0 # Seconds samples are buffered before they're written out
+
+
+class CaptureWriter:
+
+    # Start a capture at path, or carry on with the one already there
+    def __init__(self, path):
+        self.path = path
+        self.hosts = []
+        self.last_received = -math.inf
+        if os.path.exists(path) and os.path.getsize(path) >= HEADER_SIZE:
+            info = read_header(path)
+            if tuple(info["columns"]) != COLUMNS:
+                raise ValueError(f"{path} was recorded with different columns, record to a new file")
+            self.hosts = info["hosts"]
+            self.file = open(path, 'r+b')
+            # Drop any half-written record left by a crash so the records stay aligned
+            size = os.path.getsize(path)
+            record_size = len(COLUMNS) * 8
+            end = HEADER_SIZE + (size - HEADER_SIZE) // record_size * record_size
+            self.file.truncate(end)
+            if end > HEADER_SIZE:
+                self.file.seek(end - record_size)
+                self.last_received = array('d', self.file.read(8))[0]
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.file = open(path, 'w+b')
+            self.write_header()
+            self.file.seek(HEADER_SIZE)
+        self.host_index = {host: i for i, host in enumerate(self.hosts)}
+        self.pending = array('d')
+        self.last_flush = time.monotonic()
+
+    def write_header(self):
+        info = json.dumps({"columns": COLUMNS, "hosts": self.hosts}, separators=(',', ':')).encode()
+        if HEADER.size + len(info) > HEADER_SIZE:
+            raise ValueError(f"Too many hosts for one capture file ({len(self.hosts)})")
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, VERSION, HEADER_SIZE, len(info)) + info)
+        self.file.write(b'\0' * (HEADER_SIZE - HEADER.size - len(info)))
+
+    # Record one sample from a host, received at the given time (now if not given). Samples from different hosts
+    # come in on different threads and are written a tab at a time, so a sample stamped before the last one
+    # written is recorded as received along with it, keeping the received column in order for seeking.
+    def write(self, host, sample, received=None):
+        index = self.host_index.get(host)
+        if index is None:
+            index = self.host_index[host] = len(self.hosts)
+            self.hosts.append(host)
+            self.flush()
+            self.write_header()
+            self.file.seek(0, os.SEEK_END)
+        self.last_received = max(self.last_received, time.time() if received is None else received)
+        self.pending.append(self.last_received)
+        self.pending.append(index)
+        self.pending.append(sample.get('seq') or 0)
+        for name in METRIC_COLUMNS:
+            value = sample.get(name)
+            self.pending.append(float('nan') if value is None else value)
+        if time.monotonic() - self.last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.pending.tofile(self.file)
+            self.pending = array('d')
+        self.file.flush()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+# The column names and hosts from a capture's header
+def read_header(path):
+    with open(path, 'rb') as f:
+        raw = f.read(HEADER_SIZE)
+    magic, version, header_size, length = HEADER.unpack_from(raw, 0)
+    if magic != MAGIC or version != VERSION or header_size != HEADER_SIZE:
+        raise ValueError(f"{path} isn't a metrics capture")
+    return json.loads(raw[HEADER.size:HEADER.size + length])
+
+
+class CaptureReader:
+
+    def __init__(self, path):
+        info = read_header(path)
+        self.columns = tuple(info["columns"])
+        self.hosts = info["hosts"]
+        self.index = {name: i for i, name in enumerate(self.columns)}
+        count = (os.path.getsize(path) - HEADER_SIZE) // (len(self.columns) * 8)
+        if count:
+            self.records = np.memmap(path, dtype='<f8', mode='r', offset=HEADER_SIZE, shape=(count, len(self.columns)))
+        else:
+            self.records = np.empty((0, len(self.columns)))
+
+    def __len__(self):
+        return len(self.records)
+
+    # A view of one column, in the order the samples were received
+    def column(self, name):
+        return self.records[:, self.index[name]]
+
+    # When the capture starts and ends, by the time samples were received
+    def span(self):
+        if not len(self.records):
+            return 0.0, 0.0
+        return float(self.records[0, 0]), float(self.records[-1, 0])
+
+    # Position of the first record received after the given time
+    def position(self, received):
+        return int(np.searchsorted(self.column('received'), received, side='right'))
+
+    # Records [first, last) as (host, sample dict) pairs, the way they'd have come off the wire
+    def samples(self, first, last):
+        names = self.columns[3:]
+        result = []
+        for row in self.records[first:last].tolist():
+            sample = dict(zip(names, row[3:]))
+            sample['seq'] = int(row[2])
+            result.append((self.hosts[int(row[1])], sample))
+        return result
+
+    # Records [first, last) of each host as columns, for filling a graph in one go
+    def host_columns(self, first, last):
+        block = self.records[first:last]
+        hosts = block[:, 1]
+        result = {}
+        for index in np.unique(hosts).astype(int):
+            rows = block[hosts == index]
+            result[self.hosts[index]] = {name: rows[:, i] for i, name in enumerate(self.columns)}
+        return result
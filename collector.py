@@ -1,74 +1,154 @@
-import psutil
+import argparse
 import json
 import time
-import os
 import atexit
 
-# Define pipe and define usage of psutil
-PIPE_PATH = '/tmp/metrics_pipe'
-last_disk_io = psutil.disk_io_counters()
-last_net_io = psutil.net_io_counters()
+from shmring import RingWriter, RING_PATH
+from sampler import AdaptivePeriod, Sampler, MIN_PERIOD
+from tsstore import TimeSeriesStore, DEFAULT_STORE_DIR
+from selfstats import Stats, COLLECTOR_STATS_PATH, COLLECTOR_STATS_INTERVAL
+from proctable import ProcessTable, MAX_TOP
+from alerts import DEFAULT_RULES_PATH, load_rules
 
-# Function to clean up pipe on exit
+# The parts of a sample that can be left out when it's too big for a ring slot, in the order they go
+OPTIONAL_FIELDS = ('processes', 'nics', 'disks', 'per_cpu')
+
+# How often to take a sample, in seconds (can go down to 0.1)
+parser = argparse.ArgumentParser(description="Collect system metrics and publish them for agent.py")
+parser.add_argument('--period', type=float, default=1.0, help=f"Seconds between samples (minimum {MIN_PERIOD})")
+parser.add_argument('--adaptive', action='store_true', help="Sample faster while metrics are busy and slower while they're flat")
+parser.add_argument('--fastest', type=float, default=0.25, help=f"Shortest period with --adaptive (minimum {MIN_PERIOD})")
+parser.add_argument('--slowest', type=float, default=10.0, help="Longest period with --adaptive")
+parser.add_argument('--store', default=DEFAULT_STORE_DIR, help="Directory to keep the on-disk history in")
+parser.add_argument('--no-store', action='store_true', help="Don't keep any history on disk")
+parser.add_argument('--top', type=int, default=0, help=f"Also list the top N processes by CPU, memory and IO (up to {MAX_TOP}, 0 for none)")
+parser.add_argument('--top-interval', type=float, default=0.0, help="Least seconds between process scans (they're also spaced out if they get slow)")
+args = parser.parse_args()
+period = max(MIN_PERIOD, args.period)
+
+# Attach to the ring (this creates it if it doesn't exist, or picks up where the last run left off)
+ring = RingWriter(RING_PATH)
+
+# Open the on-disk store. Monitoring carries on without it if the directory can't be used.
+store = None
+if not args.no_store:
+    try:
+        store = TimeSeriesStore(args.store)
+    except OSError as e:
+        print(f"Couldn't open the history store at {args.store}, history won't be kept: {e}")
+
+# The collector's own counters, published next to the ring for the agent to serve on /internal/stats
+stats = Stats('collector')
+stats.gauge('period_seconds', period)
+
+# Adaptive sampling watches the same alert thresholds the agent checks
+adaptive = None
+if args.adaptive:
+    try:
+        rules = load_rules(DEFAULT_RULES_PATH)
+    except ValueError as e:
+        print(f"Couldn't load the alert rules from {DEFAULT_RULES_PATH}, only watching for sharp changes: {e}")
+        rules = []
+    adaptive = AdaptivePeriod(period, max(MIN_PERIOD, args.fastest), args.slowest, rules)
+
+# The process table, if top processes were asked for
+processes = ProcessTable(args.top, args.top_interval) if args.top > 0 else None
+next_publish = time.monotonic()
+
+# Function to clean up on exit
 def cleanup():
-    # Remove the pipe on exit.
-    print("Collector shutting down. Cleaning up pipe.")
-    if os.path.exists(PIPE_PATH):
-        os.remove(PIPE_PATH)
+    # The ring file is left in place so the agent keeps serving the last samples and
+    # sequence numbers carry on from where they were when the collector comes back.
+    print("Collector shutting down. Detaching from ring buffer.")
+    ring.close()
+    if store:
+        store.close()
 
 # Setup the cleanup to fire when the program exits
 atexit.register(cleanup)
 
-# Create the named pipe if it doesn't exist
-if not os.path.exists(PIPE_PATH):
-    os.mkfifo(PIPE_PATH)
-    # Set permissions to be world-writable
-    os.chmod(PIPE_PATH, 0o666)
-
 # Log the start of the collector
-print(f"Collector started. Writing to pipe: {PIPE_PATH}")
+print(f"Collector started. Sampling every {period}s, writing to ring buffer: {RING_PATH} (epoch {ring.epoch})")
+if adaptive:
+    print(f"Adapting the period between {adaptive.fastest}s and {adaptive.slowest}s to how busy the metrics are")
+if processes:
+    print(f"Listing the top {processes.top} processes by CPU, memory and IO")
 
-# Run the collection of metrics
+# Run the collection of metrics. Ticks are scheduled against the monotonic clock so the loop doesn't
+# drift by however long each sample took, and the sampler divides every counter by the real time elapsed.
+sampler = Sampler()
+next_tick = time.monotonic() + period
 while True:
     try:
-        # 1. CPU Usage
-        cpu_percent = psutil.cpu_percent(interval=1)
-
-        # 2. Memory Usage
-        memory_info = psutil.virtual_memory()
-        memory_percent = memory_info.percent
-
-        # 3. Disk I/O
-        current_disk_io = psutil.disk_io_counters()
-        disk_io_bytes = (current_disk_io.read_bytes - last_disk_io.read_bytes) + \
-                        (current_disk_io.write_bytes - last_disk_io.write_bytes)
-        last_disk_io = current_disk_io
-
-        # 4. Network I/O
-        current_net_io = psutil.net_io_counters()
-        net_io_bytes = (current_net_io.bytes_sent - last_net_io.bytes_sent) + \
-                       (current_net_io.bytes_recv - last_net_io.bytes_recv)
-        last_net_io = current_net_io
-        # 5. System Load Average
-        load_avg = psutil.getloadavg()[0] # 1-minute average
-
-        # Format the data for flask
-        metrics = {
-            'timestamp': time.time(),
-            'cpu_percent': cpu_percent,
-            'memory_percent': memory_percent,
-            'disk_io_bytes': disk_io_bytes,
-            'net_io_bytes': net_io_bytes,
-            'load_avg': load_avg
-        }
-        # Convert to JSON
-        metrics_json = json.dumps(metrics) + '\n' # Add newline as delimiter
-
-        # Open the pipe, in non-blocking write mode to avoid waiting for it to be read
-        with open(PIPE_PATH, 'w') as pipe:
-            pipe.write(metrics_json)
+        delay = next_tick - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        started = time.monotonic()
+        # How late we woke up for this tick
+        stats.observe('tick_jitter_seconds', max(0.0, started - next_tick))
+        next_tick += period
+        # If we fell more than a whole period behind (suspend, overloaded host) start counting again from now
+        if next_tick < started:
+            stats.count('samples_dropped_total', int((started - next_tick) // period) + 1)
+            next_tick = started + period
+
+        metrics = sampler.sample()
+        if processes:
+            scans = processes.next_scan
+            metrics['processes'] = processes.latest()
+            if processes.next_scan != scans:
+                stats.observe('process_scan_seconds', processes.last_cost)
+                stats.gauge('processes_tracked', len(processes.entries))
+        sampled = time.monotonic()
+        stats.observe('sample_seconds', sampled - started)
+
+        # Pick the time to the next sample from this one. Every sample says how long it really covers in "interval".
+        if adaptive:
+            new_period = adaptive.update(metrics, started)
+            if new_period != period:
+                if new_period < period:
+                    stats.count('sampling_speedups_total')
+                next_tick += new_period - period
+                period = new_period
+                stats.gauge('period_seconds', period)
+
+        # Convert to JSON and publish it. This never waits on a reader, it just overwrites the oldest slot.
+        # "published" is when it went out, so clients can tell a slow collector from a slow network.
+        metrics['published'] = time.time()
+        metrics_json = json.dumps(metrics, separators=(',', ':')).encode()
+        # If a sample outgrows its slot the details go, the process list first, until it fits
+        for field in OPTIONAL_FIELDS:
+            if len(metrics_json) <= ring.max_payload:
+                break
+            if field in metrics:
+                del metrics[field]
+                stats.count(f'{field}_dropped_total')
+                metrics_json = json.dumps(metrics, separators=(',', ':')).encode()
+        ring.write(metrics_json, metrics['timestamp'])
+        published = time.monotonic()
+        stats.observe('ring_write_seconds', published - sampled)
+        stats.count('samples_total')
+        stats.count('bytes_published_total', len(metrics_json))
+
+        # Keep it on disk too. A problem with the store shouldn't stop the live samples.
+        if store:
+            try:
+                store.append(metrics)
+            except OSError as e:
+                stats.count('store_errors_total')
+                print(f"An error occurred writing to the history store: {e}")
+            stats.observe('store_append_seconds', time.monotonic() - published)
+
+        stats.observe('loop_seconds', time.monotonic() - started)
+        if published >= next_publish:
+            next_publish = published + COLLECTOR_STATS_INTERVAL
+            try:
+                stats.publish(COLLECTOR_STATS_PATH)
+            except OSError as e:
+                print(f"Couldn't publish the collector's stats: {e}")
 
     # Account for exceptions in the program
     except Exception as e:
+        stats.count('errors_total')
         print(f"An error occurred in the collector: {e}")
         time.sleep(5) # Wait before retrying
@@ -0,0 +1,68 @@
+import numpy as np
+
+# Largest-Triangle-Three-Buckets downsampling for the dashboard graphs.
+#
+# Picks `threshold` points out of a series so the line keeps its visual shape (peaks and dips
+# survive, unlike plain striding or averaging). Graphs ask for about one point per pixel of width,
+# so drawing a day of samples costs the same as drawing a few minutes. Gaps in a series (NaN values)
+# are kept as gaps, and each stretch between them is downsampled on its own, since a NaN would
+# otherwise poison the triangle areas of the bucket after it and lose its peaks.
+
+def lttb(x, y, threshold):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    missing = np.isnan(y)
+    if threshold >= len(y) or not missing.any():
+        return lttb_run(x, y, threshold)
+
+    # Where each run of real values starts and ends, [start, end)
+    change = np.diff(np.concatenate(([True], missing, [True])).astype(np.int8))
+    starts = np.flatnonzero(change == -1)
+    ends = np.flatnonzero(change == 1)
+    valid = len(y) - int(np.count_nonzero(missing))
+    xs, ys = [], []
+    for start, end in zip(starts, ends):
+        if xs:
+            # The NaN just before the run, so the line still breaks there
+            xs.append(x[start - 1:start])
+            ys.append(y[start - 1:start])
+        # Every run gets its share of the points
+        run_x, run_y = lttb_run(x[start:end], y[start:end], max(3, round(threshold * (end - start) / valid)))
+        xs.append(run_x)
+        ys.append(run_y)
+    if not xs:
+        return x[:0].copy(), y[:0].copy()
+    return np.concatenate(xs), np.concatenate(ys)
+
+# LTTB over a series with no gaps in it
+def lttb_run(x, y, threshold):
+    count = len(x)
+    # Always hand back copies, the inputs are often views straight into a live buffer
+    if threshold >= count or threshold < 3:
+        return np.array(x, dtype=float), np.array(y, dtype=float)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    # First and last points are always kept, everything in between is split into threshold - 2 buckets
+    edges = (np.arange(threshold - 1) * ((count - 2) / (threshold - 2))).astype(np.int64) + 1
+    edges[-1] = count - 1
+
+    # The average point of every bucket, worked out in one go
+    sizes = np.diff(edges)
+    avg_x = np.add.reduceat(x[:-1], edges[:-1]) / sizes
+    avg_y = np.add.reduceat(y[:-1], edges[:-1]) / sizes
+    # The last bucket is compared against the final point instead of a next bucket
+    avg_x = np.append(avg_x[1:], x[-1])
+    avg_y = np.append(avg_y[1:], y[-1])
+
+    picked = np.empty(threshold, dtype=np.int64)
+    picked[0] = 0
+    picked[-1] = count - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        # Keep the point that makes the biggest triangle with the last kept point and the next bucket's average
+        area = np.abs((x[a] - avg_x[i]) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y[i] - y[a]))
+        a = start + int(np.argmax(area))
+        picked[i + 1] = a
+    return x[picked], y[picked]
@@ -0,0 +1,205 @@
+import time
+import tkinter as tk
+
+import numpy as np
+from matplotlib import colormaps
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.colors import LogNorm, Normalize
+from matplotlib.figure import Figure
+
+# Fleet overview: every monitored server on one screen.
+#
+# Each metric is a single heatmap image with one row per server and one column per tick, backed by
+# one NumPy array for the whole fleet. A tick slides the window along by one column with a single
+# array copy, and a redraw is five set_data calls and a blit, however many servers there are.
+
+FLEET_COLUMNS = 60 # Ticks of history shown per server
+FLEET_INTERVAL = 1000 # Milliseconds between ticks
+MAX_LABELLED_HOSTS = 40 # Past this the rows are too thin to label
+
+# Sample key, graph title, colour map and scale of each metric, plus the ServerTab threshold it is checked against
+FLEET_METRICS = (
+    ('cpu_percent', "CPU (%)", 'viridis', Normalize(0, 100), 'cpu_threshold'),
+    ('memory_percent', "Memory (%)", 'viridis', Normalize(0, 100), 'mem_threshold'),
+    ('load_avg', "Load", 'magma', Normalize(0, 4), 'load_threshold'),
+    ('disk_io_bytes', "Disk I/O", 'cividis', LogNorm(1024, 1e9, clip=True), None),
+    ('net_io_bytes', "Network I/O", 'cividis', LogNorm(1024, 1e9, clip=True), None),
+)
+
+
+# Read a Tk variable that might hold something that isn't a number yet
+def read_var(var, default):
+    try:
+        return var.get()
+    except tk.TclError:
+        return default
+
+
+class FleetView(tk.Frame):
+
+    def __init__(self, parent, dashboard, *args, **kwargs):
+        super().__init__(parent, *args, **kwargs)
+        self.dashboard = dashboard
+        self.configure(bg="#2E2E2E")
+
+        # One row per server tab, one plane per metric
+        self.hosts = []
+        self.rows = {}
+        self.names = ()
+        self.values = np.full((len(FLEET_METRICS), 0, FLEET_COLUMNS), np.nan)
+        self.latest = np.full((len(FLEET_METRICS), 0), np.nan)
+        self.thresholds = {}
+
+        self.info_label = tk.Label(self, text="No servers yet.", bg=self["bg"], fg="#FFFFFF", anchor="w")
+        self.info_label.pack(side="top", fill="x", padx=10, pady=(5, 0))
+
+        self.setup_graphs()
+        self.tick_job_id = self.after(FLEET_INTERVAL, self.tick)
+
+    def setup_graphs(self):
+        self.fig = Figure(figsize=(8, 10), facecolor="#2E2E2E")
+        self.fig.subplots_adjust(wspace=0.1, left=0.15, right=0.98, top=0.95, bottom=0.03)
+        self.axes = self.fig.subplots(1, len(FLEET_METRICS), sharey=True)
+
+        self.images = []
+        self.markers = []
+        for ax, (_, title, cmap_name, norm, threshold) in zip(self.axes, FLEET_METRICS):
+            cmap = colormaps[cmap_name].copy()
+            cmap.set_bad('#3C3C3C') # No data
+            ax.set_title(title, fontsize=9, color="#FFFFFF")
+            ax.set_facecolor('#3C3C3C')
+            ax.set_xticks([])
+            ax.tick_params(axis='y', labelsize=7, colors="#FFFFFF")
+            image = ax.imshow(np.full((1, FLEET_COLUMNS), np.nan), cmap=cmap, norm=norm, aspect='auto',
+                              interpolation='nearest', extent=(0, FLEET_COLUMNS, 1, 0), animated=True)
+            # Leave a margin on the right for the threshold markers (this also stops the images resetting the limits)
+            ax.set_xlim(0, FLEET_COLUMNS + 2)
+            self.images.append(image)
+            # Servers whose latest value is over their threshold get a marker at the end of their row
+            self.markers.append(ax.scatter([], [], marker='<', color='red', s=14, animated=True) if threshold else None)
+
+        self.background = None
+        self.layout_dirty = True
+        self.canvas = FigureCanvasTkAgg(self.fig, master=self)
+        self.canvas.get_tk_widget().pack(fill="both", expand=True)
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        # Click a row to jump to that server's tab
+        self.canvas.mpl_connect('button_press_event', self.on_click)
+        # Catch up straight away when the tab is selected
+        self.bind("<Map>", lambda event: self.redraw())
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_animated()
+
+    def draw_animated(self):
+        for ax, image, markers in zip(self.axes, self.images, self.markers):
+            ax.draw_artist(image)
+            if markers is not None:
+                ax.draw_artist(markers)
+
+    def on_click(self, event):
+        if event.ydata is None:
+            return
+        row = int(event.ydata)
+        if 0 <= row < len(self.hosts):
+            self.dashboard.notebook.select(self.hosts[row])
+
+    # Take the newest values of every server from its tab's own series, so nothing is kept twice
+    def read_latest(self):
+        for row, tab in enumerate(self.hosts):
+            if not tab.monitoring:
+                self.latest[:, row] = np.nan # Servers that aren't being monitored show as gaps
+                continue
+            for i, (key, _, _, _, _) in enumerate(FLEET_METRICS):
+                self.latest[i, row] = tab.series.latest(key)
+        # A log scale would show idle as missing
+        for i, (_, _, _, norm, _) in enumerate(FLEET_METRICS):
+            if isinstance(norm, LogNorm):
+                np.fmax(self.latest[i], 1.0, out=self.latest[i], where=~np.isnan(self.latest[i]))
+
+    # Match the rows up with the dashboard's tabs, keeping the history of servers that are still there
+    def sync_hosts(self):
+        tabs = list(self.dashboard.tabs)
+        names = tuple(read_var(tab.server_ip, "") or f"Server {i + 1}" for i, tab in enumerate(tabs))
+        if tabs == self.hosts and names == self.names:
+            return
+
+        if tabs != self.hosts:
+            values = np.full((len(FLEET_METRICS), len(tabs), FLEET_COLUMNS), np.nan)
+            latest = np.full((len(FLEET_METRICS), len(tabs)), np.nan)
+            for row, tab in enumerate(tabs):
+                old_row = self.rows.get(tab)
+                if old_row is not None:
+                    values[:, row] = self.values[:, old_row]
+                    latest[:, row] = self.latest[:, old_row]
+            self.values, self.latest = values, latest
+            self.hosts = tabs
+            self.rows = {tab: row for row, tab in enumerate(tabs)}
+
+        self.names = names
+        count = max(1, len(tabs))
+        for ax, image in zip(self.axes, self.images):
+            image.set_extent((0, FLEET_COLUMNS, count, 0))
+            ax.set_xlim(0, FLEET_COLUMNS + 2)
+        ax = self.axes[0]
+        ax.set_ylim(count, 0)
+        if len(tabs) <= MAX_LABELLED_HOSTS:
+            ax.set_yticks(np.arange(len(tabs)) + 0.5, labels=names)
+        else:
+            ax.set_yticks([])
+        self.layout_dirty = True
+
+    def tick(self):
+        self.tick_job_id = self.after(FLEET_INTERVAL, self.tick)
+        self.sync_hosts()
+        self.read_latest()
+        # Slide the window along one column and add the newest values
+        self.values[:, :, :-1] = self.values[:, :, 1:]
+        self.values[:, :, -1] = self.latest
+
+        if self.winfo_ismapped():
+            self.redraw()
+
+    def redraw(self):
+        count = len(self.hosts)
+        if count == 0:
+            self.info_label.config(text="No servers yet. Add a server tab to see it here.")
+            return
+        for _, _, _, _, threshold in FLEET_METRICS:
+            if threshold:
+                self.thresholds[threshold] = np.array([read_var(getattr(tab, threshold), np.inf) for tab in self.hosts], dtype=float)
+
+        start = time.perf_counter()
+        relayout = self.layout_dirty or self.background is None
+        self.layout_dirty = False
+
+        for i, (_, _, _, norm, threshold) in enumerate(FLEET_METRICS):
+            self.images[i].set_data(self.values[i])
+            if threshold:
+                # Highlight every server whose latest value is over its own threshold
+                over = np.flatnonzero(self.latest[i] > self.thresholds[threshold])
+                self.markers[i].set_offsets(np.column_stack([np.full(len(over), FLEET_COLUMNS + 1.0), over + 0.5]))
+                if threshold == 'load_threshold':
+                    # Scale the load colours to the thresholds in use
+                    top = max(1.0, float(np.max(self.thresholds[threshold], initial=0, where=np.isfinite(self.thresholds[threshold]))) * 2)
+                    if top != norm.vmax:
+                        norm.vmax = top
+                        relayout = True
+
+        if relayout:
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.draw_animated()
+            self.canvas.blit(self.fig.bbox)
+
+        over_count = sum(len(markers.get_offsets()) for markers in self.markers if markers is not None)
+        stale_count = sum(tab.stale for tab in self.hosts)
+        elapsed = (time.perf_counter() - start) * 1000
+        self.info_label.config(text=f"{count} servers, {over_count} threshold breaches, {stale_count} with stale data. Redraw took {elapsed:.1f} ms.")
+
+    def stop(self):
+        if self.tick_job_id:
+            self.after_cancel(self.tick_job_id)
+            self.tick_job_id = None
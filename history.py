@@ -0,0 +1,99 @@
+import threading
+from array import array
+
+# Bounded, columnar in-memory history of collector samples.
+#
+# Each metric lives in its own fixed-size array of doubles (plus one array of sequence numbers),
+# used as a ring. An hour of 1 second samples is only a couple of hundred kilobytes, and range
+# queries binary search the ring instead of walking Python objects.
+
+# The scalar metrics every sample carries, in column order
+COLUMNS = ('timestamp', 'interval', 'cpu_percent', 'memory_percent', 'disk_io_bytes', 'net_io_bytes', 'load_avg',
+           'disk_read_bytes', 'disk_write_bytes', 'net_recv_bytes', 'net_sent_bytes')
+DEFAULT_CAPACITY = 3600 # One hour at 1 second resolution
+
+
+class MetricHistory:
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, columns=COLUMNS):
+        self.capacity = capacity
+        self.columns = columns
+        self.seq = array('q', [0] * capacity)
+        self.data = {name: array('d', [0.0] * capacity) for name in columns}
+        self.start = 0 # Index of the oldest sample in the ring
+        self.count = 0
+        self.lock = threading.Lock()
+
+    # Sequence number of the newest sample held, or 0 if empty
+    @property
+    def last_seq(self):
+        with self.lock:
+            if not self.count:
+                return 0
+            return self.seq[(self.start + self.count - 1) % self.capacity]
+
+    # Timestamp of the oldest sample held, or None if empty. How far back the history reaches depends on
+    # how often the collector samples, so clients ask rather than assume it's an hour.
+    @property
+    def first_timestamp(self):
+        with self.lock:
+            return self.data['timestamp'][self.start] if self.count else None
+
+    def clear(self):
+        with self.lock:
+            self.start = 0
+            self.count = 0
+
+    # Add a sample (a dict of metric values), overwriting the oldest one once full
+    def append(self, seq, sample):
+        with self.lock:
+            if self.count < self.capacity:
+                index = (self.start + self.count) % self.capacity
+                self.count += 1
+            else:
+                index = self.start
+                self.start = (self.start + 1) % self.capacity
+            self.seq[index] = seq
+            for name in self.columns:
+                value = sample.get(name)
+                self.data[name][index] = float(value) if value is not None else float('nan')
+
+    # Logical position (0 = oldest) of the first sample whose key is greater than value
+    def _first_after(self, column, value):
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if column[(self.start + mid) % self.capacity] > value:
+                high = mid
+            else:
+                low = mid + 1
+        return low
+
+    # Copy logical positions [first, count) out of the ring, chronologically, as plain lists
+    def _slice(self, first, limit):
+        last = self.count if limit is None else min(self.count, first + limit)
+        result = {'seq': [], **{name: [] for name in self.columns}}
+        if first >= last:
+            return result
+        begin = (self.start + first) % self.capacity
+        end = (self.start + last) % self.capacity
+        # The requested range either sits in one piece or wraps past the end of the arrays
+        if begin < end:
+            spans = [(begin, end)]
+        else:
+            spans = [(begin, self.capacity), (0, end)]
+        for low, high in spans:
+            result['seq'].extend(self.seq[low:high])
+            for name in self.columns:
+                result[name].extend(self.data[name][low:high])
+        return result
+
+    # All samples with a sequence number greater than seq, as columns
+    def since_seq(self, seq, limit=None):
+        with self.lock:
+            return self._slice(self._first_after(self.seq, seq), limit)
+
+    # All samples collected after the given unix timestamp, as columns
+    def since_time(self, timestamp, limit=None):
+        with self.lock:
+            return self._slice(self._first_after(self.data['timestamp'], timestamp), limit)
@@ -1,15 +1,107 @@
+import argparse
 import tkinter as tk
 from tkinter import ttk, font, messagebox
 import requests
-import threading
 import time
+import bisect
+from types import SimpleNamespace
 
-from collections import deque
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.ticker import FuncFormatter
+import numpy as np
 import math
 
+from poller import PollingEngine
+from downsample import lttb
+from seriesbuffer import SeriesBuffer
+from capture import CaptureReader, CaptureWriter
+from replay import ReplayBar
+
+# How often (ms) the dashboard collects finished polls from the engine and hands them to the tabs
+PUMP_INTERVAL = 100
+
+# Line colour, title and sample key of each graph
+GRAPH_STYLES = {
+    "CPU Usage": ('cyan', "CPU Usage (%)", 'cpu_percent'),
+    "Memory Usage": ('lime', "Memory Usage (%)", 'memory_percent'),
+    "System Load": ('magenta', "System Load", 'load_avg'),
+    "Disk I/O": ('yellow', "Disk I/O", 'disk_io_bytes'),
+    "Network I/O": ('orange', "Network I/O", 'net_io_bytes'),
+}
+SERIES_COLUMNS = ('timestamp',) + tuple(key for _, _, key in GRAPH_STYLES.values())
+# Which live metric label shows each sample key, for colouring them by alert state
+METRIC_LABELS = {key: name for name, (_, _, key) in GRAPH_STYLES.items()}
+
+# Columns of the top processes panel: heading, width and the process field shown
+PROCESS_COLUMNS = {
+    "pid": ("PID", 60, 'pid'),
+    "name": ("Name", 170, 'name'),
+    "user": ("User", 90, 'user'),
+    "cpu": ("CPU %", 70, 'cpu_percent'),
+    "memory": ("Memory", 90, 'rss_bytes'),
+    "io": ("Disk I/O", 90, 'io_bytes'),
+}
+PROCESS_ROWS = 6 # Processes shown at once (the rest are a scroll away)
+
+# A tab's graphs are only built the first time it's shown, and are let go of once it has been hidden this long
+# (its data stays, so they're rebuilt as they were when it's shown again)
+GRAPH_IDLE_SECONDS = 300
+GRAPH_IDLE_CHECK = 30000 # Milliseconds between checks for graphs to let go of
+
+# Time windows the graphs can show, in seconds
+GRAPH_WINDOWS = {"30 seconds": 30, "5 minutes": 300, "1 hour": 3600, "24 hours": 86400}
+MAX_WINDOW = max(GRAPH_WINDOWS.values())
+GAP_INTERVALS = 3 # Refresh intervals without a sample before the graphs show a gap
+
+# A server's data is flagged as stale once its newest sample is this many intervals old (change it with --stale-after)
+STALE_INTERVALS = 3
+FRESHNESS_CHECK = 1000 # Milliseconds between checks of how old every server's data is
+# The steps a sample's latency is broken down into on its way to the screen, in order (see poller.trace_samples)
+LATENCY_STEPS = ("publish", "agent", "relay", "network", "paint")
+
+# matplotlib, imported the first time a graph is needed, so the dashboard opens without waiting on it
+plotting = None
+
+def load_plotting():
+    global plotting
+    if plotting is None:
+        import matplotlib.style
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+        from matplotlib.ticker import FuncFormatter
+        matplotlib.style.use('dark_background')
+        plotting = SimpleNamespace(Figure=Figure, FigureCanvasTkAgg=FigureCanvasTkAgg,
+                                   NavigationToolbar2Tk=NavigationToolbar2Tk, FuncFormatter=FuncFormatter)
+    return plotting
+
+# Label the time axis relative to the newest data, e.g. -30s, -5m, -2.0h
+def format_offset(seconds, pos=None):
+    sign = "-" if seconds < 0 else "+"
+    seconds = abs(seconds)
+    if seconds < 1:
+        return "now"
+    if seconds < 120:
+        return f"{sign}{seconds:.0f}s"
+    if seconds < 7200:
+        return f"{sign}{seconds / 60:.0f}m"
+    return f"{sign}{seconds / 3600:.1f}h"
+
+# A short length of time, e.g. 12 ms or 3.4 s
+def format_duration(seconds):
+    if seconds < 1:
+        return f"{seconds * 1000:.0f} ms"
+    if seconds < 120:
+        return f"{seconds:.1f} s"
+    return f"{seconds / 60:.0f} min"
+
+# Round a value up to the next 1, 2 or 5 times a power of ten
+def nice_ceiling(value):
+    if value <= 0:
+        return 1
+    magnitude = 10 ** math.floor(math.log10(value))
+    for step in (1, 2, 5, 10):
+        if value <= step * magnitude:
+            return step * magnitude
+    return 10 * magnitude
+
 # A single server tab
 class ServerTab(tk.Frame):
 
@@ -21,6 +113,7 @@ class ServerTab(tk.Frame):
         # Styling
         self.default_bg = "#3C3C3C"
         self.alert_bg = "#8B0000"
+        self.anomaly_bg = "#6A2C91"
         self.label_fg = "#FFFFFF"
         self.label_font = font.Font(family="Helvetica", size=12)
 
@@ -31,23 +124,46 @@ class ServerTab(tk.Frame):
         self.load_threshold = tk.DoubleVar(value=2.0)
         self.update_interval = tk.IntVar(value=3)
         self.monitoring = False
-        self.monitor_thread = None
         self.flash_job_id = None
 
-        # Graph data
-        self.max_data_points = 200  # A large buffer to hold data history
-        self.cpu_data = deque([0] * self.max_data_points, maxlen=self.max_data_points)
-        self.mem_data = deque([0] * self.max_data_points, maxlen=self.max_data_points)
-        self.load_data = deque([0] * self.max_data_points, maxlen=self.max_data_points)
-        self.disk_data = deque([0] * self.max_data_points, maxlen=self.max_data_points)
-        self.net_data = deque([0] * self.max_data_points, maxlen=self.max_data_points)
-
-        # Flashing alert (TODO: Make timer configurable? It's already kinda cramped in this space though.)
-        self.alert_timers = {}
-        self.flash_state = {}
+        # Graph data: every sample received (plus anything backfilled from the agent), as far back as the longest window.
+        # The fleet overview reads the newest values from here too.
+        self.series = SeriesBuffer(SERIES_COLUMNS)
+        self.max_gap = None # Seconds between samples past which the graphs show a gap, set from the refresh rate
+        self.window_choice = tk.StringVar(value="30 seconds")
+        self.follow_live = True # Keep the graphs scrolling with new data, until the user pans or zooms
+        self.view_anchor = time.time() # The time axis is drawn in seconds relative to this
+        self.backfill_from = None # Oldest time we've already asked the agent for
+
+        # Alert state of each live metric label ("pending" or "firing", or "anomaly" when the value is unusual for
+        # this server), as worked out by the agent's alert rules and anomaly scores
+        self.alert_states = {}
+        self.flash_on = False
+
+        # How fresh the newest sample is: when it was collected by our clock, how long it took to get to the screen,
+        # and whether it's old enough to flag
+        self.clock_offset = 0.0 # How far the server's clock is ahead of ours
+        self.last_collected = None
+        self.sample_interval = None # Seconds the newest sample covers, the collector's period
+        self.poll_interval = None
+        self.latency = {}
+        self.stale = False
+
+        # Which column the top processes are ordered by
+        self.process_sort = "cpu"
+        self.processes = None
+
+        # The graphs, built when the tab is first shown (see setup_graphs)
+        self.fig = None
+        self.graphs_stale = False
+        self.decimated = None # Downsampled lines from the last redraw, reused until the view moves a whole bucket
+        self.hidden_since = None # When the tab was last hidden, None while it's showing
+        self.paused_view = None # Where the time axis was when the graphs were let go of
 
         self.create_widgets()
-        self.setup_graphs()
+        # Build the graphs (or catch up on anything skipped) when the tab is shown, and note when it's hidden
+        self.bind("<Map>", self.on_shown)
+        self.bind("<Unmap>", self.on_hidden)
 
     # Create the data widgets (the user inputs, live data and graphs) for each server tab
     def create_widgets(self):
@@ -90,11 +206,40 @@ class ServerTab(tk.Frame):
             value_label = tk.Label(metrics_frame, text="--", bg=self.default_bg, fg=self.label_fg, font=self.label_font, width=20, anchor="w", padx=10)
             value_label.grid(row=i, column=1, sticky="ew", padx=5, pady=8)
             self.metric_labels[metric] = value_label
+        # What the agent's alert rules make of the server right now
+        self.alerts_label = tk.Label(metrics_frame, text="Alerts: --", bg=self["bg"], fg=self.label_fg, anchor="w", justify="left", wraplength=320)
+        self.alerts_label.grid(row=len(metrics), column=0, columnspan=2, sticky="ew", padx=5, pady=(4, 0))
+        # How old the data on screen is, and where the time went between the collector and the screen
+        self.freshness_label = tk.Label(metrics_frame, text="Data age: --", bg=self["bg"], fg=self.label_fg, anchor="w", justify="left", wraplength=320)
+        self.freshness_label.grid(row=len(metrics) + 1, column=0, columnspan=2, sticky="ew", padx=5, pady=(4, 0))
         metrics_frame.grid_columnconfigure(1, weight=1)
 
+        # Top processes, as listed by the collector when it's started with --top. Click a heading to sort by it.
+        self.process_frame = tk.LabelFrame(main_frame, text="Top Processes", bg=self["bg"], fg=self.label_fg, padx=10, pady=5)
+        self.process_frame.pack(fill="x", pady=(0, 10))
+        self.process_view = ttk.Treeview(self.process_frame, columns=list(PROCESS_COLUMNS), show="headings", height=PROCESS_ROWS)
+        for column, (heading, width, _) in PROCESS_COLUMNS.items():
+            self.process_view.heading(column, text=heading, command=lambda column=column: self.sort_processes(column))
+            self.process_view.column(column, width=width, anchor="w" if column in ("name", "user") else "e", stretch=column == "name")
+        process_scrollbar = ttk.Scrollbar(self.process_frame, orient="vertical", command=self.process_view.yview)
+        self.process_view.configure(yscrollcommand=process_scrollbar.set)
+        process_scrollbar.pack(side="right", fill="y")
+        self.process_view.pack(side="left", fill="x", expand=True)
+        self.sort_processes(self.process_sort)
+
         # Metrics graph frame
         graph_outer_frame = tk.LabelFrame(main_frame, text="Metrics Graphs (Last 30 seconds)", bg=self["bg"], fg=self.label_fg, padx=10, pady=10)
         graph_outer_frame.pack(fill="both", expand=True, anchor="s")
+        self.graph_frame = graph_outer_frame
+
+        # Time window selection, a button to go back to following live data, and the pan/zoom toolbar (added with the graphs)
+        self.graph_controls = tk.Frame(graph_outer_frame, bg=self["bg"])
+        self.graph_controls.pack(side="top", fill="x", pady=(0, 5))
+        tk.Label(self.graph_controls, text="Show:", bg=self["bg"], fg=self.label_fg).pack(side="left")
+        window_menu = ttk.Combobox(self.graph_controls, textvariable=self.window_choice, values=list(GRAPH_WINDOWS), state="readonly", width=10)
+        window_menu.pack(side="left", padx=5)
+        window_menu.bind("<<ComboboxSelected>>", self.on_window_change)
+        tk.Button(self.graph_controls, text="Live", command=self.go_live).pack(side="left", padx=5)
 
         # Make the graph frame scrollable
         self.scrollable_canvas = tk.Canvas(graph_outer_frame, bg=self["bg"], highlightthickness=0)
@@ -118,42 +263,211 @@ class ServerTab(tk.Frame):
     def on_canvas_configure(self, event):
         self.scrollable_canvas.itemconfig(self.canvas_window, width=event.width)
 
-    # Setup the graphs with matplotlib
+    # Setup the graphs with matplotlib. Every artist is made once here and only has its data swapped afterwards.
     def setup_graphs(self):
-        plt.style.use('dark_background')
-        self.fig = plt.figure(figsize=(8, 12), facecolor="#2E2E2E")
+        mpl = load_plotting()
+        FuncFormatter = mpl.FuncFormatter
+        self.fig = mpl.Figure(figsize=(8, 12), facecolor="#2E2E2E")
         self.fig.subplots_adjust(hspace=0.8, left=0.15, right=0.95, top=0.95, bottom=0.05)
 
-        self.axes = self.fig.subplots(5, 1)
+        # The graphs share a time axis, so panning or zooming one moves them all
+        self.axes = self.fig.subplots(5, 1, sharex=True)
         self.ax_map = {
             "CPU Usage": self.axes[0], "Memory Usage": self.axes[1], "System Load": self.axes[2],
             "Disk I/O": self.axes[3], "Network I/O": self.axes[4],
         }
+        formatters = {
+            "CPU Usage": FuncFormatter(lambda y, _: f'{y:.0f}%'),
+            "Memory Usage": FuncFormatter(lambda y, _: f'{y:.0f}%'),
+            "System Load": FuncFormatter(lambda y, _: f'{y:.2f}'),
+            "Disk I/O": FuncFormatter(self.format_bytes_ax),
+            "Network I/O": FuncFormatter(self.format_bytes_ax),
+        }
 
-        # Basic graph layout
+        # Basic graph layout. The lines are animated so a normal draw leaves them out of the cached background.
+        self.lines = {}
         for name, ax in self.ax_map.items():
-            ax.set_title(name, fontsize=10)
+            color, title, _ = GRAPH_STYLES[name]
+            ax.set_title(title, fontsize=9)
             ax.grid(True, linestyle='--', alpha=0.5)
-            ax.tick_params(axis='x', labelsize=8)
+            # Only the bottom graph labels the shared time axis
+            ax.tick_params(axis='x', labelsize=8, labelbottom=ax is self.axes[-1])
             ax.tick_params(axis='y', labelsize=8)
-            ax.set_xticklabels([])
             ax.set_facecolor('#3C3C3C')
-
-        # Add formatting for the Disk and Network I/O's units
-        for ax_name in ["Disk I/O", "Network I/O"]:
-            self.ax_map[ax_name].yaxis.set_major_formatter(FuncFormatter(self.format_bytes_ax))
+            ax.yaxis.set_major_formatter(formatters[name])
+            self.lines[name], = ax.plot([], [], color=color, animated=True)
+
+        # Threshold markers
+        self.threshold_vars = {"CPU Usage": self.cpu_threshold, "Memory Usage": self.mem_threshold, "System Load": self.load_threshold}
+        self.threshold_lines = {}
+        for name, var in self.threshold_vars.items():
+            self.threshold_lines[name] = self.ax_map[name].axhline(y=var.get(), color='orange', linestyle='--', linewidth=1, animated=True)
+
+        self.axes[-1].xaxis.set_major_formatter(FuncFormatter(format_offset))
+        # Graphs rebuilt after being let go of pick up where the user left them
+        self.axes[0].set_xlim(*(self.paused_view if not self.follow_live else (-self.window_seconds(), 0)))
+
+        # What the axes currently show, so we only relayout when it changes
+        self.ylims = {}
+        self.background = None
+        self.graphs_stale = False
+        self.setting_view = False
+        self.view_refresh_job = None
+        self.decimated = None
 
         # Place the graphs in the scrollable graph frame
-        self.canvas = FigureCanvasTkAgg(self.fig, master=self.scrollable_inner_frame)
+        self.canvas = mpl.FigureCanvasTkAgg(self.fig, master=self.scrollable_inner_frame)
         self.canvas.get_tk_widget().pack(fill="both", expand=True)
+        self.toolbar = mpl.NavigationToolbar2Tk(self.canvas, self.graph_controls, pack_toolbar=False)
+        self.toolbar.pack(side="right")
+        # Panning or zooming stops the graphs following live data
+        self.axes[0].callbacks.connect('xlim_changed', self.on_xlim_changed)
+        # Every full draw (including ones from resizing) refreshes the cached background
+        self.canvas.mpl_connect('draw_event', self.on_draw)
         self.update_graphs()
 
+    # Let go of the graphs (the figure, its canvas and toolbar), keeping the data to rebuild them from
+    def release_graphs(self):
+        if self.fig is None:
+            return
+        if self.view_refresh_job is not None:
+            self.after_cancel(self.view_refresh_job)
+            self.view_refresh_job = None
+        self.paused_view = tuple(self.axes[0].get_xlim())
+        self.toolbar.destroy()
+        self.canvas.get_tk_widget().destroy()
+        self.fig.clear()
+        self.fig = self.canvas = self.toolbar = self.background = self.decimated = None
+        self.axes = self.ax_map = self.lines = self.threshold_lines = None
+        self.graphs_stale = True
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_animated()
+
+    def on_shown(self, event):
+        self.hidden_since = None
+        if self.fig is None:
+            self.setup_graphs()
+        elif self.graphs_stale:
+            self.graphs_stale = False
+            self.update_graphs()
+
+    def on_hidden(self, event):
+        self.hidden_since = time.monotonic()
+
+    def draw_animated(self):
+        for name, ax in self.ax_map.items():
+            ax.draw_artist(self.lines[name])
+            if name in self.threshold_lines:
+                ax.draw_artist(self.threshold_lines[name])
+
+    # Length of the selected time window in seconds
+    def window_seconds(self):
+        return GRAPH_WINDOWS.get(self.window_choice.get(), 30)
+
+    # Set the time axis without it counting as the user panning
+    def set_view(self, left, right):
+        self.setting_view = True
+        try:
+            self.axes[0].set_xlim(left, right)
+        finally:
+            self.setting_view = False
+
+    def on_xlim_changed(self, ax):
+        if self.setting_view:
+            return
+        # The user panned or zoomed, so hold the view still and redraw it once they're done moving it
+        self.follow_live = False
+        self.decimated = None
+        if self.view_refresh_job is None:
+            self.view_refresh_job = self.after_idle(self.refresh_view)
+
+    def refresh_view(self):
+        self.view_refresh_job = None
+        self.graph_frame.config(text=f"Metrics Graphs (Paused at {time.strftime('%H:%M:%S', time.localtime(self.view_anchor))}, press Live to follow)")
+        self.update_graphs(force_layout=True)
+
+    def on_window_change(self, event=None):
+        self.go_live()
+        self.request_backfill()
+
+    def go_live(self):
+        self.follow_live = True
+        self.decimated = None
+        self.graph_frame.config(text=f"Metrics Graphs (Last {self.window_choice.get()})")
+        self.update_graphs(force_layout=True)
+
+    # Ask the agent for anything in the selected window that is older than what we already have: from its
+    # in-memory history first, then (in backfill_archive) from its archive for whatever that doesn't reach
+    def request_backfill(self):
+        if not self.monitoring:
+            return
+        window = self.window_seconds()
+        now = time.time()
+        start = now - window
+        timestamps = self.series.timestamps
+        have_from = timestamps[0] if len(timestamps) else now
+        # Nothing (much) missing, or we've already asked for this far back
+        if have_from - start < max(10, window * 0.02):
+            return
+        if self.backfill_from is not None and self.backfill_from <= start:
+            return
+        self.backfill_from = start
+        self.dashboard.engine.fetch(self, self.server_ip.get(), "/metrics/history", {"since": start}, "history")
+
+    # Ask the archive for the part of the window older than the agent's history goes back (agents from before
+    # it said how far that is are taken to reach back to the oldest sample they sent)
+    def backfill_archive(self, columns):
+        start = self.backfill_from
+        if start is None:
+            return
+        timestamps = columns.get('timestamp') or []
+        oldest = columns.get('oldest', timestamps[0] if len(timestamps) else None)
+        if oldest is None:
+            held = self.series.timestamps
+            oldest = held[0] if len(held) else time.time()
+        if oldest - start < max(10, self.window_seconds() * 0.02):
+            return
+        self.dashboard.engine.fetch(self, self.server_ip.get(), "/metrics/archive", {"start": start, "end": oldest}, "backfill")
+
+    # Put columns from /metrics/history or /metrics/archive in front of the data we already have
+    def merge_backfill(self, columns):
+        timestamps = columns.get('timestamp') or []
+        held = self.series.timestamps
+        first = held[0] if len(held) else math.inf
+        # Both endpoints return rows oldest first, so everything we don't have yet is one run at the start
+        count = bisect.bisect_left(timestamps, first)
+        if not count:
+            return
+        # Archive rollups name their averages <metric>_avg
+        self.series.prepend({key: columns.get(key) or columns.get(f'{key}_avg') for key in SERIES_COLUMNS}, count)
+        self.decimated = None
+        self.update_graphs()
+
+    # Add a sample to the graph data, dropping anything older than the longest window
+    def append_sample(self, data):
+        timestamp = data.get('timestamp') or time.time()
+        # A sample that comes well after the last one leaves a gap in the lines rather than a straight join. Well after is
+        # a few refresh intervals, or a few of the collector's periods if it's sampling slower than we refresh (--adaptive).
+        max_gap = self.max_gap
+        interval = data.get('interval')
+        if max_gap is not None and isinstance(interval, (int, float)) and interval > 0:
+            max_gap = max(max_gap, interval * GAP_INTERVALS)
+        self.series.append(data, timestamp, max_gap=max_gap)
+        if self.series.timestamps[0] < timestamp - MAX_WINDOW * 1.1:
+            self.series.trim_before(timestamp - MAX_WINDOW)
+
     # Function to control the monitoring
     def toggle_monitoring(self):
         if self.monitoring:
             self.monitoring = False
+            self.dashboard.engine.unregister(self)
             self.toggle_button.config(text="Start Monitoring")
             self.dashboard.update_status("Monitoring stopped.")
+            if self.stale:
+                self.stale = False
+                self.dashboard.update_tab_titles()
         else:
             server_ip_val = self.server_ip.get()
             if not server_ip_val:
@@ -164,40 +478,35 @@ class ServerTab(tk.Frame):
             self.toggle_button.config(text="Stop Monitoring")
             self.dashboard.update_status(f"Starting monitoring for {server_ip_val}...")
 
-            # Use a config dictionary to pass to the thread.
-            # This prevents the thread from accessing Tkinter variables directly, preventing a lockup.
-            config = {
-                "ip": server_ip_val,
-                "interval": self.update_interval.get()
-            }
-            self.monitor_thread = threading.Thread(target=self.monitor_loop, args=(config,), daemon=True)
-
-            self.monitor_thread.start()
+            # Hand the server over to the dashboard's shared polling engine. The settings are read here, on the
+            # Tk thread, so the engine never has to touch Tkinter variables and risk a lockup.
+            self.dashboard.engine.register(self, server_ip_val, self.update_interval.get())
+            self.poll_interval = self.update_interval.get()
+            self.max_gap = self.update_interval.get() * GAP_INTERVALS
+            self.backfill_from = None
+            self.request_backfill() # Fill in the selected window if it goes back further than we have
             self.flash_alerting_labels()  # Start the loop to give a flashing alert
 
-    # Loop that executes while monitoring is active, that pulls data from the API as often as set by the user
-    def monitor_loop(self, config):
-        server_ip = config["ip"]
-        update_interval = config["interval"]
-
-        while self.monitoring:
-            try:
-                response = requests.get(f"http://{server_ip}/metrics", timeout=2.5)
-                response.raise_for_status()
-                data = response.json()
-                # Check again if monitoring was stopped while waiting for the request
-                if self.monitoring:
-                    self.after(0, self.update_ui, data)
-            except requests.exceptions.RequestException as e:
-                if self.monitoring:
-                    self.after(0, lambda e=e: self.dashboard.update_status(f"Connection Error: {e}"))
-                    self.after(10000, self.reset_metrics)
-            except Exception as e:
-                if self.monitoring:
-                    self.after(0, lambda e=e: self.dashboard.update_status(f"An error occurred: {e}"))
-
-            # Sleep for the user-defined interval
-            time.sleep(update_interval)
+    # Called by the dashboard with everything the polling engine got for this server since the last batch
+    def handle_results(self, results):
+        samples = []
+        for kind, payload in results:
+            if kind == "samples":
+                samples.extend(payload)
+            elif kind == "history":
+                self.merge_backfill(payload)
+                self.backfill_archive(payload)
+            elif kind == "backfill":
+                self.merge_backfill(payload)
+            elif isinstance(payload, requests.exceptions.RequestException):
+                self.dashboard.update_status(f"Connection Error: {payload}")
+                self.after(10000, self.reset_metrics)
+            else:
+                self.dashboard.update_status(f"An error occurred: {payload}")
+
+        # Take in every sample but only redraw the graphs once for the lot
+        for i, data in enumerate(samples):
+            self.update_ui(data, redraw=(i == len(samples) - 1))
 
     # Formatting of data units functions
     def format_bytes_ax(self, byte_count, pos=None):
@@ -213,159 +522,259 @@ class ServerTab(tk.Frame):
     def format_bytes_label(self, byte_count):
         return self.format_bytes_ax(byte_count)
 
+    # A size rather than a rate, e.g. memory use
+    def format_bytes_size(self, byte_count):
+        return self.format_bytes_ax(byte_count).removesuffix("/s")
+
     # Function to prompt an update of the UI as new data is pulled.
-    def update_ui(self, data):
+    def update_ui(self, data, redraw=True):
         if not self.monitoring: return
-        self.dashboard.update_status(f"Connected to {self.server_ip.get()}. Last update: {time.strftime('%H:%M:%S')}")
-
-        metrics_to_check = {
-            "CPU Usage": (data.get('cpu_percent', 0), self.cpu_threshold.get()),
-            "Memory Usage": (data.get('memory_percent', 0), self.mem_threshold.get()),
-            "System Load": (data.get('load_avg', 0), self.load_threshold.get())
-        }
-
-        for name, (value, threshold) in metrics_to_check.items():
-            label = self.metric_labels[name]
+        if self.dashboard.replay:
+            self.dashboard.update_status(f"Replaying {self.server_ip.get()}. Sample from {time.strftime('%H:%M:%S', time.localtime(data.get('timestamp', 0)))}")
+        else:
+            self.note_freshness(data)
+            collected = time.strftime('%H:%M:%S', time.localtime(self.last_collected)) if self.last_collected else "--"
+            self.dashboard.update_status(f"Connected to {self.server_ip.get()}. Last sample collected at {collected}")
+
+        self.show_values(data)
+        self.show_alerts(data.get('alerts') or [], data.get('anomalies') or [], data.get('anomaly_scores') or {})
+
+        self.append_sample(data)
+
+        if redraw:
+            self.show_processes(data.get('processes'))
+
+        if redraw and self.update_graphs() and data.get('received') is not None:
+            self.latency['paint'] = max(0.0, time.time() - data['received'])
+            if self.check_freshness(time.time()):
+                self.dashboard.update_tab_titles()
+
+    # Take in the timings a sample came with (see poller.trace_samples)
+    def note_freshness(self, data):
+        if data.get('clock_offset') is not None:
+            self.clock_offset = data['clock_offset']
+        if data.get('timestamp') is not None:
+            # When it was collected, by our clock
+            self.last_collected = data['timestamp'] - self.clock_offset
+        if isinstance(data.get('interval'), (int, float)):
+            self.sample_interval = data['interval']
+        self.latency = dict(data.get('latency') or {})
+
+    # Show how long ago the newest sample was collected and where the time went, flagging the server once it's
+    # more than the dashboard's stale_after intervals old (the refresh rate, or the collector's period if that's
+    # longer). A stalled collector shows as a growing age, a slow network or relay as a big step in the breakdown.
+    # Returns whether the server just went stale or fresh again.
+    def check_freshness(self, now):
+        if not self.monitoring or self.last_collected is None or self.dashboard.replay:
+            return False
+        age = max(0.0, now - self.last_collected)
+        interval = max(self.poll_interval or 1, self.sample_interval or 0)
+        stale = age > self.dashboard.stale_after * interval
+        steps = ", ".join(f"{step} {format_duration(self.latency[step])}" for step in LATENCY_STEPS if step in self.latency)
+        text = f"Data age: {format_duration(age)}" + (" (stale)" if stale else "") + (f" ({steps})" if steps else "")
+        self.freshness_label.config(text=text, fg="#FF6B6B" if stale else self.label_fg)
+        changed = stale != self.stale
+        self.stale = stale
+        return changed
+
+    # Show a sample's values in the live metrics
+    def show_values(self, data):
+        for name, key in (("CPU Usage", 'cpu_percent'), ("Memory Usage", 'memory_percent'), ("System Load", 'load_avg')):
             text_format = "{:.2f} %" if "Usage" in name else "{:.2f}"
-            label.config(text=text_format.format(value))
-
-            if value > threshold:
-                if name not in self.alert_timers:
-                    self.alert_timers[name] = time.time()
-                    label.config(bg=self.alert_bg)
-            else:
-                if name in self.alert_timers:
-                    del self.alert_timers[name]
-                    if name in self.flash_state: del self.flash_state[name]
-                    label.config(bg=self.default_bg)
-
-        self.cpu_data.append(metrics_to_check["CPU Usage"][0])
-        self.mem_data.append(metrics_to_check["Memory Usage"][0])
-        self.load_data.append(metrics_to_check["System Load"][0])
+            self.metric_labels[name].config(text=text_format.format(data.get(key, 0)))
 
         disk_io = data.get('disk_io_bytes', 0)
         self.metric_labels["Disk I/O"].config(text=self.format_bytes_label(disk_io))
-        self.disk_data.append(disk_io)
 
         net_io = data.get('net_io_bytes', 0)
         self.metric_labels["Network I/O"].config(text=self.format_bytes_label(net_io))
-        self.net_data.append(net_io)
 
-        self.update_graphs()
-
-    # Flash the live metric if it exceeds the threshold for several seconds
+    # Colour the live metrics by the alert state the agent sent along with the sample: steady red while one
+    # of its rules is pending, flashing once it fires, and purple when the value is an anomaly for this server
+    # (anomalies are the metrics the agent scored as unusual, scores their scores by metric)
+    def show_alerts(self, alerts, anomalies=(), scores=None):
+        states = {}
+        for metric in anomalies:
+            name = METRIC_LABELS.get(metric)
+            if name:
+                states[name] = 'anomaly'
+        for alert in alerts:
+            name = METRIC_LABELS.get(alert.get('metric'))
+            if name and states.get(name) != 'firing':
+                states[name] = alert.get('state')
+        for name, label in self.metric_labels.items():
+            if states.get(name) != self.alert_states.get(name):
+                state = states.get(name)
+                label.config(bg=self.anomaly_bg if state == 'anomaly' else self.alert_bg if state else self.default_bg)
+        self.alert_states = states
+
+        parts = [f"{alert.get('rule')} ({alert.get('state')})" for alert in alerts]
+        parts += [f"unusual {METRIC_LABELS.get(metric, metric)} (score {(scores or {}).get(metric, 0):+.1f})" for metric in anomalies]
+        if parts:
+            self.alerts_label.config(text="Alerts: " + ", ".join(parts), fg="#FF6B6B" if alerts else "#C9A0DC")
+        else:
+            self.alerts_label.config(text="Alerts: none", fg=self.label_fg)
+
+    # Fill the top processes panel from a sample's process list (None if the collector isn't listing them)
+    def show_processes(self, processes):
+        if processes is None:
+            self.process_frame.config(text="Top Processes (start the collector with --top N to list them)")
+            self.processes = None
+            self.process_view.delete(*self.process_view.get_children())
+            return
+        self.process_frame.config(text="Top Processes")
+        self.processes = processes
+
+        key = PROCESS_COLUMNS[self.process_sort][2]
+        reverse = self.process_sort not in ("pid", "name", "user")
+        ordered = sorted(processes, key=lambda process: process.get(key) or (0 if reverse else ""), reverse=reverse)
+        rows = [(process.get('pid', ''), process.get('name', ''), process.get('user', ''), f"{process.get('cpu_percent', 0):.1f}",
+                 self.format_bytes_size(process.get('rss_bytes', 0)), self.format_bytes_label(process.get('io_bytes', 0)))
+                for process in ordered]
+        # Reuse the rows already in the view rather than rebuilding it on every sample
+        items = self.process_view.get_children()
+        for item, values in zip(items, rows):
+            self.process_view.item(item, values=values)
+        if len(items) > len(rows):
+            self.process_view.delete(*items[len(rows):])
+        for values in rows[len(items):]:
+            self.process_view.insert("", "end", values=values)
+
+    def sort_processes(self, column):
+        self.process_sort = column
+        for name, (heading, _, _) in PROCESS_COLUMNS.items():
+            self.process_view.heading(name, text=heading + (" ▼" if name == column else ""))
+        if self.processes is not None:
+            self.show_processes(self.processes)
+
+    # Flash the live metrics that have a firing alert
     def flash_alerting_labels(self):
-        now = time.time()
-        for name, start_time in list(self.alert_timers.items()):
-            if now - start_time > 6: # Currently hardcoded. See TODO at line 41 about this issue.
-                # Cycle between the colors
-                current_color = self.flash_state.get(name, 'red')
-                if self.monitoring == False:
-                    break
-                if current_color == 'red':
-                    self.metric_labels[name].config(bg=self.default_bg)
-                    self.flash_state[name] = 'default'
-                else:
-                    self.metric_labels[name].config(bg=self.alert_bg)
-                    self.flash_state[name] = 'red'
+        if self.monitoring:
+            self.flash_on = not self.flash_on
+            for name, state in self.alert_states.items():
+                if state == 'firing':
+                    self.metric_labels[name].config(bg=self.alert_bg if self.flash_on else self.default_bg)
 
         self.flash_job_id = self.after(500, self.flash_alerting_labels)
 
-    def update_graphs(self):
-        # Dynanically calculate points for the last 30 seconds
-        try:
-            interval = max(1, self.update_interval.get()) # Prevent division by zero, min interval of 1
-        except tk.TclError:
-            interval = 3 # Default if widget is destroyed
-
-        points_to_show = math.ceil(30 / interval)
-        points_to_show = max(2, points_to_show) # Ensure at least 2 points to draw a line
-
-        # Sliced the data for plotting
-        cpu_plot_data = list(self.cpu_data)[-points_to_show:]
-        mem_plot_data = list(self.mem_data)[-points_to_show:]
-        load_plot_data = list(self.load_data)[-points_to_show:]
-        disk_plot_data = list(self.disk_data)[-points_to_show:]
-        net_plot_data = list(self.net_data)[-points_to_show:]
-
-        # CPU Usage Graph
-        ax_cpu = self.ax_map["CPU Usage"]
-        ax_cpu.clear()
-        ax_cpu.plot(cpu_plot_data, color='cyan')
-        ax_cpu.axhline(y=self.cpu_threshold.get(), color='orange', linestyle='--', linewidth=1)
-        ax_cpu.set_ylim(0, 105)
-        ax_cpu.set_title("CPU Usage (%)", fontsize=9)
-        ax_cpu.yaxis.set_major_formatter(FuncFormatter(lambda y, _: f'{y:.0f}%'))
-
-        # Memory Usage Graph
-        ax_mem = self.ax_map["Memory Usage"]
-        ax_mem.clear()
-        ax_mem.plot(mem_plot_data, color='lime')
-        ax_mem.axhline(y=self.mem_threshold.get(), color='orange', linestyle='--', linewidth=1)
-        ax_mem.set_ylim(0, 105)
-        ax_mem.set_title("Memory Usage (%)", fontsize=9)
-        ax_mem.yaxis.set_major_formatter(FuncFormatter(lambda y, _: f'{y:.0f}%'))
-
-        # System Load Graph
-        ax_load = self.ax_map["System Load"]
-        ax_load.clear()
-        ax_load.plot(load_plot_data, color='magenta')
-        ax_load.axhline(y=self.load_threshold.get(), color='orange', linestyle='--', linewidth=1)
-        max_load = max(1.0, self.load_threshold.get() * 1.2, max(load_plot_data) * 1.1)
-        ax_load.set_ylim(bottom=0, top=max_load)
-        ax_load.set_title("System Load", fontsize=9)
-        ax_load.yaxis.set_major_formatter(FuncFormatter(lambda y, _: f'{y:.2f}'))
-
-        # Disk I/O Graph
-        ax_disk = self.ax_map["Disk I/O"]
-        ax_disk.clear()
-        ax_disk.plot(disk_plot_data, color='yellow')
-        max_disk_io = max(disk_plot_data) if any(disk_plot_data) else 0
-        disk_ylim_top = max(1024, max_disk_io * 1.1)
-        ax_disk.set_ylim(bottom=0, top=disk_ylim_top)
-        ax_disk.set_title("Disk I/O", fontsize=9)
-        ax_disk.yaxis.set_major_formatter(FuncFormatter(self.format_bytes_ax))
-
-        # Network I/O Graph
-        ax_net = self.ax_map["Network I/O"]
-        ax_net.clear()
-        ax_net.plot(net_plot_data, color='orange')
-        max_net_io = max(net_plot_data) if any(net_plot_data) else 0
-        net_ylim_top = max(1024, max_net_io * 1.1)
-        ax_net.set_ylim(bottom=0, top=net_ylim_top)
-        ax_net.set_title("Network I/O", fontsize=9)
-        ax_net.yaxis.set_major_formatter(FuncFormatter(self.format_bytes_ax))
-
-        for ax in self.ax_map.values():
-            ax.grid(True, linestyle='--', alpha=0.5)
-            ax.set_xticklabels([])
-
-        self.canvas.draw()
+    # Work out the y-axis range for a graph. Auto-scaled graphs snap to round numbers and only shrink once
+    # the data drops well below the top, so the axes (and the full redraw they need) rarely change.
+    def graph_ylim(self, name, plot_data):
+        if name in ("CPU Usage", "Memory Usage"):
+            return (0, 105)
+        peak = np.nanmax(plot_data) if np.any(np.isfinite(plot_data)) else 0
+        if name == "System Load":
+            needed = max(1.0, self.load_threshold.get() * 1.2, peak * 1.1)
+        else:
+            needed = max(1024, peak * 1.1)
+        current = self.ylims.get(name, (0, 0))[1]
+        if current / 2 < needed <= current:
+            return (0, current)
+        return (0, nice_ceiling(needed))
+
+    # The points of every graph's line inside [start, end], downsampled to about one point per pixel.
+    # While following live data the downsampled line is reused until the window has moved on by a
+    # whole bucket, with just the newest raw points added to the end, so the cost stays flat.
+    def visible_lines(self, start, end, width):
+        timestamps = self.series.timestamps
+        # One point either side so the lines run off the edges instead of stopping short
+        low = max(0, np.searchsorted(timestamps, start) - 1)
+        high = min(len(timestamps), np.searchsorted(timestamps, end, side='right') + 1)
+
+        if high - low <= width * 2:
+            self.decimated = None
+            return {key: (timestamps[low:high].copy(), self.series[key][low:high].copy()) for key in SERIES_COLUMNS[1:]}
+
+        bucket = (end - start) / width
+        cache = self.decimated
+        if cache is None or cache['width'] != width or cache['span'] != end - start or start - cache['start'] >= bucket:
+            lines = {key: lttb(timestamps[low:high], self.series[key][low:high], width) for key in SERIES_COLUMNS[1:]}
+            cache = self.decimated = {'width': width, 'span': end - start, 'start': start, 'until': timestamps[high - 1], 'lines': lines}
+
+        # Raw points that came in after the cached line was made
+        tail = np.searchsorted(timestamps, cache['until'], side='right')
+        lines = {}
+        for key, (x, y) in cache['lines'].items():
+            if tail < high:
+                x = np.concatenate((x, timestamps[tail:high]))
+                y = np.concatenate((y, self.series[key][tail:high]))
+            lines[key] = (x, y)
+        return lines
+
+    # Returns whether anything was drawn
+    def update_graphs(self, force_layout=False):
+        # Don't spend any time drawing a tab nobody can see (or that has no graphs yet), it gets redrawn when it's selected
+        if self.fig is None or not self.winfo_ismapped():
+            self.graphs_stale = True
+            return False
+
+        relayout = self.background is None or force_layout
+        if self.follow_live:
+            # The axis is in seconds before the newest sample, so following live data never moves the axis itself
+            # (and the server's clock being a little off from ours doesn't push the data off the edge)
+            self.view_anchor = self.series.latest('timestamp') if len(self.series) else time.time()
+            window = self.window_seconds()
+            if tuple(self.axes[0].get_xlim()) != (-window, 0):
+                self.set_view(-window, 0)
+                relayout = True
+        left, right = self.axes[0].get_xlim()
+        width = max(50, int(self.axes[0].bbox.width))
+
+        lines = self.visible_lines(self.view_anchor + left, self.view_anchor + right, width)
+        for name, (_, _, key) in GRAPH_STYLES.items():
+            x, y = lines[key]
+            self.lines[name].set_data(x - self.view_anchor, y)
+            ylim = self.graph_ylim(name, y)
+            if ylim != self.ylims.get(name):
+                self.ylims[name] = ylim
+                self.ax_map[name].set_ylim(*ylim)
+                relayout = True
+
+        for name, var in self.threshold_vars.items():
+            self.threshold_lines[name].set_ydata([var.get(), var.get()])
+
+        if relayout:
+            # Full draw, the draw_event handler recaptures the background and adds the lines on top
+            self.canvas.draw()
+        else:
+            # Just repaint the lines over the cached background
+            self.canvas.restore_region(self.background)
+            self.draw_animated()
+            for ax in self.ax_map.values():
+                self.canvas.blit(ax.bbox)
+        return True
 
     # Function to reset the metrics whenever required
     def reset_metrics(self):
-        self.alert_timers.clear()
-        self.flash_state.clear()
+        self.alert_states = {}
+        self.alerts_label.config(text="Alerts: --", fg=self.label_fg)
+        self.freshness_label.config(text="Data age: --", fg=self.label_fg)
+        self.last_collected = None
+        self.latency = {}
+        self.stale = False
         for key in self.metric_labels:
             self.metric_labels[key].config(text="--", bg=self.default_bg)
+        self.processes = None
+        self.process_view.delete(*self.process_view.get_children())
 
-        self.cpu_data.extend([0]*self.max_data_points)
-        self.mem_data.extend([0]*self.max_data_points)
-        self.load_data.extend([0]*self.max_data_points)
-        self.disk_data.extend([0]*self.max_data_points)
-        self.net_data.extend([0]*self.max_data_points)
+        # Break the lines here rather than joining across the outage
+        self.series.append_gap(max(time.time(), self.series.latest('timestamp') if len(self.series) else 0))
         self.update_graphs()
 
     # Convenience function to control monitoring status
     def stop_monitoring(self):
         self.monitoring = False
+        self.dashboard.engine.unregister(self)
         if self.flash_job_id:
             self.after_cancel(self.flash_job_id)
             self.flash_job_id = None
 
 # Seperate foreground class responsable for the window, server buttons/tabs, updating, and closing the program.
 class PerformanceDashboard(tk.Tk):
-    def __init__(self):
+    # relay is the host:port of a relay.py to get every server's data through, instead of asking each server.
+    # record is a capture file to keep every sample received in, replay a capture file to play back instead of polling.
+    # stale_after is how many intervals old a server's newest sample can get before it's flagged.
+    def __init__(self, relay=None, record=None, replay=None, stale_after=STALE_INTERVALS):
         super().__init__()
         self.title("Multi-Server Performance Monitor")
         self.geometry("745x865")
@@ -380,6 +789,9 @@ class PerformanceDashboard(tk.Tk):
         self.remove_server_button = tk.Button(top_bar, text="➖ Remove Server", command=self.remove_server_tab)
         self.remove_server_button.pack(side="left")
 
+        self.fleet_button = tk.Button(top_bar, text="▦ Fleet Overview", command=self.show_fleet_view)
+        self.fleet_button.pack(side="right")
+
         self.notebook = ttk.Notebook(self)
         self.notebook.pack(pady=10, padx=10, fill="both", expand=True)
 
@@ -387,11 +799,28 @@ class PerformanceDashboard(tk.Tk):
         self.status_label.pack(side="bottom", fill="x")
 
         self.tabs = []
+        self.fleet = None # Fleet overview tab, made the first time it's asked for
+        self.capture = CaptureWriter(record) if record else None
+        self.replay = None
+        self.stale_after = stale_after
+
+        # One polling engine for every tab, drained on the Tk thread by a single pump
+        self.engine = PollingEngine(relay=relay, stream=True)
+        if relay:
+            self.update_status(f"Ready. Add a server tab to begin (servers are read through the relay at {relay}).")
+        self.pump_job_id = self.after(PUMP_INTERVAL, self.pump_results)
+        self.release_job_id = self.after(GRAPH_IDLE_CHECK, self.release_idle_graphs)
+        self.freshness_job_id = self.after(FRESHNESS_CHECK, self.check_freshness)
+
+        if replay:
+            self.replay = ReplayBar(self, dashboard=self, reader=CaptureReader(replay))
+            self.replay.pack(side="top", fill="x", padx=10, pady=(5, 0), before=self.notebook)
+            self.add_server_button.config(state="disabled")
 
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
 
     def add_server_tab(self):
-        tab_count = len(self.notebook.tabs()) + 1
+        tab_count = len(self.tabs) + 1
         new_tab = ServerTab(self.notebook, dashboard=self)
         self.notebook.add(new_tab, text=f"Server {tab_count}")
         self.tabs.append(new_tab)
@@ -399,19 +828,36 @@ class PerformanceDashboard(tk.Tk):
         self.update_status(f"Added Server {tab_count}. Please configure and start monitoring.")
         self.update_tab_titles()
 
+    # Show the fleet overview tab, making it the first time
+    def show_fleet_view(self):
+        if self.fleet is None:
+            from fleetview import FleetView # Only imported (along with matplotlib) when it's first opened
+            load_plotting()
+            self.fleet = FleetView(self.notebook, dashboard=self)
+            self.notebook.insert(0, self.fleet, text="Fleet Overview")
+        self.notebook.select(self.fleet)
+
     def remove_server_tab(self):
         if not self.notebook.tabs():
             self.update_status("No servers to remove.")
             return
 
         try:
-            # Get the widget and index of the currently selected tab
+            # Get the widget of the currently selected tab
             selected_tab_widget = self.nametowidget(self.notebook.select())
-            current_selection_index = self.notebook.index(self.notebook.select())
         except tk.TclError:
             self.update_status("No server tab selected to remove.")
             return
 
+        # The fleet overview just gets closed, it can be opened again from its button
+        if selected_tab_widget is self.fleet:
+            self.fleet.stop()
+            self.notebook.forget(self.fleet)
+            self.fleet.destroy()
+            self.fleet = None
+            self.update_status("Closed the fleet overview.")
+            return
+
         ip_address = selected_tab_widget.server_ip.get() or "this server"
         question = f"Are you sure you want to remove the tab for {ip_address}?"
 
@@ -421,31 +867,90 @@ class PerformanceDashboard(tk.Tk):
             self.update_status(f"Stopping monitoring for {ip_address}...")
 
             # Remove the tab after a short delay with a helper function
-            self.after(100, self._finalize_tab_removal, selected_tab_widget, current_selection_index, ip_address)
+            self.after(100, self._finalize_tab_removal, selected_tab_widget, ip_address)
 
     # Helper function to perform the actual removal of everything
-    def _finalize_tab_removal(self, tab_to_remove, tab_index, ip_address):
+    def _finalize_tab_removal(self, tab_to_remove, ip_address):
         # Forget the tab from the notebook, destroying its widgets
         self.notebook.forget(tab_to_remove)
-        # Remove the tab object from the list of tabs
-        self.tabs.pop(tab_index)
+        # Remove the tab object from the list of tabs (notebook indexes are off by one while the fleet tab is open)
+        self.tabs.remove(tab_to_remove)
 
         self.update_status(f"Removed tab for {ip_address}.")
         self.update_tab_titles()
 
     def update_tab_titles(self):
         for i, tab in enumerate(self.tabs):
-            self.notebook.tab(tab, text=f"Server {i + 1}")
+            self.notebook.tab(tab, text=f"Server {i + 1}" + (" ⚠" if tab.stale else ""))
 
     def update_status(self, message):
         self.status_label.config(text=message)
 
+    # Collect everything the engine has finished and give each tab its results in one go
+    def pump_results(self):
+        # Queue the next run first so one bad batch can't stop the pump
+        self.pump_job_id = self.after(PUMP_INTERVAL, self.pump_results)
+        batches = {}
+        for tab, kind, payload in self.engine.drain():
+            batches.setdefault(tab, []).append((kind, payload))
+        for tab, results in batches.items():
+            # Results for a tab that has been stopped or removed in the meantime are dropped
+            if tab.monitoring:
+                if self.capture:
+                    self.record(tab, results)
+                tab.handle_results(results)
+
+    # Let go of the graphs of tabs that haven't been looked at for a while
+    def release_idle_graphs(self):
+        self.release_job_id = self.after(GRAPH_IDLE_CHECK, self.release_idle_graphs)
+        now = time.monotonic()
+        for tab in self.tabs:
+            if tab.fig is not None and tab.hidden_since is not None and now - tab.hidden_since > GRAPH_IDLE_SECONDS:
+                tab.release_graphs()
+
+    # Age every server's data, even the ones that have stopped sending any, and flag the stale ones in their tab titles
+    def check_freshness(self):
+        self.freshness_job_id = self.after(FRESHNESS_CHECK, self.check_freshness)
+        now = time.time()
+        changed = [tab.check_freshness(now) for tab in self.tabs]
+        if any(changed):
+            self.update_tab_titles()
+            stale = [tab.server_ip.get() for tab in self.tabs if tab.stale]
+            if stale:
+                self.update_status(f"Stale data from {', '.join(stale)} (older than {self.stale_after:g} intervals).")
+
+    # Keep every sample a tab was given in the capture file
+    def record(self, tab, results):
+        host = tab.server_ip.get()
+        received = time.time()
+        for kind, payload in results:
+            if kind == "samples":
+                for sample in payload:
+                    self.capture.write(host, sample, sample.get('received', received))
+
     def on_closing(self):
         for tab in self.tabs:
             tab.stop_monitoring()
-        plt.close('all')
+        if self.fleet:
+            self.fleet.stop()
+        self.after_cancel(self.pump_job_id)
+        self.after_cancel(self.release_job_id)
+        self.after_cancel(self.freshness_job_id)
+        self.engine.close()
+        if self.replay:
+            self.replay.stop()
+        if self.capture:
+            self.capture.close()
         self.destroy()
 
 if __name__ == "__main__":
-    app = PerformanceDashboard()
+    parser = argparse.ArgumentParser(description="Monitor servers running agent.py")
+    parser.add_argument('--relay', help="host:port of a relay.py to read every server through")
+    parser.add_argument('--record', help="Capture file to keep every sample received in, for replaying later")
+    parser.add_argument('--replay', help="Capture file (from --record) to play back instead of monitoring")
+    parser.add_argument('--stale-after', type=float, default=STALE_INTERVALS, help="Flag a server once its newest sample is this many intervals old")
+    args = parser.parse_args()
+    if args.record and args.replay:
+        parser.error("--record and --replay can't be used together")
+    app = PerformanceDashboard(relay=args.relay, record=args.record, replay=args.replay, stale_after=args.stale_after)
     app.mainloop()
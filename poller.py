@@ -0,0 +1,479 @@
+import asyncio
+import heapq
+import itertools
+import json
+import random
+import threading
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from wireformat import BINARY_MIME, JSON_MIME, SERVED_HEADER, decode_columns, decode_sample
+
+# One polling engine shared by every server tab in the dashboard.
+#
+# A single scheduler thread keeps a heap of when each host is next due and hands the actual
+# requests to a small, bounded worker pool. All requests go through one requests.Session, so
+# each host keeps a single keep-alive connection open instead of reconnecting every sample.
+# Results are queued up for the Tk thread to collect in batches. Agents are asked for the compact
+# columnar encoding, which decodes straight into arrays instead of going through JSON.
+#
+# Started with stream=True (as the dashboard does), hosts aren't polled at all but pushed each sample
+# over the agent's /metrics/stream. Every stream is held open by one asyncio loop on one more thread,
+# however many hosts there are, and reconnects with the same backoff as polling, resuming after the
+# last sample it got (anything the agent no longer has to resume from is backfilled from its history
+# first). Agents without a stream are polled instead.
+#
+# Given the address of a relay (relay.py), the engine doesn't poll the hosts at all: every registered
+# host's newest sample comes in on one batch request to the relay, and history is fetched through it.
+#
+# Every sample that comes in is stamped with when it was received, and with how long it spent at each
+# step on its way here (see trace_samples), so the dashboard can tell a stalled collector from a slow
+# network or a slow screen. Times taken on another machine are corrected for how far its clock is off
+# from ours, estimated from the responses themselves the way NTP does it.
+
+DEFAULT_WORKERS = 16
+DEFAULT_TIMEOUT = 2.5
+JITTER = 0.1 # Each poll is moved by up to +/-10% of the interval so hosts don't all fire at once
+MAX_BACKOFF = 60 # Longest wait between retries of a host that keeps failing
+MAX_HOSTS = 1024 # Number of hosts that can keep a pooled connection open at once
+AGENT_PORT = 5050 # Assumed for hosts given without a port
+RELAY_FILTER_MAX = 64 # Past this many hosts, take the relay's shared whole-fleet batch instead of asking for ours
+CLOCK_SAMPLES = 16 # Recent responses the clock offset of each host is estimated from
+# Seconds to wait on a quiet stream before reconnecting (the agent sends a keepalive every 15 seconds)
+STREAM_READ_TIMEOUT = 30
+
+
+# Everything the engine needs to know about one registered host
+class PollTarget:
+
+    def __init__(self, key, address, interval, timeout):
+        self.key = key
+        self.address = address
+        self.interval = interval
+        self.timeout = timeout
+        self.active = True
+        self.due = 0.0
+        self.failures = 0
+        self.last_seq = None # Sequence number of the newest sample delivered
+        self.last_timestamp = 0.0
+        self.etag = None # Validator of the newest /metrics response, so an unchanged sample costs a 304
+        self.needs_backfill = False # Set after a failure, so the gap gets filled in on recovery
+        self.clock = ClockOffset()
+        self.stream = None # The future of the task holding its stream open, in stream mode
+
+
+# How far a server's clock is ahead of ours. Each response says when it was sent by the server's clock, which
+# was somewhere between when we sent the request and when the answer arrived, so taking the middle is off by
+# at most half the round trip. The estimate from the quickest recent round trip is the one kept.
+class ClockOffset:
+
+    def __init__(self):
+        self.recent = deque(maxlen=CLOCK_SAMPLES) # (round trip, offset)
+        self.offset = 0.0
+
+    # sent and received are by our clock, served by the server's
+    def update(self, sent, received, served):
+        self.recent.append((received - sent, served - (sent + received) / 2))
+        self.offset = min(self.recent)[1]
+        return self.offset
+
+
+# The unix time a response says it was sent at, or None if the server doesn't say
+def served_time(response):
+    return parse_time(response.headers.get(SERVED_HEADER))
+
+def parse_time(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+# An agent that has no /metrics/stream, so has to be polled
+class StreamUnavailable(Exception):
+    pass
+
+# Stamp samples that just arrived with when they did (received, by our clock) and add this hop to their
+# "latency": seconds between being collected and published ("publish"), published and sent out by the agent
+# ("agent"), spent waiting on any relays on the way ("relay") and on the wire ("network"). "clock_offset"
+# is how far the clock of the host the sample came from is ahead of ours, through every hop. served is when
+# the server sent the samples by its clock (None if it didn't say), offset how far its clock is ahead of ours.
+def trace_samples(samples, served, received, offset):
+    for sample in samples:
+        latency = dict(sample.get("latency") or {})
+        previous = sample.get("received")
+        if served is not None:
+            if previous is not None:
+                # Came through a relay, which stamped it when it arrived there
+                latency["relay"] = latency.get("relay", 0.0) + max(0.0, served - previous)
+            elif sample.get("published") is not None:
+                latency["agent"] = max(0.0, served - sample["published"])
+            latency["network"] = latency.get("network", 0.0) + max(0.0, received - (served - offset))
+        if previous is None and sample.get("published") is not None and sample.get("timestamp") is not None:
+            latency["publish"] = max(0.0, sample["published"] - sample["timestamp"])
+        sample["latency"] = latency
+        sample["clock_offset"] = (sample.get("clock_offset") or 0.0) + offset
+        sample["received"] = received
+    return samples
+
+
+# Decode a response in whichever format the agent sent (older agents only speak JSON)
+def read_body(response, sample=False):
+    if response.headers.get("Content-Type", "").startswith(BINARY_MIME):
+        return decode_sample(response.content) if sample else decode_columns(response.content)
+    return response.json()
+
+# The host:port a host is known by, with the agent's default port if it was given without one
+def host_address(host):
+    host = host.strip()
+    return host if ':' in host else f"{host}:{AGENT_PORT}"
+
+# Turn a columnar /metrics/history response into a list of sample dicts
+def columns_to_samples(columns):
+    names = [name for name, values in columns.items() if isinstance(values, (list, array))]
+    return [dict(zip(names, row)) for row in zip(*(columns[name] for name in names))]
+
+# Drop samples that come sooner than the refresh interval after the one before (with a little slack for jitter)
+def thin_samples(samples, interval, last_timestamp=0.0):
+    thinned = []
+    for sample in samples:
+        timestamp = sample.get("timestamp", 0.0)
+        if timestamp - last_timestamp >= interval * 0.9:
+            thinned.append(sample)
+            last_timestamp = timestamp
+    return thinned
+
+
+class PollingEngine:
+
+    # stream is whether to have agents push their samples instead of polling them (not through a relay)
+    def __init__(self, max_workers=DEFAULT_WORKERS, relay=None, stream=False):
+        self.session = requests.Session()
+        if relay:
+            # Everything goes to the relay, so it gets the whole pool
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        else:
+            # One small pool per host; only one request per host is ever in flight
+            adapter = HTTPAdapter(pool_connections=MAX_HOSTS, pool_maxsize=2)
+        self.session.mount("http://", adapter)
+        self.session.headers["Accept"] = f"{BINARY_MIME}, {JSON_MIME};q=0.5"
+        self.workers = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="poller")
+
+        self.targets = {}
+        self.schedule = [] # Heap of (due time, tie breaker, target)
+        self.counter = itertools.count()
+        self.results = deque() # (key, "samples" or "error", payload) waiting for the Tk thread
+        self.wakeup = threading.Condition()
+        self.running = True
+        self.relay = relay
+        # The one target polled in relay mode, only scheduled while there are hosts registered
+        self.relay_target = PollTarget(None, relay, 1.0, DEFAULT_TIMEOUT) if relay else None
+        if relay:
+            self.relay_target.active = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        # The one loop every stream is read on
+        self.loop = None
+        if stream and not relay:
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, daemon=True, name="streams").start()
+
+    # Start polling a host. key is whatever the caller wants results tagged with. A host given without a
+    # port is polled on the agent's default one, the same as the relay assumes.
+    def register(self, key, address, interval, timeout=DEFAULT_TIMEOUT):
+        self.unregister(key)
+        target = PollTarget(key, host_address(address), max(0.1, interval), timeout)
+        with self.wakeup:
+            self.targets[key] = target
+            if self.loop:
+                target.stream = asyncio.run_coroutine_threadsafe(self.follow_stream(target), self.loop)
+            elif not self.relay:
+                # Spread the first polls out a little too
+                self._schedule(target, time.monotonic() + random.uniform(0, JITTER * target.interval))
+            elif not self.relay_target.active:
+                self.relay_target.active = True
+                self._schedule(self.relay_target, time.monotonic())
+        return target
+
+    def unregister(self, key):
+        with self.wakeup:
+            target = self.targets.pop(key, None)
+            if target:
+                target.active = False
+                if target.stream:
+                    target.stream.cancel()
+
+    # One-off request on the shared pool and session (e.g. backfilling a graph). The decoded response is
+    # queued as (key, kind, data), or (key, "error", exception) if it fails.
+    def fetch(self, key, address, path, params, kind, timeout=DEFAULT_TIMEOUT):
+        self.workers.submit(self.fetch_once, key, self.url(address, path), params, kind, timeout)
+
+    def fetch_once(self, key, url, params, kind, timeout):
+        try:
+            response = self.session.get(url, params=params, timeout=timeout)
+            response.raise_for_status()
+            self.results.append((key, kind, read_body(response)))
+        except Exception as e:
+            self.results.append((key, "error", e))
+
+    # Everything that has come in since the last call, oldest first
+    def drain(self):
+        batch = []
+        while self.results:
+            batch.append(self.results.popleft())
+        return batch
+
+    def close(self):
+        with self.wakeup:
+            self.running = False
+            self.wakeup.notify()
+        if self.loop:
+            asyncio.run_coroutine_threadsafe(self.close_streams(), self.loop)
+        self.workers.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+    # Stream task: cancel every stream and let them close their connections before stopping the loop
+    async def close_streams(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.loop.stop()
+
+    # Where to ask for one of a host's endpoints, directly or through the relay
+    def url(self, address, path):
+        address = host_address(address)
+        if self.relay:
+            return f"http://{self.relay}/hosts/{address}{path}"
+        return f"http://{address}{path}"
+
+    def _schedule(self, target, due):
+        target.due = due
+        heapq.heappush(self.schedule, (due, next(self.counter), target))
+        self.wakeup.notify()
+
+    # Scheduler thread: sleep until the next host is due and pass it to the worker pool
+    def run(self):
+        with self.wakeup:
+            while self.running:
+                if not self.schedule:
+                    self.wakeup.wait()
+                    continue
+                due, _, target = self.schedule[0]
+                now = time.monotonic()
+                if due > now:
+                    self.wakeup.wait(due - now)
+                    continue
+                heapq.heappop(self.schedule)
+                # Skip hosts that were removed, or entries left over from an earlier registration
+                if not target.active or target.due != due:
+                    continue
+                self.workers.submit(self.poll, target)
+
+    # Worker: fetch whatever is new from one host, queue it, and work out when to ask again
+    def poll(self, target):
+        if target is self.relay_target:
+            return self.poll_relay(target)
+        try:
+            if target.needs_backfill and target.last_seq is not None:
+                samples = self.backfill(target)
+            else:
+                headers = {"If-None-Match": target.etag} if target.etag else None
+                sent = time.time()
+                response = self.session.get(self.url(target.address, "/metrics"), headers=headers, timeout=target.timeout)
+                received = time.time()
+                response.raise_for_status()
+                if response.status_code == 304:
+                    samples = [] # The agent hasn't got a newer sample than the one we have
+                served = served_time(response)
+                offset = target.clock.update(sent, received, served) if served is not None else target.clock.offset
+                if response.status_code != 304:
+                    target.etag = response.headers.get("ETag")
+                    data = read_body(response, sample=True)
+                    # Nothing new since last time (collector stalled or polling faster than it samples)
+                    samples = [] if target.last_seq is not None and data.get("seq") == target.last_seq else [data]
+                    trace_samples(samples, served, received, offset)
+            self.deliver(target, samples)
+            delay = target.interval * random.uniform(1 - JITTER, 1 + JITTER)
+        except Exception as e:
+            target.failures += 1
+            target.needs_backfill = True
+            if target.active:
+                self.results.append((target.key, "error", e))
+            # Back off exponentially on a host that keeps failing
+            delay = min(MAX_BACKOFF, target.interval * 2 ** target.failures) * random.uniform(1, 1 + JITTER)
+
+        with self.wakeup:
+            # In relay mode hosts are only polled on their own to backfill, the relay batch brings the rest
+            if target.active and self.running and not self.relay:
+                # Keep to the host's own cadence rather than drifting by the time the request took
+                self._schedule(target, max(time.monotonic(), target.due + delay))
+
+    # Fill in what we missed while a host was unreachable, in one request to its history
+    def backfill(self, target):
+        response = self.session.get(self.url(target.address, "/metrics/history"), params={"since_seq": target.last_seq}, timeout=target.timeout)
+        response.raise_for_status()
+        return thin_samples(columns_to_samples(read_body(response)), target.interval, target.last_timestamp)
+
+    # Stream task: keep a host's stream open for as long as it's registered, reconnecting when it drops
+    async def follow_stream(self, target):
+        while target.active and self.running:
+            try:
+                if target.needs_backfill and target.last_seq is not None:
+                    samples = await self.loop.run_in_executor(self.workers, self.backfill, target)
+                    self.deliver(target, samples)
+                await self.read_stream(target)
+                continue # The agent ended the stream (it's shutting down), so try again straight away
+            except StreamUnavailable:
+                # An agent from before streaming, poll it like the rest
+                target.stream = None
+                with self.wakeup:
+                    if target.active and self.running:
+                        self._schedule(target, time.monotonic())
+                return
+            except (OSError, asyncio.TimeoutError, ValueError, IndexError) as e:
+                error = requests.exceptions.ConnectionError(f"Stream from {target.address} failed: {e!r}")
+            except Exception as e:
+                error = e
+            target.failures += 1
+            target.needs_backfill = True
+            if target.active:
+                self.results.append((target.key, "error", error))
+            # Back off exponentially on a host that keeps failing
+            await asyncio.sleep(min(MAX_BACKOFF, target.interval * 2 ** target.failures) * random.uniform(1, 1 + JITTER))
+
+    # Read one connection's worth of a host's stream, thinned by the agent to the host's interval and resuming
+    # after the newest sample we have. Returns when the agent closes it, raises if it fails or goes quiet.
+    async def read_stream(self, target):
+        url = urlsplit(f"http://{target.address}")
+        params = {"interval": target.interval}
+        if target.last_seq is not None:
+            params["since_seq"] = target.last_seq
+        sent = time.time()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(url.hostname, url.port), target.timeout)
+        try:
+            # HTTP/1.0, so the body comes as it is rather than in chunks, until the agent closes it
+            writer.write(f"GET /metrics/stream?{urlencode(params)} HTTP/1.0\r\nHost: {url.netloc}\r\n"
+                         f"Accept: text/event-stream\r\n\r\n".encode())
+            status = await asyncio.wait_for(reader.readline(), target.timeout)
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), target.timeout)
+                if not line.strip():
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            received = time.time()
+            code = int(status.split()[1])
+            if code == 404:
+                raise StreamUnavailable()
+            if code != 200:
+                raise requests.exceptions.HTTPError(f"{code} from http://{target.address}/metrics/stream")
+            served = parse_time(headers.get(SERVED_HEADER.lower()))
+            offset = target.clock.update(sent, received, served) if served is not None else target.clock.offset
+            target.failures = 0
+            target.needs_backfill = False
+
+            # Server-sent events: lines of "field: value", a blank line ending each event. The agent puts a
+            # ": served <time>" comment ahead of each sample, for tracing how long it took to get here.
+            data_lines = []
+            while True:
+                line = await asyncio.wait_for(reader.readline(), STREAM_READ_TIMEOUT)
+                if not line:
+                    return
+                line = line.decode().rstrip('\r\n')
+                if line.startswith(':'):
+                    if line.startswith(': served '):
+                        served = parse_time(line[9:])
+                    continue # Otherwise a keepalive
+                if line:
+                    field, _, value = line.partition(':')
+                    if field == 'data':
+                        data_lines.append(value.removeprefix(' '))
+                    continue
+                if not data_lines:
+                    continue
+                data = json.loads('\n'.join(data_lines))
+                data_lines = []
+                self.deliver(target, trace_samples([data], served, time.time(), offset))
+        finally:
+            writer.close()
+
+    # Queue new samples from a host that answered
+    def deliver(self, target, samples):
+        target.failures = 0
+        target.needs_backfill = False
+        if samples:
+            target.last_seq = samples[-1].get("seq", target.last_seq)
+            target.last_timestamp = samples[-1].get("timestamp", target.last_timestamp)
+            if target.active:
+                self.results.append((target.key, "samples", samples))
+
+    # Relay mode worker: one request for the newest sample of every registered host, handed out to each host
+    def poll_relay(self, relay_target):
+        with self.wakeup:
+            targets = list(self.targets.values())
+        params = {}
+        if len(targets) <= RELAY_FILTER_MAX:
+            params["hosts"] = ",".join(target.address for target in targets)
+        try:
+            sent = time.time()
+            response = self.session.get(f"http://{self.relay}/fleet/latest", params=params, timeout=relay_target.timeout)
+            received = time.time()
+            response.raise_for_status()
+            batch = read_body(response)
+            rows = {}
+            for row in columns_to_samples(batch):
+                row.update(row.pop("details", None) or {})
+                if isinstance(row.get("seq"), float):
+                    row["seq"] = int(row["seq"]) # Stored as a double when some hosts lack it
+                rows[row.pop("host")] = row
+            served = served_time(response)
+            offset = relay_target.clock.update(sent, received, served) if served is not None else relay_target.clock.offset
+            trace_samples(rows.values(), served, received, offset)
+            errors = batch.get("errors", {})
+            relay_target.failures = 0
+        except Exception as e:
+            relay_target.failures += 1
+            rows = {}
+            errors = {target.address: e for target in targets}
+
+        now = time.monotonic()
+        for target in targets:
+            sample = rows.get(target.address)
+            if sample is not None:
+                target.due = 0.0 # Report the next failure straight away
+                if target.needs_backfill and target.last_seq is not None:
+                    self.poll(target) # Get what we missed from the relay's copy of the host's history
+                elif target.last_seq is None or sample.get("seq") != target.last_seq:
+                    self.deliver(target, thin_samples([sample], target.interval, target.last_timestamp))
+            elif target.address in errors:
+                self.relay_error(target, errors[target.address], now)
+
+        interval = min((target.interval for target in targets), default=1.0)
+        if relay_target.failures:
+            delay = min(MAX_BACKOFF, interval * 2 ** relay_target.failures) * random.uniform(1, 1 + JITTER)
+        else:
+            delay = interval * random.uniform(1 - JITTER, 1 + JITTER)
+        with self.wakeup:
+            if self.running and self.targets:
+                self._schedule(relay_target, max(time.monotonic(), relay_target.due + delay))
+            else:
+                relay_target.active = False # Picked up again when a host is registered
+
+    # A host the relay can't reach. Reports are spaced out the same way failed polls back off.
+    def relay_error(self, target, error, now):
+        target.failures += 1
+        target.needs_backfill = True
+        if now < target.due:
+            return
+        target.due = now + min(MAX_BACKOFF, target.interval * 2 ** target.failures)
+        if not isinstance(error, Exception):
+            error = requests.exceptions.ConnectionError(error)
+        if target.active:
+            self.results.append((target.key, "error", error))
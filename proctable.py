@@ -0,0 +1,189 @@
+import heapq
+import os
+import time
+
+import psutil
+
+# Top processes by CPU, memory and disk IO, for the collector.
+#
+# The table is kept from one scan to the next. A process's name and user never change, so they're
+# looked up once, the first time its PID is seen (a PID reused by a new process is spotted by its
+# start time changing). After that each scan only reads the counters: on Linux one read of
+# /proc/<pid>/stat and /proc/<pid>/io per process, diffed against the previous scan. Scans are
+# spaced out so they never take more than a small share of the collector's time, however many
+# processes the host runs.
+
+PROC = '/proc'
+USE_PROC = os.path.exists('/proc/self/stat') and os.path.exists('/proc/self/io')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+MAX_TOP = 10 # Processes kept per ranking, so the sample still fits in a ring slot
+MAX_SCAN_SHARE = 0.05 # Scans are spaced out so they take at most this share of the time
+MAX_NAME_LENGTH = 40
+# The rankings, and the field of a process each one is ordered by
+RANKINGS = {'cpu': 'cpu_percent', 'memory': 'rss_bytes', 'io': 'io_bytes'}
+
+# Usernames by uid, shared by every process
+user_names = {}
+
+
+def user_name(uid):
+    if uid not in user_names:
+        try:
+            import pwd
+            user_names[uid] = pwd.getpwuid(uid).pw_name
+        except (ImportError, KeyError):
+            user_names[uid] = str(uid)
+    return user_names[uid]
+
+# A small /proc file in one read. Plain os.open/os.read cost well under half what open() does, which
+# adds up over thousands of processes.
+def read_small_file(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, 4096)
+    finally:
+        os.close(fd)
+
+# Start time, CPU seconds and RSS bytes of a process from /proc/<pid>/stat, plus its name
+def read_proc_stat(pid):
+    line = read_small_file(f'{PROC}/{pid}/stat')
+    # The name is in brackets and can hold spaces or brackets itself, the fields after it can't
+    name_start = line.index(b'(')
+    name_end = line.rindex(b')')
+    fields = line[name_end + 2:].split()
+    # fields[0] is field 3 (state) of proc(5), so field n is at n - 3
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    return int(fields[19]), cpu_seconds, int(fields[21]) * PAGE_SIZE, line[name_start + 1:name_end].decode(errors='replace')
+
+# Bytes read from and written to storage by a process, None if we aren't allowed to see them
+def read_proc_io(pid):
+    try:
+        fields = read_small_file(f'{PROC}/{pid}/io').split()
+    except PermissionError:
+        return None
+    # Pairs of "name:" and value, read_bytes and write_bytes are the ones that really reached storage
+    counters = dict(zip(fields[::2], fields[1::2]))
+    return int(counters[b'read_bytes:']) + int(counters[b'write_bytes:'])
+
+
+# What the table keeps about one process between scans
+class ProcessEntry:
+
+    def __init__(self, pid, started, name, user):
+        self.pid = pid
+        self.started = started
+        self.name = name[:MAX_NAME_LENGTH]
+        self.user = user
+        self.handle = None # psutil.Process, where /proc can't be read directly
+        self.io_readable = True # Set once reading its IO is refused, so it isn't tried every scan
+        self.cpu_seconds = None
+        self.io_total = None
+        self.cpu_percent = 0.0
+        self.rss_bytes = 0
+        self.io_bytes = 0
+
+    # Take in new counter readings, working out the rates since the last ones
+    def update(self, cpu_seconds, rss_bytes, io_total, elapsed):
+        if self.cpu_seconds is not None:
+            self.cpu_percent = round(max(0.0, cpu_seconds - self.cpu_seconds) * 100 / elapsed, 1)
+        if io_total is not None and self.io_total is not None:
+            self.io_bytes = round(max(0, io_total - self.io_total) / elapsed)
+        self.cpu_seconds = cpu_seconds
+        self.io_total = io_total
+        self.rss_bytes = rss_bytes
+
+    def summary(self):
+        return {
+            'pid': self.pid,
+            'name': self.name,
+            'user': self.user,
+            'cpu_percent': self.cpu_percent,
+            'rss_bytes': self.rss_bytes,
+            'io_bytes': self.io_bytes,
+        }
+
+
+class ProcessTable:
+
+    # top is how many processes to keep in each ranking, min_interval the least time between scans
+    def __init__(self, top, min_interval=0.0):
+        self.top = max(1, min(top, MAX_TOP))
+        self.min_interval = min_interval
+        self.entries = {}
+        self.last_time = None
+        self.next_scan = 0.0
+        self.last_cost = 0.0 # Seconds the last scan took
+        self.processes = []
+
+    # The top processes, scanning again if one is due. Between scans the last result is returned.
+    def latest(self):
+        now = time.monotonic()
+        if now >= self.next_scan:
+            self.scan()
+            # Whatever the scan cost, keep it to MAX_SCAN_SHARE of the time
+            self.next_scan = now + max(self.min_interval, self.last_cost / MAX_SCAN_SHARE)
+        return self.processes
+
+    def scan(self):
+        started = time.monotonic()
+        elapsed = started - self.last_time if self.last_time is not None else None
+        entries = {}
+        for pid in self.pids():
+            try:
+                entry = self.read(pid, elapsed)
+            except (FileNotFoundError, ProcessLookupError, psutil.NoSuchProcess):
+                continue # Exited while we were looking
+            except (OSError, ValueError, IndexError, KeyError, psutil.Error):
+                continue # Unreadable (zombie, no permission), skip it this time
+            entries[pid] = entry
+        self.entries = entries
+        self.last_time = started
+
+        # Each ranking's top processes, listed once however many rankings they're in
+        chosen = {}
+        for field in RANKINGS.values():
+            for entry in heapq.nlargest(self.top, entries.values(), key=lambda e: getattr(e, field)):
+                chosen[entry.pid] = entry
+        self.processes = [entry.summary() for entry in chosen.values()]
+        self.last_cost = time.monotonic() - started
+        return self.processes
+
+    def pids(self):
+        if USE_PROC:
+            return [int(name) for name in os.listdir(PROC) if name.isdigit()]
+        return psutil.pids()
+
+    # Read one process's counters, making its entry if the PID is new (or now belongs to another process)
+    def read(self, pid, elapsed):
+        entry = self.entries.get(pid)
+        if USE_PROC:
+            started, cpu_seconds, rss_bytes, name = read_proc_stat(pid)
+            if entry is None or entry.started != started:
+                entry = ProcessEntry(pid, started, name, user_name(os.stat(f'{PROC}/{pid}').st_uid))
+            entry.name = name # exec() renames a process without restarting it, so never keep an old name
+            io_total = read_proc_io(pid) if entry.io_readable else None
+        else:
+            # is_running() is False once the PID belongs to another process
+            if entry is None or not entry.handle.is_running():
+                handle = psutil.Process(pid)
+                with handle.oneshot():
+                    entry = ProcessEntry(pid, handle.create_time(), handle.name(), handle.username())
+                entry.handle = handle
+            with entry.handle.oneshot():
+                entry.name = entry.handle.name()
+                times = entry.handle.cpu_times()
+                cpu_seconds = times.user + times.system
+                rss_bytes = entry.handle.memory_info().rss
+                io_total = None
+                if entry.io_readable:
+                    try:
+                        io = entry.handle.io_counters()
+                        io_total = io.read_bytes + io.write_bytes
+                    except (AttributeError, psutil.AccessDenied):
+                        pass
+        if io_total is None:
+            entry.io_readable = False
+        # On the first scan every entry is new, so there's nothing to take a rate from and elapsed isn't needed
+        entry.update(cpu_seconds, rss_bytes, io_total, elapsed or 1.0)
+        return entry
@@ -0,0 +1,254 @@
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import make_server
+import argparse
+import atexit
+import threading
+import time
+
+from capture import CaptureWriter
+from history import MetricHistory
+from poller import AGENT_PORT, PollingEngine, host_address
+from wireformat import (JSON_MIME, SERVED_HEADER, choose_encoding, compact_json, compress, encode_body, encode_response,
+                        encode_sample, is_number, negotiate)
+
+# Relay that sits between many agents and many dashboards.
+#
+# The relay polls every agent it's given (with the same pooled polling engine the dashboard uses)
+# and keeps each host's recent history in memory. Dashboards poll the relay instead of the agents:
+# /fleet/latest has every host's newest sample in one response, and /hosts/<host>/metrics and
+# /hosts/<host>/metrics/history answer for a single host just like its agent would. However many
+# dashboards are open, each monitored machine only ever has the relay reading from it.
+
+# waitress is the production WSGI server served through (it's in requirements.txt), with werkzeug's
+# threaded server as the fallback where it can't be installed
+try:
+    import waitress
+except ImportError:
+    waitress = None
+
+DEFAULT_PORT = 5060
+DEFAULT_THREADS = 16 # waitress workers, so a burst of dashboards asking at once isn't queued behind 4
+DRAIN_INTERVAL = 0.05 # How often the polling engine's results are taken in
+MAX_HISTORY_SAMPLES = 3600 # Cap on samples returned by one history request
+
+app = Flask(__name__)
+
+
+# Everything the relay keeps about one agent
+class RelayedHost:
+
+    def __init__(self, address):
+        self.address = address
+        self.history = MetricHistory()
+        self.latest = None # Newest sample
+        self.bodies = {} # The newest sample's /metrics body in each format it has been asked for
+        self.error = None # Why the last poll failed, until one succeeds again
+
+
+hosts = {}
+hosts_lock = threading.Lock()
+engine = None
+capture = None # Capture file every sample is recorded in, with --record
+# The whole-fleet /fleet/latest bodies, rebuilt at most once per change however many dashboards ask
+fleet_cache = {"version": 0, "built": -1, "bodies": {}}
+
+# Start polling the agents. Each one is polled every interval seconds.
+def start(addresses, interval, workers):
+    global engine
+    engine = PollingEngine(max_workers=workers)
+    for address in map(host_address, addresses):
+        hosts[address] = RelayedHost(address)
+        engine.register(address, address, interval)
+    threading.Thread(target=follow_agents, daemon=True).start()
+
+# Take in everything the polling engine has fetched
+def follow_agents():
+    while True:
+        try:
+            results = engine.drain()
+            if results:
+                apply_results(results)
+        except Exception as e:
+            print(f"An error occurred while taking in samples: {e}")
+        time.sleep(DRAIN_INTERVAL)
+
+def apply_results(results):
+    with hosts_lock:
+        for address, kind, payload in results:
+            host = hosts.get(address)
+            if host is None:
+                continue
+            if kind == "samples":
+                received = time.time()
+                for sample in payload:
+                    if capture:
+                        capture.write(address, sample, received)
+                    seq = int(sample.get("seq", 0))
+                    # The agent's collector started counting again, so the history is from another run
+                    if seq < host.history.last_seq:
+                        host.history.clear()
+                    host.history.append(seq, sample)
+                host.latest = payload[-1]
+                host.bodies = {}
+                host.error = None
+            else:
+                host.error = str(payload)
+        fleet_cache["version"] += 1
+
+# The newest sample of each host as columns, one row per host. Hosts that can't be reached are listed in
+# "errors" instead. Everything in a sample that isn't a plain number goes in the row's "details".
+def fleet_columns(addresses):
+    rows = []
+    errors = {}
+    for address in addresses:
+        host = hosts.get(address)
+        if host is None:
+            errors[address] = "This host isn't being relayed"
+        elif host.error:
+            errors[address] = host.error
+        elif host.latest is not None:
+            rows.append(host)
+
+    names = {}
+    for host in rows:
+        for name, value in host.latest.items():
+            if is_number(value):
+                names[name] = True
+    columns = {"host": [host.address for host in rows]}
+    for name in names:
+        columns[name] = [host.latest.get(name) if is_number(host.latest.get(name)) else None for host in rows]
+    columns["details"] = [{name: value for name, value in host.latest.items() if name not in names} for host in rows]
+    columns["errors"] = errors
+    columns["count"] = len(rows)
+    return columns, len(rows)
+
+# Newest sample of every relayed host in one response. ?hosts=a:5050,b:5050 narrows it down to those hosts.
+@app.route('/fleet/latest', methods=['GET'])
+def get_fleet_latest():
+    try:
+        wanted = request.args.get('hosts')
+        with hosts_lock:
+            if wanted:
+                columns, rows = fleet_columns([host_address(h) for h in wanted.split(',') if h.strip()])
+                body, mimetype, headers = encode_response(columns, rows, request)
+                return Response(body, mimetype=mimetype, headers=headers)
+
+            if fleet_cache["built"] != fleet_cache["version"]:
+                fleet_cache["bodies"] = {}
+                fleet_cache["built"] = fleet_cache["version"]
+            bodies = fleet_cache["bodies"]
+            mimetype = negotiate(request)
+            if mimetype not in bodies:
+                bodies[mimetype] = encode_body(*fleet_columns(list(hosts)), mimetype)
+            body = bodies[mimetype]
+            encoding = choose_encoding(request, len(body))
+            headers = {"Vary": "Accept, Accept-Encoding"}
+            if encoding:
+                if (mimetype, encoding) not in bodies:
+                    bodies[mimetype, encoding] = compress(body, encoding)
+                body = bodies[mimetype, encoding]
+                headers["Content-Encoding"] = encoding
+        return Response(body, mimetype=mimetype, headers=headers)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Stamp every response with when it went out by our clock, so dashboards can tell how long samples sat here
+@app.after_request
+def stamp_served(response):
+    response.headers[SERVED_HEADER] = f"{time.time():.6f}"
+    return response
+
+def unknown_host(host):
+    return jsonify({"error": f"{host} isn't being relayed"}), 404
+
+# A single host's newest sample, the same as its agent's /metrics
+@app.route('/hosts/<path:host>/metrics', methods=['GET'])
+def get_host_metrics(host):
+    with hosts_lock:
+        relayed = hosts.get(host_address(host))
+        if relayed is None:
+            return unknown_host(host)
+        if relayed.latest is None:
+            return jsonify({"error": relayed.error or "No data from this host yet"}), 503
+        mimetype = negotiate(request)
+        if mimetype not in relayed.bodies:
+            relayed.bodies[mimetype] = compact_json(relayed.latest) if mimetype == JSON_MIME else encode_sample(relayed.latest)
+        body = relayed.bodies[mimetype]
+    return Response(body, mimetype=mimetype, headers={"Vary": "Accept"})
+
+# A single host's recent samples as columns, with the same parameters as the agent's /metrics/history
+@app.route('/hosts/<path:host>/metrics/history', methods=['GET'])
+def get_host_history(host):
+    relayed = hosts.get(host_address(host))
+    if relayed is None:
+        return unknown_host(host)
+    try:
+        limit = min(request.args.get('limit', MAX_HISTORY_SAMPLES, type=int), MAX_HISTORY_SAMPLES)
+        since_seq = request.args.get('since_seq', type=int)
+        since = request.args.get('since', type=float)
+        if since_seq is not None:
+            columns = relayed.history.since_seq(since_seq, limit)
+        else:
+            columns = relayed.history.since_time(since if since is not None else 0.0, limit)
+        columns["count"] = len(columns["seq"])
+        columns["head"] = relayed.history.last_seq
+        columns["oldest"] = relayed.history.first_timestamp
+        body, mimetype, headers = encode_response(columns, columns["count"], request)
+        return Response(body, mimetype=mimetype, headers=headers)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Long range history isn't kept by the relay, so it's passed through to the agent as asked for
+@app.route('/hosts/<path:host>/metrics/archive', methods=['GET'])
+def get_host_archive(host):
+    relayed = hosts.get(host_address(host))
+    if relayed is None:
+        return unknown_host(host)
+    try:
+        headers = {"Accept": request.headers.get("Accept", JSON_MIME)}
+        response = engine.session.get(f"http://{relayed.address}/metrics/archive", params=request.args, headers=headers, timeout=30)
+        return Response(response.content, status=response.status_code, content_type=response.headers.get("Content-Type"))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 502
+
+# Make the server the relay runs on: waitress if it's installed, otherwise werkzeug's threaded server, like the agent.
+# Returns the port it's listening on and the function that serves requests until the process ends.
+def create_server(host, port, threads=DEFAULT_THREADS):
+    if waitress is not None:
+        server = waitress.create_server(app, host=host, port=port, threads=threads)
+        return server.effective_port, server.run
+    server = make_server(host, port, app, threaded=True)
+    return server.server_port, server.serve_forever
+
+# Read the hosts to relay from a file with one per line (blank lines and # comments are skipped)
+def read_hosts_file(path):
+    with open(path) as f:
+        return [line.split('#', 1)[0].strip() for line in f if line.split('#', 1)[0].strip()]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Poll many agents and serve them to dashboards from one place")
+    parser.add_argument('hosts', nargs='*', help=f"Agents to relay, as host or host:port (port {AGENT_PORT} if left out)")
+    parser.add_argument('--hosts-file', help="File listing the agents to relay, one per line")
+    parser.add_argument('--interval', type=float, default=1.0, help="Seconds between polls of each agent")
+    parser.add_argument('--workers', type=int, default=32, help="Most agents polled at the same time")
+    parser.add_argument('--host', default='0.0.0.0', help="Address to listen on")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="Port to serve dashboards on")
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS, help="Worker threads with waitress")
+    parser.add_argument('--record', help="Capture file to keep every sample from every agent in, for replaying later")
+    args = parser.parse_args()
+
+    addresses = list(args.hosts)
+    if args.hosts_file:
+        addresses += read_hosts_file(args.hosts_file)
+    if not addresses:
+        parser.error("Give at least one agent to relay")
+    if args.record:
+        capture = CaptureWriter(args.record)
+        atexit.register(capture.close)
+    if args.threads < 1:
+        parser.error("--threads must be at least 1")
+    start(addresses, args.interval, args.workers)
+    port, serve = create_server(args.host, args.port, args.threads)
+    print(f"Relay serving on {args.host}:{port} with "
+          f"{f'waitress ({args.threads} threads)' if waitress else 'the threaded werkzeug server'}")
+    serve()
@@ -0,0 +1,153 @@
+import datetime
+import time
+import tkinter as tk
+from tkinter import ttk
+
+import numpy as np
+
+# Replay of a capture recorded with --record.
+#
+# Each host in the capture gets its own server tab, and samples are handed to the tabs through the
+# same handle_results/update_ui path that live polling uses, paced by the time they were first
+# received, at anything from 1x to 100x. Jumping refills every tab's graphs with the window before
+# the new position in one go, straight from the capture's columns, and carries on from there.
+
+REPLAY_TICK = 100 # Milliseconds between replay steps
+SPEEDS = {"1x": 1, "2x": 2, "5x": 5, "10x": 10, "25x": 25, "50x": 50, "100x": 100}
+GAP_INTERVALS = 3 # Sample intervals without a sample before the graphs show a gap
+INTERVAL_SAMPLE_ROWS = 1000 # Records looked at to work out each host's sample interval
+
+
+def format_time(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
+class ReplayBar(tk.Frame):
+
+    def __init__(self, parent, dashboard, reader, *args, **kwargs):
+        super().__init__(parent, *args, **kwargs)
+        self.dashboard = dashboard
+        self.reader = reader
+        self.configure(bg="#2E2E2E")
+        self.start, self.end = reader.span()
+        self.clock = self.start
+        self.cursor = 0 # Next record to hand out
+        self.playing = False
+        self.speed = tk.StringVar(value="1x")
+        self.jump_text = tk.StringVar()
+
+        self.play_button = tk.Button(self, text="▶ Play", width=8, command=self.toggle_play)
+        self.play_button.pack(side="left")
+        ttk.Combobox(self, textvariable=self.speed, values=list(SPEEDS), state="readonly", width=5).pack(side="left", padx=5)
+        self.slider = tk.Scale(self, from_=0, to=max(1.0, self.end - self.start), orient="horizontal", showvalue=False,
+                               resolution=1, bg=self["bg"], fg="#FFFFFF", highlightthickness=0)
+        self.slider.pack(side="left", fill="x", expand=True, padx=5)
+        # Jump once the slider is let go of, not on every pixel it's dragged through
+        self.slider.bind("<ButtonRelease-1>", lambda event: self.jump(self.start + self.slider.get()))
+        entry = tk.Entry(self, textvariable=self.jump_text, width=9)
+        entry.pack(side="left")
+        entry.bind("<Return>", self.jump_to_entry)
+        tk.Button(self, text="Go to", command=self.jump_to_entry).pack(side="left", padx=(2, 5))
+        self.time_label = tk.Label(self, bg=self["bg"], fg="#FFFFFF", width=19, anchor="e")
+        self.time_label.pack(side="left")
+
+        self.tabs = {}
+        self.make_tabs()
+        self.show_position()
+        self.tick_job_id = self.after(REPLAY_TICK, self.tick)
+
+    # One tab per host in the capture, fed by the replay instead of polling
+    def make_tabs(self):
+        intervals = self.host_intervals()
+        for host in self.reader.hosts:
+            self.dashboard.add_server_tab()
+            tab = self.dashboard.tabs[-1]
+            tab.server_ip.set(host)
+            tab.monitoring = True
+            tab.toggle_button.config(text="Replaying", state="disabled")
+            if host in intervals:
+                tab.max_gap = intervals[host] * GAP_INTERVALS
+            self.tabs[host] = tab
+        self.dashboard.update_status(f"Replaying {len(self.reader)} samples from {len(self.tabs)} servers, "
+                                     f"{format_time(self.start)} to {format_time(self.end)}.")
+
+    # Each host's usual time between samples, from the start of the capture
+    def host_intervals(self):
+        intervals = {}
+        for host, columns in self.reader.host_columns(0, INTERVAL_SAMPLE_ROWS * max(1, len(self.reader.hosts))).items():
+            steps = np.diff(columns['timestamp'])
+            if len(steps):
+                intervals[host] = float(np.median(steps))
+        return intervals
+
+    def toggle_play(self):
+        if self.cursor >= len(self.reader):
+            self.jump(self.start) # Played to the end, so start again
+        self.playing = not self.playing
+        self.play_button.config(text="❚❚ Pause" if self.playing else "▶ Play")
+
+    def tick(self):
+        self.tick_job_id = self.after(REPLAY_TICK, self.tick)
+        if not self.playing:
+            return
+        self.clock += REPLAY_TICK / 1000 * SPEEDS.get(self.speed.get(), 1)
+        position = self.reader.position(self.clock)
+        self.deliver(self.cursor, position)
+        self.cursor = position
+        if self.cursor >= len(self.reader):
+            self.toggle_play()
+        self.show_position()
+
+    # Hand records [first, last) to their tabs, in one batch per tab
+    def deliver(self, first, last):
+        batches = {}
+        for host, sample in self.reader.samples(first, last):
+            tab = self.tabs.get(host)
+            if tab is not None:
+                batches.setdefault(tab, []).append(sample)
+        for tab, samples in batches.items():
+            tab.handle_results([("samples", samples)])
+
+    # Carry on from the given time, with every tab's graphs showing what came before it
+    def jump(self, timestamp):
+        self.clock = min(max(timestamp, self.start), self.end)
+        self.cursor = self.reader.position(self.clock)
+        longest = max((tab.window_seconds() for tab in self.tabs.values()), default=0)
+        before = self.reader.host_columns(self.reader.position(self.clock - longest), self.cursor)
+        for host, tab in self.tabs.items():
+            tab.series.clear()
+            columns = before.get(host)
+            if columns is not None:
+                tab.series.prepend(columns, len(columns['timestamp']))
+                tab.show_values({name: float(values[-1]) for name, values in columns.items()})
+            tab.decimated = None
+            tab.go_live()
+        self.show_position()
+
+    # Jump to the time typed in, e.g. 14:05 or 14:05:30 on the day the capture started
+    def jump_to_entry(self, event=None):
+        text = self.jump_text.get().strip()
+        for pattern in ('%H:%M:%S', '%H:%M'):
+            try:
+                parsed = datetime.datetime.strptime(text, pattern).time()
+                break
+            except ValueError:
+                continue
+        else:
+            self.dashboard.update_status(f"Couldn't read {text!r} as a time, use HH:MM or HH:MM:SS.")
+            return
+        day = datetime.datetime.fromtimestamp(self.start).date()
+        target = datetime.datetime.combine(day, parsed).timestamp()
+        if target < self.start:
+            target += 86400 # Past midnight in a capture that runs over into the next day
+        self.jump(target)
+
+    def show_position(self):
+        self.slider.set(self.clock - self.start)
+        self.time_label.config(text=format_time(self.clock))
+
+    def stop(self):
+        self.playing = False
+        if self.tick_job_id:
+            self.after_cancel(self.tick_job_id)
+            self.tick_job_id = None
@@ -0,0 +1,214 @@
+import os
+import time
+
+import psutil
+
+# Sampling engine for the collector.
+#
+# On Linux the raw counters are read in bulk straight from /proc (one read each of /proc/stat,
+# /proc/diskstats and /proc/net/dev per sample), everywhere else they come from psutil. Every rate
+# is the counter delta divided by the time that really passed between the two readings on the
+# monotonic clock, so a late or early tick doesn't skew the numbers.
+
+PROC_STAT = '/proc/stat'
+PROC_DISKSTATS = '/proc/diskstats'
+PROC_NET_DEV = '/proc/net/dev'
+SECTOR_SIZE = 512 # /proc/diskstats always counts in 512 byte sectors
+MIN_PERIOD = 0.1
+# Virtual block devices that only add noise (and bulk up every sample)
+IGNORED_DISK_PREFIXES = ('loop', 'ram')
+# Virtual network interfaces (loopback, container and VM plumbing), left out of the per-interface rates since a
+# container host can have hundreds of them. Their traffic still counts towards the totals.
+IGNORED_NIC_PREFIXES = ('lo', 'veth', 'docker', 'br-', 'virbr', 'vnet', 'tap', 'cali', 'flannel', 'cni')
+MAX_DEVICES = 32 # Busiest disks and interfaces listed in each sample, so samples stay well inside a ring slot
+
+# Adaptive sampling: how close to an alert threshold counts as approaching it, and what counts as a sharp change.
+# A change is sharp when it moves a metric by SHARP_CHANGE of its last value, or of its floor here if that's bigger.
+APPROACH = 0.85
+SHARP_CHANGE = 0.5
+CHANGE_FLOORS = {'cpu_percent': 20.0, 'memory_percent': 20.0, 'load_avg': 1.0, 'disk_io_bytes': 1048576, 'net_io_bytes': 1048576}
+BURST_HOLD = 30.0 # Seconds sampling stays fast after the last sign of activity
+BACKOFF = 2.0 # Once quiet, the period grows by this much with each sample until it reaches the slowest
+
+USE_PROC = os.path.exists(PROC_STAT) and os.path.exists(PROC_DISKSTATS) and os.path.exists(PROC_NET_DEV)
+# Whether each device in /proc/diskstats is a whole disk, so /sys/block is only checked once per device
+whole_disk_cache = {}
+
+
+# CPU jiffies as {"cpu": (busy, total), "cpu0": (busy, total), ...}
+def read_cpu_times():
+    times = {}
+    if USE_PROC:
+        with open(PROC_STAT, 'rb') as f:
+            for line in f:
+                if not line.startswith(b'cpu'):
+                    break # The cpu lines always come first
+                fields = line.split()
+                # user nice system idle iowait irq softirq steal (guest time is already counted in user)
+                values = [int(v) for v in fields[1:9]]
+                total = sum(values)
+                times[fields[0].decode()] = (total - values[3] - values[4], total)
+        return times
+    for name, cpu in [('cpu', psutil.cpu_times())] + [(f'cpu{i}', c) for i, c in enumerate(psutil.cpu_times(percpu=True))]:
+        total = sum(cpu)
+        idle = cpu.idle + getattr(cpu, 'iowait', 0.0)
+        times[name] = (total - idle, total)
+    return times
+
+# Whole-disk byte counters as {"sda": (read_bytes, write_bytes), ...}
+def read_disk_counters():
+    counters = {}
+    if USE_PROC:
+        with open(PROC_DISKSTATS, 'rb') as f:
+            for line in f:
+                fields = line.split()
+                name = fields[2].decode()
+                if name.startswith(IGNORED_DISK_PREFIXES):
+                    continue
+                # Partitions are left out so they aren't counted twice (whole disks are listed in /sys/block)
+                if name not in whole_disk_cache:
+                    whole_disk_cache[name] = os.path.exists(f'/sys/block/{name}')
+                if not whole_disk_cache[name]:
+                    continue
+                counters[name] = (int(fields[5]) * SECTOR_SIZE, int(fields[9]) * SECTOR_SIZE)
+        return counters
+    for name, disk in (psutil.disk_io_counters(perdisk=True) or {}).items():
+        if not name.startswith(IGNORED_DISK_PREFIXES):
+            counters[name] = (disk.read_bytes, disk.write_bytes)
+    return counters
+
+# Per-interface byte counters as {"eth0": (recv_bytes, sent_bytes), ...}
+def read_net_counters():
+    counters = {}
+    if USE_PROC:
+        with open(PROC_NET_DEV, 'rb') as f:
+            for line in f.readlines()[2:]: # Skip the two header lines
+                name, _, data = line.partition(b':')
+                fields = data.split()
+                counters[name.strip().decode()] = (int(fields[0]), int(fields[8]))
+        return counters
+    for name, nic in psutil.net_io_counters(pernic=True).items():
+        counters[name] = (nic.bytes_recv, nic.bytes_sent)
+    return counters
+
+# Busy percentage between two readings of the CPU times
+def busy_percent(before, after):
+    busy = after[0] - before[0]
+    total = after[1] - before[1]
+    if total <= 0:
+        return 0.0
+    return round(min(100.0, max(0.0, 100.0 * busy / total)), 1)
+
+# Per-second rate of each pair of counters between two readings. Devices that appeared in between are skipped.
+def counter_rates(before, after, elapsed):
+    rates = {}
+    for name, (first, second) in after.items():
+        if name not in before:
+            continue
+        old_first, old_second = before[name]
+        # Counters can go backwards if a device is reset, treat that as no traffic
+        rates[name] = (max(0, first - old_first) / elapsed, max(0, second - old_second) / elapsed)
+    return rates
+
+# The busiest MAX_DEVICES of a device map from counter_rates, as the {name: {field: rate}} listed in a sample
+def busiest_devices(rates, fields):
+    busiest = sorted(rates.items(), key=lambda item: item[1][0] + item[1][1], reverse=True)[:MAX_DEVICES]
+    return {name: {fields[0]: round(first), fields[1]: round(second)} for name, (first, second) in busiest}
+
+
+class Sampler:
+
+    def __init__(self):
+        self.last_time = time.monotonic()
+        self.last_cpu = read_cpu_times()
+        self.last_disk = read_disk_counters()
+        self.last_net = read_net_counters()
+
+    # Take a sample covering everything since the previous one
+    def sample(self):
+        now = time.monotonic()
+        cpu = read_cpu_times()
+        disk = read_disk_counters()
+        net = read_net_counters()
+        elapsed = max(now - self.last_time, 1e-6)
+
+        per_cpu = [busy_percent(self.last_cpu[name], cpu[name]) for name in cpu if name != 'cpu' and name in self.last_cpu]
+        disk_rates = counter_rates(self.last_disk, disk, elapsed)
+        net_rates = counter_rates(self.last_net, net, elapsed)
+        disk_read = sum(r for r, _ in disk_rates.values())
+        disk_write = sum(w for _, w in disk_rates.values())
+        net_recv = sum(r for r, _ in net_rates.values())
+        net_sent = sum(s for _, s in net_rates.values())
+
+        metrics = {
+            'timestamp': time.time(),
+            'interval': round(elapsed, 4), # How much time this sample really covers
+            'cpu_percent': busy_percent(self.last_cpu['cpu'], cpu['cpu']),
+            'memory_percent': psutil.virtual_memory().percent,
+            'disk_io_bytes': round(disk_read + disk_write),
+            'net_io_bytes': round(net_recv + net_sent),
+            'load_avg': psutil.getloadavg()[0], # 1-minute average
+            'disk_read_bytes': round(disk_read),
+            'disk_write_bytes': round(disk_write),
+            'net_recv_bytes': round(net_recv),
+            'net_sent_bytes': round(net_sent),
+            'per_cpu': per_cpu,
+            'disks': busiest_devices(disk_rates, ('read_bytes', 'write_bytes')),
+            'nics': busiest_devices({name: rates for name, rates in net_rates.items() if not name.startswith(IGNORED_NIC_PREFIXES)},
+                                    ('recv_bytes', 'sent_bytes')),
+        }
+
+        self.last_time = now
+        self.last_cpu = cpu
+        self.last_disk = disk
+        self.last_net = net
+        return metrics
+
+
+# Picks the collector's sampling period as it goes: the fastest while metrics are changing sharply or
+# getting close to an alert threshold, easing off through the normal period towards the slowest
+# while they're flat.
+class AdaptivePeriod:
+
+    # rules are the alert rules whose thresholds to watch (rate rules are left out, a single sample says nothing about them)
+    def __init__(self, period, fastest, slowest, rules=()):
+        self.normal = period
+        self.fastest = min(fastest, period)
+        self.slowest = max(slowest, period)
+        self.period = period
+        self.thresholds = [(rule.metric, rule.op, rule.threshold) for rule in rules if rule.aggregate != 'rate']
+        self.last = {}
+        self.busy_until = 0.0
+        self.reason = None # Why sampling last went fast
+
+    # What's going on in a sample that's worth a closer look, or None if nothing is
+    def activity(self, metrics):
+        reason = None
+        for metric, op, threshold in self.thresholds:
+            value = metrics.get(metric)
+            if not isinstance(value, (int, float)):
+                continue
+            if op in ('>', '>=') and value >= threshold * APPROACH or op in ('<', '<=') and value <= threshold / APPROACH:
+                reason = f"{metric} near {threshold:g}"
+                break
+        for metric, floor in CHANGE_FLOORS.items():
+            value = metrics.get(metric)
+            if value is None:
+                continue
+            last = self.last.get(metric)
+            if reason is None and last is not None and abs(value - last) >= SHARP_CHANGE * max(abs(last), floor):
+                reason = f"{metric} jumped from {last:g} to {value:g}"
+            self.last[metric] = value
+        return reason
+
+    # Work out the period until the next sample from the one just taken (at now on the monotonic clock)
+    def update(self, metrics, now):
+        reason = self.activity(metrics)
+        if reason:
+            self.reason = reason
+            self.period = self.fastest
+            self.busy_until = now + BURST_HOLD
+        elif now >= self.busy_until:
+            # Quiet for long enough, so ease off a step at a time towards the slowest
+            self.period = min(self.slowest, self.period * BACKOFF)
+        return self.period
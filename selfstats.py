@@ -0,0 +1,181 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+import psutil
+
+from shmring import RING_PATH
+
+# The monitor's own instrumentation.
+#
+# Counters, gauges and latency histograms cheap enough to update on every sample and request: a
+# histogram is a fixed set of buckets, so recording a value is a binary search and an increment.
+# Snapshots carry the process's own RSS and CPU use alongside them, and can be rendered as JSON or
+# in the Prometheus text format. The collector has no server of its own, so it writes its snapshot
+# next to the ring every few seconds and the agent serves both.
+
+# Upper bounds of the histogram buckets, in seconds (50 microseconds to 10 seconds)
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COLLECTOR_STATS_PATH = os.path.join(os.path.dirname(RING_PATH), 'metrics_collector_stats.json')
+COLLECTOR_STATS_INTERVAL = 10 # Seconds between the collector's snapshots
+
+
+# Labels as the text that follows a Prometheus metric name, e.g. {endpoint="/metrics"}
+def label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in sorted(labels.items())) + '}'
+
+# Estimate a quantile from cumulative bucket counts. None if there's nothing yet, or if the quantile is
+# past the top bucket, where the buckets can't say how far (the histogram's max is the best bound then).
+def bucket_quantile(counts, total, fraction):
+    if not total:
+        return None
+    target = fraction * total
+    for bound, count in zip(BUCKETS, counts):
+        if count >= target:
+            return bound
+    return None
+
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1) # The last one catches anything over the top bucket
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        cumulative = []
+        running = 0
+        for count in self.counts[:-1]:
+            running += count
+            cumulative.append(running)
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "max": self.max,
+            "p50": bucket_quantile(cumulative, self.count, 0.5),
+            "p90": bucket_quantile(cumulative, self.count, 0.9),
+            "p99": bucket_quantile(cumulative, self.count, 0.99),
+            "buckets": cumulative,
+        }
+
+
+class Stats:
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.process = psutil.Process()
+        self.started = time.time()
+        # CPU used before this point (interpreter startup and imports) is left out of the average
+        self.started_cpu = self.cpu_seconds()
+        self.last_cpu = (time.monotonic(), self.started_cpu)
+
+    def count(self, name, value=1, **labels):
+        key = name + label_text(labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[name + label_text(labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        key = name + label_text(labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def cpu_seconds(self):
+        times = self.process.cpu_times()
+        return times.user + times.system
+
+    # The process's own footprint. cpu_percent is the share of one core used since the last snapshot,
+    # cpu_percent_average the share used since the stats were started.
+    def process_stats(self):
+        now = time.monotonic()
+        cpu = self.cpu_seconds()
+        last_time, last_cpu = self.last_cpu
+        self.last_cpu = (now, cpu)
+        uptime = time.time() - self.started
+        return {
+            "pid": self.process.pid,
+            "uptime_seconds": round(uptime, 1),
+            "rss_bytes": self.process.memory_info().rss,
+            "threads": self.process.num_threads(),
+            "cpu_seconds": round(cpu, 3),
+            "cpu_percent": round(100 * (cpu - last_cpu) / max(now - last_time, 1e-9), 3),
+            "cpu_percent_average": round(100 * (cpu - self.started_cpu) / max(uptime, 1e-9), 3),
+        }
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {key: histogram.snapshot() for key, histogram in self.histograms.items()}
+        return {
+            "name": self.name,
+            "time": time.time(),
+            "process": self.process_stats(),
+            "counters": counters,
+            "gauges": gauges,
+            "histograms": histograms,
+        }
+
+    # Write a snapshot where another process can read it, swapping the file in whole
+    def publish(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f, separators=(',', ':'))
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+
+
+# Read a snapshot another process published. stale is set once it's well past when the next one was due.
+def read_published(path, interval=COLLECTOR_STATS_INTERVAL):
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    snapshot["stale"] = time.time() - snapshot.get("time", 0) > interval * 3
+    return snapshot
+
+# Render snapshots in the Prometheus text exposition format, every metric prefixed with spm_<name>_
+def prometheus_text(snapshots):
+    lines = []
+    for snapshot in snapshots:
+        prefix = f"spm_{snapshot['name']}_"
+        for key, value in snapshot["process"].items():
+            if key != "pid":
+                lines.append(f"{prefix}process_{key} {value}")
+        for key, value in sorted({**snapshot["counters"], **snapshot["gauges"]}.items()):
+            lines.append(f"{prefix}{key} {value}")
+        for key, histogram in sorted(snapshot["histograms"].items()):
+            name, _, labels = key.partition('{')
+            labels = labels.rstrip('}')
+            joiner = ',' if labels else ''
+            for bound, count in zip(BUCKETS, histogram["buckets"]):
+                lines.append(f'{prefix}{name}_bucket{{{labels}{joiner}le="{bound}"}} {count}')
+            lines.append(f'{prefix}{name}_bucket{{{labels}{joiner}le="+Inf"}} {histogram["count"]}')
+            suffix = f"{{{labels}}}" if labels else ''
+            lines.append(f"{prefix}{name}_sum{suffix} {histogram['sum']}")
+            lines.append(f"{prefix}{name}_count{suffix} {histogram['count']}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,108 @@
+import math
+
+import numpy as np
+
+# Fixed-size numeric history of one server, for the dashboard.
+#
+# Every column (the timestamp first, then one per metric) is a row of one float64 NumPy array, so
+# memory is capped at capacity x columns x 16 bytes however long the dashboard runs (and the pages
+# are only touched as they fill, so a tab that has only run for a minute costs next to nothing). The
+# array holds twice the capacity: samples are appended at the end, and when it fills up the newest
+# capacity's worth are moved back to the start in one copy. That keeps everything held contiguous,
+# so any window is a plain slice (a view, nothing copied) that can go straight to NumPy or
+# matplotlib. Missing samples are NaN, which breaks the graph lines instead of drawing across the gap.
+
+DEFAULT_CAPACITY = 86400 # A day at one sample a second, at most about 8 MB for six columns
+
+
+class SeriesBuffer:
+
+    # columns are the names of the columns, the first one is the timestamp
+    def __init__(self, columns, capacity=DEFAULT_CAPACITY):
+        self.columns = tuple(columns)
+        self.index = {name: i for i, name in enumerate(self.columns)}
+        self.capacity = capacity
+        self.data = np.empty((len(self.columns), capacity * 2))
+        self.start = 0 # Oldest sample held
+        self.end = 0 # One past the newest
+
+    def __len__(self):
+        return self.end - self.start
+
+    # A view of one column, oldest first. Views are only good until the next append.
+    def column(self, name):
+        return self.data[self.index[name], self.start:self.end]
+
+    def __getitem__(self, name):
+        return self.column(name)
+
+    @property
+    def timestamps(self):
+        return self.data[0, self.start:self.end]
+
+    # Newest value of a column, NaN if there isn't one
+    def latest(self, name):
+        return self.data[self.index[name], self.end - 1] if self.end > self.start else math.nan
+
+    # Make room for one more sample at the end
+    def make_room(self):
+        if self.end == self.data.shape[1]:
+            keep = min(len(self), self.capacity - 1)
+            self.data[:, :keep] = self.data[:, self.end - keep:self.end]
+            self.start, self.end = 0, keep
+        elif len(self) == self.capacity:
+            self.start += 1 # Full, so the oldest sample goes
+
+    # Add a sample, a dict of values (anything missing or None is NaN). If max_gap is given and the sample
+    # comes more than max_gap seconds after the last one, a NaN row goes in between to break the lines.
+    def append(self, sample, timestamp, max_gap=None):
+        if max_gap is not None and self.end > self.start and timestamp - self.data[0, self.end - 1] > max_gap:
+            self.append_gap(self.data[0, self.end - 1] + max_gap)
+        self.make_room()
+        row = self.data[:, self.end]
+        row[0] = timestamp
+        for i in range(1, len(self.columns)):
+            value = sample.get(self.columns[i])
+            row[i] = math.nan if value is None else value
+        self.end += 1
+
+    # Mark a gap at timestamp, so the lines stop there rather than joining across it
+    def append_gap(self, timestamp):
+        self.make_room()
+        self.data[:, self.end] = math.nan
+        self.data[0, self.end] = timestamp
+        self.end += 1
+
+    # Put older samples in front of the ones held: the first count values of each column in columns (a dict
+    # of sequences by name, anything missing is NaN). If they don't all fit, the oldest are left out.
+    def prepend(self, columns, count):
+        taken = min(count, self.capacity - len(self))
+        if taken <= 0:
+            return
+        skipped = count - taken
+        count = taken
+        held = len(self)
+        if self.start < count:
+            # Not enough room in front, move what's held up to make some
+            self.data[:, count:count + held] = self.data[:, self.start:self.end]
+            self.start, self.end = count, count + held
+        front = self.data[:, self.start - count:self.start]
+        for i, name in enumerate(self.columns):
+            values = columns.get(name)
+            if values is None:
+                front[i] = math.nan
+            else:
+                front[i] = np.array(values[skipped:skipped + count], dtype=float) # None becomes NaN
+        self.start -= count
+
+    # Drop everything older than timestamp
+    def trim_before(self, timestamp):
+        self.start += int(np.searchsorted(self.timestamps, timestamp))
+
+    def clear(self):
+        self.start = self.end = 0
+
+    # Bytes held for this server, used or not
+    @property
+    def nbytes(self):
+        return self.data.nbytes
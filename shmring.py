@@ -0,0 +1,207 @@
+import mmap
+import os
+import struct
+import time
+
+# Shared-memory ring buffer used to hand samples from collector.py to agent.py.
+#
+# The file is a fixed header followed by a fixed number of fixed-size slots. The collector
+# is the only writer and never blocks, it just overwrites the oldest slot. Every slot is
+# guarded by its own seqlock counter (odd while being written, even when stable), so any
+# number of readers in any number of processes can pull the latest samples straight out
+# of the mapping without a syscall and without taking samples away from each other.
+
+# Prefer tmpfs so the ring never touches the disk
+RING_PATH = '/dev/shm/metrics_ring' if os.path.isdir('/dev/shm') else '/tmp/metrics_ring'
+DEFAULT_SLOT_COUNT = 512
+DEFAULT_SLOT_SIZE = 8192
+
+MAGIC = b'SPMRING1'
+# magic, slot count, slot size, epoch (bumped each time a collector attaches), head sequence number
+HEADER = struct.Struct('<8sIIIxxxxQ')
+HEADER_SIZE = 64
+HEAD_OFFSET = 24
+# seqlock counter, sample sequence number, sample timestamp, payload length
+SLOT_HEADER = struct.Struct('<QQdI')
+SLOT_HEADER_SIZE = 32
+LOCK = struct.Struct('<Q')
+
+# How many times a reader retries a slot the writer is in the middle of updating
+READ_RETRIES = 100
+# How long the head can stay still before a reader checks if the ring file was replaced
+STALE_AFTER = 5.0
+
+
+# The collector side of the ring. Only one writer may be attached at a time.
+class RingWriter:
+
+    def __init__(self, path=RING_PATH, slot_count=DEFAULT_SLOT_COUNT, slot_size=DEFAULT_SLOT_SIZE):
+        self.path = path
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.max_payload = slot_size - SLOT_HEADER_SIZE
+        self.size = HEADER_SIZE + slot_count * slot_size
+
+        # Reuse an existing ring with the same layout so attached readers keep working and
+        # sequence numbers keep counting up across collector restarts.
+        epoch, head = self._existing_header()
+        if epoch is None:
+            self._create()
+            epoch, head = 0, 0
+
+        self._file = open(self.path, 'r+b')
+        self._mm = mmap.mmap(self._file.fileno(), self.size)
+        self.epoch = epoch + 1
+        self.seq = head
+        HEADER.pack_into(self._mm, 0, MAGIC, slot_count, slot_size, self.epoch, head)
+
+    # Return (epoch, head) of a compatible ring already on disk, or (None, None)
+    def _existing_header(self):
+        try:
+            with open(self.path, 'rb') as f:
+                raw = f.read(HEADER.size)
+                f.seek(0, os.SEEK_END)
+                size = f.tell()
+        except FileNotFoundError:
+            return None, None
+        if len(raw) < HEADER.size or size != self.size:
+            return None, None
+        magic, slot_count, slot_size, epoch, head = HEADER.unpack(raw)
+        if magic != MAGIC or slot_count != self.slot_count or slot_size != self.slot_size:
+            return None, None
+        return epoch, head
+
+    # Build the ring in a temporary file and rename it into place, so a reader never maps a half-made ring
+    def _create(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.truncate(self.size)
+            f.write(HEADER.pack(MAGIC, self.slot_count, self.slot_size, 0, 0))
+        # Readable by the agent, which may run as a different user
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, self.path)
+
+    # Publish one encoded sample and return its sequence number
+    def write(self, payload, timestamp=None):
+        if len(payload) > self.max_payload:
+            raise ValueError(f"Sample of {len(payload)} bytes does not fit in a {self.max_payload} byte slot")
+        if timestamp is None:
+            timestamp = time.time()
+
+        seq = self.seq + 1
+        offset = HEADER_SIZE + (seq % self.slot_count) * self.slot_size
+        lock = LOCK.unpack_from(self._mm, offset)[0] | 1
+        # Odd counter tells readers the slot is being rewritten
+        LOCK.pack_into(self._mm, offset, lock)
+        SLOT_HEADER.pack_into(self._mm, offset, lock, seq, timestamp, len(payload))
+        start = offset + SLOT_HEADER_SIZE
+        self._mm[start:start + len(payload)] = payload
+        # Back to even, the slot is stable again
+        LOCK.pack_into(self._mm, offset, lock + 1)
+        LOCK.pack_into(self._mm, HEAD_OFFSET, seq)
+        self.seq = seq
+        return seq
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._file.close()
+            self._mm = None
+
+
+# The agent side of the ring. Readers never modify the mapping, so there can be as many as needed.
+class RingReader:
+
+    def __init__(self, path=RING_PATH):
+        self.path = path
+        self._mm = None
+        self._inode = None
+        self._last_head = None
+        self._last_change = 0.0
+
+    # Map the ring file. Raises FileNotFoundError if the collector hasn't created it yet.
+    def _attach(self):
+        with open(self.path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size < HEADER_SIZE:
+                raise FileNotFoundError(f"Metrics ring at {self.path} is not initialised")
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, slot_count, slot_size, _, _ = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC:
+            mm.close()
+            raise FileNotFoundError(f"{self.path} is not a metrics ring")
+        self.close()
+        self._mm = mm
+        self._inode = stat.st_ino
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self._last_head = None
+
+    # If the head hasn't moved for a while the collector may have rebuilt the ring with a new layout,
+    # so check the file on disk is still the one we have mapped.
+    def _check_stale(self, head):
+        now = time.monotonic()
+        if head != self._last_head:
+            self._last_head = head
+            self._last_change = now
+            return False
+        if now - self._last_change < STALE_AFTER:
+            return False
+        self._last_change = now
+        try:
+            replaced = os.stat(self.path).st_ino != self._inode
+        except FileNotFoundError:
+            return False
+        if replaced:
+            self._attach()
+        return replaced
+
+    # Sequence number of the newest sample in the ring (0 if nothing has been written yet)
+    def head(self):
+        if self._mm is None:
+            self._attach()
+        head = LOCK.unpack_from(self._mm, HEAD_OFFSET)[0]
+        if self._check_stale(head):
+            head = LOCK.unpack_from(self._mm, HEAD_OFFSET)[0]
+        return head
+
+    # Read a single sample as (seq, timestamp, payload bytes), or None if it was overwritten or not written yet
+    def read(self, seq):
+        if self._mm is None:
+            self._attach()
+        offset = HEADER_SIZE + (seq % self.slot_count) * self.slot_size
+        start = offset + SLOT_HEADER_SIZE
+        for _ in range(READ_RETRIES):
+            lock, slot_seq, timestamp, length = SLOT_HEADER.unpack_from(self._mm, offset)
+            if lock & 1:
+                continue
+            if slot_seq != seq:
+                return None
+            payload = self._mm[start:start + length]
+            # Only trust the copy if the writer didn't touch the slot while we were reading it
+            if LOCK.unpack_from(self._mm, offset)[0] == lock:
+                return seq, timestamp, payload
+        return None
+
+    # Up to n of the newest samples, oldest first
+    def latest(self, n=1):
+        head = self.head()
+        return self.since(max(0, head - n), head)
+
+    # Every sample still in the ring with a sequence number greater than seq, oldest first
+    def since(self, seq, head=None):
+        if head is None:
+            head = self.head()
+        # Stay one slot clear of the writer so we don't chase a slot it is about to overwrite
+        first = max(seq + 1, head - self.slot_count + 2, 1)
+        samples = []
+        for s in range(first, head + 1):
+            sample = self.read(s)
+            if sample is not None:
+                samples.append(sample)
+        return samples
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
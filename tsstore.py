@@ -0,0 +1,388 @@
+import mmap
+import math
+import os
+import struct
+import threading
+import time
+
+from history import COLUMNS
+
+# Persistent, compressed time-series store for the collector's samples.
+#
+# Samples are kept in three tiers: every raw sample, 1 minute rollups and 1 hour rollups (min, max
+# and average of each metric). The rollups are built incrementally as samples come in, so a query
+# over days or weeks reads a few hundred rollup rows instead of scanning raw samples.
+#
+# Each tier is split into segment files covering a fixed span of time. Rows are appended as they
+# come in, with every column encoded against the previous row of the same segment: metrics are
+# stored as the zigzag varint of the change in their fixed-point value, and timestamps as the
+# change in the gap between samples (delta of delta). Steady metrics cost one byte per value and
+# a regular clock costs one byte per timestamp. Queries memory-map the segments they need.
+
+DEFAULT_STORE_DIR = '/opt/monitor/tsdb'
+MAGIC = b'SPMTS1'
+SEGMENT_HEADER = struct.Struct('<6sH') # magic, number of columns
+DAY = 86400
+
+# Every metric stored, and how many steps per unit it's stored with
+METRICS = COLUMNS[1:]
+SCALES = {
+    'timestamp': 1000, # Milliseconds
+    'interval': 10000,
+    'cpu_percent': 100,
+    'memory_percent': 100,
+    'load_avg': 100,
+    'count': 1,
+    'weight': 1000, # Seconds of samples in a rollup bucket
+}
+DEFAULT_SCALE = 1 # Byte rates are whole numbers already
+
+# name, rollup bucket in seconds (0 for raw samples), time covered by one segment file, how long segments are kept
+TIERS = (
+    ('raw', 0, 3600, 2 * DAY),
+    ('1m', 60, DAY, 30 * DAY),
+    ('1h', 3600, 30 * DAY, 365 * DAY),
+)
+RETENTION_CHECK_INTERVAL = 600
+MAX_QUERY_ROWS = 20000 # Queries pick the finest tier that stays under this
+
+
+# The columns stored in a tier, in the order they are written
+def tier_columns(bucket):
+    if not bucket:
+        return ('timestamp',) + METRICS
+    columns = ['timestamp', 'count', 'weight']
+    for name in METRICS:
+        columns += [f'{name}_min', f'{name}_max', f'{name}_avg']
+    return tuple(columns)
+
+def column_scale(column):
+    if column in SCALES:
+        return SCALES[column]
+    return SCALES.get(column.rsplit('_', 1)[0], DEFAULT_SCALE)
+
+def encode_varint(value, out):
+    # Zigzag so small negative changes stay small too
+    value = (value << 1) ^ (value >> 63)
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def decode_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            break
+        shift += 7
+    return (result >> 1) ^ -(result & 1), pos
+
+
+# Appends rows to the current segment of one tier, keeping the per-column delta state
+class SegmentWriter:
+
+    def __init__(self, directory, name, span, columns):
+        self.directory = directory
+        self.name = name
+        self.span = span
+        self.columns = columns
+        self.scales = [column_scale(c) for c in columns]
+        self.segment_start = None
+        self.fd = None
+
+    def path(self, segment_start):
+        return os.path.join(self.directory, f'{self.name}-{segment_start}.seg')
+
+    def open_segment(self, segment_start):
+        self.close()
+        path = self.path(segment_start)
+        self.segment_start = segment_start
+        self.previous = [0] * len(self.columns)
+        self.previous_gap = 0
+        if os.path.exists(path):
+            try:
+                # Carry on from where the last run stopped, dropping any half-written row at the end
+                _, end, self.previous, self.previous_gap = decode_segment(path, len(self.columns))
+                os.truncate(path, end)
+                self.fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+                return
+            except ValueError:
+                # Written by a version with different columns, keep it out of the way rather than mixing the two.
+                # Each one put aside gets a name of its own (.old, .old.1, ...) so an earlier one isn't overwritten.
+                aside = path + '.old'
+                count = 0
+                while os.path.exists(aside):
+                    count += 1
+                    aside = f'{path}.old.{count}'
+                os.replace(path, aside)
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.write(self.fd, SEGMENT_HEADER.pack(MAGIC, len(self.columns)))
+
+    def append(self, row):
+        timestamp = row[0]
+        segment_start = int(timestamp // self.span * self.span)
+        if segment_start != self.segment_start:
+            self.open_segment(segment_start)
+
+        out = bytearray()
+        for i, value in enumerate(row):
+            fixed = round(value * self.scales[i])
+            if i == 0:
+                gap = fixed - self.previous[0]
+                encode_varint(gap - self.previous_gap, out)
+                self.previous_gap = gap
+            else:
+                encode_varint(fixed - self.previous[i], out)
+            self.previous[i] = fixed
+        # One write per row keeps rows whole on disk as long as the write isn't cut short
+        os.write(self.fd, out)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+# Decode a whole segment file from a memory map. Returns (rows as columns of fixed-point ints,
+# offset just past the last whole row, last fixed-point values, last timestamp gap).
+def decode_segment(path, column_count):
+    columns = [[] for _ in range(column_count)]
+    previous = [0] * column_count
+    previous_gap = 0
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < SEGMENT_HEADER.size:
+            return columns, 0, previous, previous_gap
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, stored_count = SEGMENT_HEADER.unpack_from(data, 0)
+        if magic != MAGIC or stored_count != column_count:
+            raise ValueError(f"{path} isn't a segment with {column_count} columns")
+        pos = SEGMENT_HEADER.size
+        end = pos
+        while pos < size:
+            row = []
+            gap = previous_gap
+            try:
+                for i in range(column_count):
+                    delta, pos = decode_varint(data, pos)
+                    if i == 0:
+                        gap = previous_gap + delta
+                        row.append(previous[0] + gap)
+                    else:
+                        row.append(previous[i] + delta)
+            except IndexError:
+                break # Half-written row at the end
+            previous = row
+            previous_gap = gap
+            end = pos
+            for i, value in enumerate(row):
+                columns[i].append(value)
+        return columns, end, previous, previous_gap
+    finally:
+        data.close()
+
+
+# Running min/max/sum of each metric over one rollup bucket
+class Rollup:
+
+    def __init__(self, writer, bucket):
+        self.writer = writer
+        self.bucket = bucket
+        self.start = None
+        self.count = 0
+
+    # weight is how many seconds the sample covers, so averages are over time rather than samples and a
+    # burst of fast samples doesn't outweigh the slow ones around it
+    def add(self, timestamp, values, weight=1.0):
+        bucket_start = timestamp // self.bucket * self.bucket
+        if bucket_start != self.start:
+            self.flush()
+            self.start = bucket_start
+            self.count = 0
+            self.weight = 0.0
+            self.mins = list(values)
+            self.maxs = list(values)
+            self.sums = [value * weight for value in values]
+        else:
+            for i, value in enumerate(values):
+                if value < self.mins[i]:
+                    self.mins[i] = value
+                if value > self.maxs[i]:
+                    self.maxs[i] = value
+                self.sums[i] += value * weight
+        self.count += 1
+        self.weight += weight
+
+    def flush(self):
+        if not self.count:
+            return
+        row = [self.start, self.count, self.weight]
+        for i in range(len(self.mins)):
+            row += [self.mins[i], self.maxs[i], self.sums[i] / self.weight]
+        self.writer.append(row)
+        self.count = 0
+
+
+class TimeSeriesStore:
+
+    def __init__(self, directory=DEFAULT_STORE_DIR, readonly=False):
+        self.directory = directory
+        self.readonly = readonly
+        self.lock = threading.Lock()
+        if readonly:
+            return
+        os.makedirs(directory, exist_ok=True)
+        self.writers = []
+        self.rollups = []
+        for name, bucket, span, _ in TIERS:
+            writer = SegmentWriter(directory, name, span, tier_columns(bucket))
+            self.writers.append(writer)
+            if bucket:
+                self.rollups.append(Rollup(writer, bucket))
+        self.raw_writer = self.writers[0]
+        threading.Thread(target=self.retention_loop, daemon=True).start()
+
+    # Store one sample from the collector and fold it into the rollups
+    def append(self, sample):
+        timestamp = sample['timestamp']
+        values = [float(sample.get(name) or 0) for name in METRICS]
+        weight = sample.get('interval') or 1.0
+        with self.lock:
+            self.raw_writer.append([timestamp] + values)
+            for rollup in self.rollups:
+                rollup.add(timestamp, values, weight)
+
+    # Delete segments that have aged out of their tier's retention
+    def enforce_retention(self, now=None):
+        now = now or time.time()
+        for name, _, span, retention in TIERS:
+            for segment_start, path in self.segments(name):
+                if segment_start + span < now - retention:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+    def retention_loop(self):
+        while True:
+            try:
+                self.enforce_retention()
+            except Exception as e:
+                print(f"An error occurred while enforcing retention: {e}")
+            time.sleep(RETENTION_CHECK_INTERVAL)
+
+    # (segment start, path) of every segment of a tier, oldest first
+    def segments(self, name):
+        found = []
+        try:
+            entries = os.listdir(self.directory)
+        except FileNotFoundError:
+            return found
+        for entry in entries:
+            prefix, _, rest = entry.partition('-')
+            start, _, suffix = rest.partition('.')
+            # .seg.old (then .seg.old.1 and so on) segments were put aside by a version with other columns, but are still read
+            if suffix == 'seg':
+                order = math.inf
+            elif suffix == 'seg.old':
+                order = 0
+            elif suffix.startswith('seg.old.') and suffix[8:].isdigit():
+                order = int(suffix[8:])
+            else:
+                continue
+            if prefix == name and start.isdigit():
+                found.append((int(start), order, os.path.join(self.directory, entry)))
+        # A segment put aside holds what was written before the ones that replaced it
+        found.sort()
+        return [(start, path) for start, _, path in found]
+
+    # Pick the finest tier that answers a query over this span in at most MAX_QUERY_ROWS rows
+    def pick_tier(self, start, end, sample_period=1.0):
+        span = max(0.0, end - start)
+        for name, bucket, _, _ in TIERS:
+            if span / (bucket or sample_period) <= MAX_QUERY_ROWS:
+                return name
+        return TIERS[-1][0]
+
+    # Everything stored between start and end (unix timestamps), as columns of floats.
+    # resolution is 'raw', '1m', '1h', or None to pick one from the length of the range.
+    def query(self, start, end, resolution=None):
+        if resolution is None:
+            resolution = self.pick_tier(start, end)
+        tier = next((t for t in TIERS if t[0] == resolution), None)
+        if tier is None:
+            raise ValueError(f"Unknown resolution {resolution!r}")
+        name, bucket, span, _ = tier
+        columns = tier_columns(bucket)
+        scales = [column_scale(c) for c in columns]
+
+        result = {column: [] for column in columns}
+        for segment_start, path in self.segments(name):
+            # Only open the segments that overlap the range
+            if segment_start + span <= start or segment_start > end:
+                continue
+            try:
+                rows = decode_segment(path, len(columns))[0]
+            except ValueError:
+                if not bucket:
+                    continue
+                try:
+                    # Rollups from before they had a weight averaged every sample equally, as if each covered one second
+                    rows = decode_segment(path, len(columns) - 1)[0]
+                except ValueError:
+                    continue # Not a layout we know, leave it out rather than failing the whole query
+                rows.insert(2, [count * scales[2] for count in rows[1]])
+            low, high = start * scales[0], end * scales[0]
+            keep = [i for i, ts in enumerate(rows[0]) if low <= ts <= high]
+            for column, values, scale in zip(columns, rows, scales):
+                result[column].extend(values[i] / scale for i in keep)
+        if bucket:
+            result = merge_buckets(result, columns)
+        result['resolution'] = name
+        return result
+
+    def close(self):
+        if self.readonly:
+            return
+        with self.lock:
+            # Write out the partly filled buckets so a restart doesn't lose them (queries merge the halves back together)
+            for rollup in self.rollups:
+                rollup.flush()
+            for writer in self.writers:
+                writer.close()
+
+
+# Combine rollup rows that share a bucket, which happens when the collector restarts part way through one
+def merge_buckets(result, columns):
+    timestamps = result['timestamp']
+    if len(set(timestamps)) == len(timestamps):
+        return result
+    merged = {column: [] for column in columns}
+    index = {}
+    for row in range(len(timestamps)):
+        timestamp = timestamps[row]
+        if timestamp not in index:
+            index[timestamp] = len(merged['timestamp'])
+            for column in columns:
+                merged[column].append(result[column][row])
+            continue
+        target = index[timestamp]
+        merged['count'][target] += result['count'][row]
+        # Averages are over time, so the halves count for as many seconds of samples as they hold
+        old_weight = merged['weight'][target]
+        weight = result['weight'][row]
+        merged['weight'][target] = old_weight + weight
+        for column in columns[3:]:
+            value = result[column][row]
+            if column.endswith('_min'):
+                merged[column][target] = min(merged[column][target], value)
+            elif column.endswith('_max'):
+                merged[column][target] = max(merged[column][target], value)
+            elif old_weight + weight > 0:
+                merged[column][target] = (merged[column][target] * old_weight + value * weight) / (old_weight + weight)
+    return merged
@@ -0,0 +1,147 @@
+import gzip
+import json
+import struct
+import sys
+from array import array
+
+# zstd is optional, bulk responses fall back to gzip without it
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compact columnar encoding for the agent's API.
+#
+# JSON stays the default. Clients that send "Accept: application/x-spm-columns" get this instead: a
+# small header naming each column, then each column as one run of little-endian numbers, then
+# everything that isn't a plain number (per-core lists, per-device tables, ...) as one compact
+# JSON object. Reading a column back is a single frombytes into an array, with no per-value parsing.
+
+BINARY_MIME = 'application/x-spm-columns'
+JSON_MIME = 'application/json'
+MAGIC = b'SPMC'
+VERSION = 1
+HEADER = struct.Struct('<4sBIH') # magic, version, rows, number of columns
+COLUMN_HEADER = struct.Struct('<cB') # typecode ('q' whole numbers or 'd' doubles), name length
+SWAP_BYTES = sys.byteorder != 'little'
+COMPRESS_MIN_BYTES = 1024 # Bodies smaller than this aren't worth compressing
+SERVED_HEADER = 'X-Served-At' # Response header with the unix time the agent or relay sent it, by its own clock
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def compact_json(data):
+    return json.dumps(data, separators=(',', ':')).encode()
+
+# A list of numbers as an array: whole numbers if they all are, otherwise doubles (None becomes NaN).
+# None if the list holds anything else.
+def to_array(values):
+    for typecode in 'qd':
+        try:
+            return array(typecode, values)
+        except TypeError:
+            pass
+    if all(v is None or is_number(v) for v in values):
+        return array('d', (float('nan') if v is None else v for v in values))
+    return None
+
+# Encode equal-length columns of numbers. Anything else in the dict (counts, names, nested data) goes in the
+# JSON part, along with extra.
+def encode_columns(columns, rows, extra=None):
+    header = bytearray()
+    blocks = []
+    extra = dict(extra or {})
+    for name, values in columns.items():
+        if not isinstance(values, (list, array)) or len(values) != rows:
+            extra[name] = values
+            continue
+        if isinstance(values, array):
+            typecode = 'd' if values.typecode in 'fd' else 'q'
+            values = values if values.typecode == typecode else array(typecode, values)
+        else:
+            values = to_array(values)
+            if values is None:
+                extra[name] = columns[name]
+                continue
+            typecode = values.typecode
+        if SWAP_BYTES:
+            values = array(typecode, values)
+            values.byteswap()
+        encoded_name = name.encode()
+        header += COLUMN_HEADER.pack(typecode.encode(), len(encoded_name)) + encoded_name
+        blocks.append(values.tobytes())
+    return HEADER.pack(MAGIC, VERSION, rows, len(blocks)) + header + b''.join(blocks) + (compact_json(extra) if extra else b'')
+
+# Encode a single sample as a one-row table
+def encode_sample(sample):
+    numbers = {name: [value] for name, value in sample.items() if is_number(value)}
+    return encode_columns(numbers, 1, {name: value for name, value in sample.items() if name not in numbers})
+
+# Decode a body back into a dict of arrays (one per column) plus whatever was in the JSON part
+def decode_columns(payload):
+    magic, version, rows, count = HEADER.unpack_from(payload, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a columnar metrics payload")
+    pos = HEADER.size
+    layout = []
+    for _ in range(count):
+        typecode, length = COLUMN_HEADER.unpack_from(payload, pos)
+        pos += COLUMN_HEADER.size
+        layout.append((payload[pos:pos + length].decode(), typecode.decode()))
+        pos += length
+
+    view = memoryview(payload)
+    result = {}
+    for name, typecode in layout:
+        values = array(typecode)
+        end = pos + rows * values.itemsize
+        values.frombytes(view[pos:end])
+        if SWAP_BYTES:
+            values.byteswap()
+        result[name] = values
+        pos = end
+    if pos < len(payload):
+        result.update(json.loads(view[pos:].tobytes()))
+    return result
+
+# Decode a body from encode_sample back into a plain sample dict
+def decode_sample(payload):
+    return {name: value[0] if isinstance(value, array) else value for name, value in decode_columns(payload).items()}
+
+
+# The format to answer a Flask request in: JSON unless the client prefers the columnar binary format
+def negotiate(request):
+    return request.accept_mimetypes.best_match([JSON_MIME, BINARY_MIME], default=JSON_MIME)
+
+# How to compress a body of this size for a Flask request ("zstd", "gzip" or None)
+def choose_encoding(request, size):
+    if size < COMPRESS_MIN_BYTES:
+        return None
+    if zstandard is not None and request.accept_encodings["zstd"]:
+        return "zstd"
+    if request.accept_encodings["gzip"]:
+        return "gzip"
+    return None
+
+def compress(body, encoding):
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor().compress(body)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=1) # Nearly all of the saving for a fraction of the CPU
+    return body
+
+def encode_body(columns, rows, mimetype):
+    return encode_columns(columns, rows) if mimetype == BINARY_MIME else compact_json(columns)
+
+# Encode columns for a Flask request in the negotiated format, compressed if the client takes it.
+# Returns (body, mimetype, headers).
+def encode_response(columns, rows, request):
+    mimetype = negotiate(request)
+    body = encode_body(columns, rows, mimetype)
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    encoding = choose_encoding(request, len(body))
+    if encoding:
+        body = compress(body, encoding)
+        headers["Content-Encoding"] = encoding
+    return body, mimetype, headers